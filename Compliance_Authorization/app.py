@@ -2,11 +2,18 @@
 """
 from enum import Enum
 from urllib.parse import quote_plus, urlencode
-import requests
 from authlib.integrations.flask_client import OAuth
-from flask import Flask, redirect, render_template, session, url_for, request, abort
+from flask import Flask, g, redirect, render_template, session, url_for, request, abort
 from dotenv import load_dotenv
 import os
+import sys
+
+#instrumentation.py is shared by the services in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import instrumentation
+from auth_cache import JwksCache, RoleResolver
+from edge_cache import EdgeCache
+from proxy import Upstream
 
 load_dotenv()
 AUTH0_CLIENT_ID = os.getenv("AUTH0_CLIENT_ID")
@@ -14,12 +21,36 @@ AUTH0_CLIENT_SECRET = os.getenv("AUTH0_CLIENT_SECRET")
 AUTH0_DOMAIN = os.getenv("AUTH0_DOMAIN")
 APP_SECRET_KEY = os.getenv("APP_SECRET_KEY")
 
-URL_Recommender = os.getenv("URL_Recommender")
-URL_Company_Control_Store = os.getenv("URL_Company_Control_Store")
-URL_Chat = os.getenv("URL_Chat")
+URL_Recommender = os.getenv("URL_Recommender", "http://127.0.0.1:2001/")
+URL_Company_Control_Store = os.getenv("URL_Company_Control_Store", "http://127.0.0.1:2002/")
+URL_Chat = os.getenv("URL_Chat", "http://127.0.0.1:2003/")
+
+#Keep-alive connection pools to the upstream services, LLM answers may take minutes on a CPU
+UPSTREAM_POOL_SIZE = int(os.getenv("UPSTREAM_POOL_SIZE", 20))
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", 3.05))
+UPSTREAM_READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", 60))
+CHAT_READ_TIMEOUT = float(os.getenv("CHAT_READ_TIMEOUT", 300))
+recommender = Upstream(URL_Recommender, UPSTREAM_POOL_SIZE, UPSTREAM_CONNECT_TIMEOUT, UPSTREAM_READ_TIMEOUT)
+company_control_store = Upstream(URL_Company_Control_Store, UPSTREAM_POOL_SIZE, UPSTREAM_CONNECT_TIMEOUT,
+                                 UPSTREAM_READ_TIMEOUT)
+chat_service = Upstream(URL_Chat, UPSTREAM_POOL_SIZE, UPSTREAM_CONNECT_TIMEOUT, CHAT_READ_TIMEOUT)
+
+#GET pages of the GDPR exploration and the company controls are cached and revalidated with their ETag
+EDGE_CACHE_MAX_MB = int(os.getenv("EDGE_CACHE_MAX_MB", 64))
+EDGE_CACHE_FRESH_SECONDS = float(os.getenv("EDGE_CACHE_FRESH_SECONDS", 5))
+edge_cache = EdgeCache(max_bytes=EDGE_CACHE_MAX_MB * 1024 * 1024, fresh_seconds=EDGE_CACHE_FRESH_SECONDS)
+
+#With an API audience Auth0 issues JWT access tokens, which are validated locally against the cached JWKS
+AUTH0_AUDIENCE = os.getenv("AUTH0_AUDIENCE")
+ROLES_CLAIM = os.getenv("ROLES_CLAIM", "/roles")
+JWKS_REFRESH_INTERVAL = int(os.getenv("JWKS_REFRESH_INTERVAL", 3600))
+
+#Requests slower than this are logged with their stage breakdown, metrics are served on /metrics
+SLOW_REQUEST_SECONDS = float(os.getenv("SLOW_REQUEST_SECONDS", 2))
 
 app = Flask(__name__)
 app.secret_key = APP_SECRET_KEY
+instrumentation.Instrumentation(app, "gateway", SLOW_REQUEST_SECONDS)
 
 oauth = OAuth(app)
 
@@ -33,6 +64,11 @@ oauth.register(
     server_metadata_url=f'https://{AUTH0_DOMAIN}/.well-known/openid-configuration',
 )
 
+jwks = JwksCache(f"https://{AUTH0_DOMAIN}/.well-known/jwks.json", refresh_interval=JWKS_REFRESH_INTERVAL)
+jwks.start()
+role_resolver = RoleResolver(jwks, issuer=f"https://{AUTH0_DOMAIN}/", userinfo_url=f"https://{AUTH0_DOMAIN}/userinfo",
+                             audience=AUTH0_AUDIENCE, roles_claim=ROLES_CLAIM)
+
 
 class Options(Enum):
     """Class for the company controls options"""
@@ -40,18 +76,17 @@ class Options(Enum):
     GUIDELINE = "GUIDELINE"
 
 
+def current_roles():
+    """Roles of the logged in user, resolved once per request"""
+    if 'roles' not in g:
+        with instrumentation.stage("auth"):
+            g.roles = role_resolver.roles(session)
+    return g.roles
+
+
 def check_role(role):
     """Function to check if a user has a specific role"""
-    access_token = session['user']['access_token']
-    headers = {
-        'Authorization': f'Bearer {access_token}'
-    }
-
-    user_info_url = f"https://{AUTH0_DOMAIN}/userinfo"
-    response = requests.get(user_info_url, headers=headers)
-    user_info = response.json()
-    roles = user_info.get('/roles', 'No roles found')
-    if role in roles:
+    if role in current_roles():
         return True
     return False
 
@@ -73,6 +108,11 @@ def callback():
 
 @app.route("/login")
 def login():
+    if AUTH0_AUDIENCE:
+        return oauth.auth0.authorize_redirect(
+            redirect_uri=url_for("callback", _external=True),
+            audience=AUTH0_AUDIENCE
+        )
     return oauth.auth0.authorize_redirect(
         redirect_uri=url_for("callback", _external=True)
     )
@@ -95,13 +135,28 @@ def logout():
     )
 
 
+@app.route("/auth_stats")
+def auth_stats():
+    """Where the roles of the role-checked routes came from, hit_rate counts lookups without a /userinfo call"""
+    if 'user' not in session:
+        return redirect(url_for('login'))
+    return role_resolver.stats()
+
+
+@app.route("/edge_cache_stats")
+def edge_cache_stats():
+    """Hits, revalidations and misses of the gateway cache"""
+    if 'user' not in session:
+        return redirect(url_for('login'))
+    return edge_cache.stats()
+
+
 @app.route("/graph_home")
 def graph_home():
     if 'user' not in session:
         return redirect(url_for('login'))
 
-    r = requests.get(URL_Recommender)
-    return r.text
+    return edge_cache.respond(recommender, '', 'recommender')
 
 
 @app.route("/graph")
@@ -109,13 +164,7 @@ def graph():
     """Route to the graph endpoint of the GDPR exploration"""
     if 'user' not in session:
         return redirect(url_for('login'))
-    query_string = request.query_string.decode()
-    new_url = f'{URL_Recommender}graph'
-    if query_string:
-        new_url += f'?{query_string}'
-
-    r = requests.get(new_url)
-    return r.text
+    return edge_cache.respond(recommender, 'graph', 'recommender')
 
 
 @app.route("/node_relationships")
@@ -123,12 +172,15 @@ def node_relationships():
     """Route to the node relationship endpoint of the GDPR exploration"""
     if 'user' not in session:
         return redirect(url_for('login'))
-    query_string = request.query_string.decode()
-    new_url = f'{URL_Recommender}+node_relationships'
-    if query_string:
-        new_url += '?' + query_string
-    r = requests.get(new_url)
-    return r.text
+    return recommender.forward('node_relationships')
+
+
+def llm_answer(path):
+    """JSON answer of the LLM recommender, errors like a full queue are passed on as they are"""
+    r = chat_service.request('GET', path, request.query_string.decode(), stream=True)
+    if r.status_code != 200:
+        return None, Upstream.response(r)
+    return r.json(), None
 
 
 @app.route("/query")
@@ -136,12 +188,9 @@ def query():
     """Get the response from the LLM based on the MongoDB Atlas Search """
     if 'user' not in session:
         return redirect(url_for('login'))
-    query_string = request.query_string.decode()
-    new_url = 'http://127.0.0.1:2003/query'
-    if query_string:
-        new_url += '?' + query_string
-    r = requests.get(new_url)
-    result = r.json()
+    result, error = llm_answer('query')
+    if error:
+        return error
     return render_template(
         "home.html",
         session=session.get("user"),
@@ -158,12 +207,9 @@ def chat():
     """Get the response from the LLM based on the generative AI with Ollama"""
     if 'user' not in session:
         return redirect(url_for('login'))
-    query_string = request.query_string.decode()
-    new_url = 'http://127.0.0.1:2003/chat'
-    if query_string:
-        new_url += '?' + query_string
-    r = requests.get(new_url)
-    result = r.json()
+    result, error = llm_answer('chat')
+    if error:
+        return error
     return render_template(
         "home.html",
         session=session.get("user"),
@@ -175,6 +221,16 @@ def chat():
     )
 
 
+@app.route("/chat/stream")
+def chat_stream():
+    """Pass the Server-Sent Events of the streaming chat through to the browser as they arrive"""
+    if 'user' not in session:
+        return redirect(url_for('login'))
+    response = chat_service.forward('chat/stream')
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
 @app.route("/search_bool")
 def search_bool():
     """Route to determine which LLM function is required"""
@@ -208,8 +264,7 @@ def company_controls():
     """Route for handling the company controls creating, editing and deleting """
     if 'user' not in session:
         return redirect(url_for('login'))
-    r = requests.get(URL_Company_Control_Store)
-    return r.text
+    return edge_cache.respond(company_control_store, '', 'company_controls')
 
 
 @app.route("/document", methods=['GET', 'POST'])
@@ -218,15 +273,8 @@ def new_document():
     if 'user' not in session:
         return redirect(url_for('login'))
     if request.method == 'POST':
-        new_url = 'http://127.0.0.1:2002/document'
-        files = request.files
-        parameter = request.form
-        r = requests.post(new_url, data=parameter, files=files)
-        return r.text
-    else:
-        new_url = 'http://127.0.0.1:2002/document'
-        r = requests.get(new_url)
-        return r.text
+        edge_cache.invalidate('company_controls')
+    return company_control_store.forward('document')
 
 
 @app.route('/document/<doc_id>')
@@ -234,9 +282,9 @@ def view_document(doc_id):
     """Route for viewing the given company control"""
     if 'user' not in session:
         return redirect(url_for('login'))
-    new_url = f'http://127.0.0.1:2002/document/{doc_id}'
-    r = requests.get(new_url)
-    return r.text
+    # scoped by role, as the page offers the DPO actions
+    return edge_cache.respond(company_control_store, f'document/{doc_id}', 'company_controls',
+                              scope=tuple(sorted(current_roles())))
 
 
 @app.route('/document/edit/<doc_id>', methods=['GET', 'POST'])
@@ -246,18 +294,9 @@ def edit_document(doc_id):
         return redirect(url_for('login'))
 
     if check_role("Data Protection Officer"):
-        new_url = f'http://127.0.0.1:2002/document/edit/{doc_id}'
         if request.method == 'POST':
-            files = request.files
-            parameter = request.form
-            r = requests.post(new_url, data=parameter, files=files)
-            return r.text
-        else:
-            query_string = request.query_string.decode()
-            if query_string:
-                new_url += '?' + query_string
-            r = requests.get(new_url)
-            return r.text
+            edge_cache.invalidate('company_controls')
+        return company_control_store.forward(f'document/edit/{doc_id}')
     else:
         abort(403)  # Forbidden
 
@@ -267,11 +306,7 @@ def file(file_id):
     """Route for loading the PDF of the given company control"""
     if 'user' not in session:
         return redirect(url_for('login'))
-    new_url = f'http://127.0.0.1:2002/file/{file_id}'
-    query_string = request.query_string.decode()
-    if query_string:
-        new_url += '?' + query_string
-    return redirect(new_url)
+    return company_control_store.forward(f'file/{file_id}')
 
 
 @app.route('/document/delete/<doc_id>', methods=['POST'])
@@ -280,9 +315,8 @@ def delete_document(doc_id):
     if 'user' not in session:
         return redirect(url_for('login'))
     if check_role("Data Protection Officer"):
-        new_url = f'http://127.0.0.1:2002/document/delete/{doc_id}'
-        r = requests.post(new_url)
-        return r.text
+        edge_cache.invalidate('company_controls')
+        return company_control_store.forward(f'document/delete/{doc_id}')
     else:
         abort(403)
 
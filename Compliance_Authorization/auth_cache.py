@@ -0,0 +1,155 @@
+"""Local validation of Auth0 access tokens and per-session caching of the user roles
+"""
+import threading
+import time
+
+import requests
+from authlib.jose import JsonWebKey, JsonWebToken, JoseError
+
+# Auth0 signs its tokens with RS256, tokens with any other algorithm (HS256, none) are rejected
+jwt = JsonWebToken(['RS256'])
+
+
+class JwksCache:
+    """Signing keys of the Auth0 tenant, refreshed in the background so key rotation is picked up
+    without a request waiting for it"""
+    def __init__(self, jwks_url, refresh_interval=3600, min_refresh_interval=60, timeout=5):
+        self.jwks_url = jwks_url
+        self.refresh_interval = refresh_interval
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.key_set = None
+        self.fetched_at = 0
+        self.refreshes = 0
+        self.errors = 0
+        self.thread = None
+
+    def refresh(self):
+        """Fetches the key set, the previous keys are kept when Auth0 cannot be reached"""
+        with self.lock:
+            if time.monotonic() - self.fetched_at < self.min_refresh_interval and self.key_set is not None:
+                return False
+            self.fetched_at = time.monotonic()
+        try:
+            response = requests.get(self.jwks_url, timeout=self.timeout)
+            response.raise_for_status()
+            key_set = JsonWebKey.import_key_set(response.json())
+        except (requests.RequestException, ValueError, JoseError):
+            with self.lock:
+                self.errors += 1
+            return False
+        with self.lock:
+            self.key_set = key_set
+            self.refreshes += 1
+        return True
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="jwks-refresh", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            self.refresh()
+            time.sleep(self.refresh_interval)
+
+
+class RoleResolver:
+    """Roles of the logged in user without an outbound call in the common case:
+    1. the roles claim of the access token, validated locally against the cached JWKS
+    2. the roles claim of the ID token, validated by authlib at login
+    3. /userinfo, cached in the session until the access token expires"""
+    def __init__(self, jwks, issuer, userinfo_url, audience=None, roles_claim="/roles", leeway=30, timeout=5):
+        self.jwks = jwks
+        self.issuer = issuer
+        self.userinfo_url = userinfo_url
+        self.audience = audience
+        self.roles_claim = roles_claim
+        self.leeway = leeway
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.counters = {'access_token': 0, 'id_token': 0, 'session': 0, 'userinfo': 0, 'invalid_tokens': 0,
+                         'userinfo_errors': 0}
+
+    def _count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def _decode(self, token, key_set):
+        options = {'iss': {'essential': True, 'value': self.issuer}}
+        if self.audience:
+            options['aud'] = {'essential': True, 'value': self.audience}
+        claims = jwt.decode(token, key_set, claims_options=options)
+        claims.validate(leeway=self.leeway)
+        return claims
+
+    def access_token_claims(self, token):
+        """Claims of a valid JWT access token, None for opaque or invalid tokens"""
+        if token.count(".") != 2:
+            # opaque access token, issued when no API audience is requested
+            return None
+        if self.jwks.key_set is None:
+            self.jwks.refresh()
+            if self.jwks.key_set is None:
+                return None
+        try:
+            return self._decode(token, self.jwks.key_set)
+        except ValueError:
+            # unknown kid, the keys may have been rotated since the last refresh
+            if not self.jwks.refresh():
+                return None
+            try:
+                return self._decode(token, self.jwks.key_set)
+            except (ValueError, JoseError):
+                self._count('invalid_tokens')
+                return None
+        except JoseError:
+            self._count('invalid_tokens')
+            return None
+
+    def roles(self, session):
+        user = session['user']
+        access_token = user['access_token']
+        now = time.time()
+        expires_at = user.get('expires_at') or now + 60
+
+        claims = self.access_token_claims(access_token)
+        if claims is not None and self.roles_claim in claims:
+            self._count('access_token')
+            return claims[self.roles_claim]
+
+        id_token_claims = user.get('userinfo') or {}
+        if self.roles_claim in id_token_claims and expires_at > now:
+            self._count('id_token')
+            return id_token_claims[self.roles_claim]
+
+        # the session cookie is signed, so the cached roles cannot be altered by the browser
+        cached = session.get('roles')
+        if cached is not None and cached['access_token_expires_at'] == expires_at and expires_at > now:
+            self._count('session')
+            return cached['roles']
+
+        self._count('userinfo')
+        try:
+            response = requests.get(self.userinfo_url, headers={'Authorization': f'Bearer {access_token}'},
+                                    timeout=self.timeout)
+            response.raise_for_status()
+            roles = response.json().get(self.roles_claim, [])
+        except (requests.RequestException, ValueError):
+            # no roles for this request only, failed lookups (rate limit, expired token) are not cached
+            self._count('userinfo_errors')
+            return []
+        session['roles'] = {'roles': roles, 'access_token_expires_at': expires_at}
+        return roles
+
+    def stats(self):
+        with self.lock:
+            counters = dict(self.counters)
+        with self.jwks.lock:
+            jwks_refreshes, jwks_errors = self.jwks.refreshes, self.jwks.errors
+        lookups = sum(counters[source] for source in ('access_token', 'id_token', 'session', 'userinfo'))
+        return dict(counters,
+                    lookups=lookups,
+                    hit_rate=round(1 - counters['userinfo'] / lookups, 4) if lookups else None,
+                    jwks_refreshes=jwks_refreshes,
+                    jwks_errors=jwks_errors)
@@ -0,0 +1,107 @@
+"""Gateway overhead per request of the pooled streaming proxy against the previous requests.get(...).text routes
+
+Run from the Compliance_Authorization folder:
+    python benchmarks/proxy_overhead.py --requests 500 --size 64
+An upstream, a gateway route in the previous style and one using proxy.Upstream run on local ports.
+The overhead is the latency through a gateway minus the latency of calling the upstream directly.
+The upstream keeps connections alive like a production WSGI server, the Flask development server
+closes every connection and so gains nothing from the pool.
+"""
+import argparse
+import logging
+import os
+import statistics
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from flask import Flask
+from werkzeug.serving import make_server
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from proxy import Upstream  # noqa: E402
+
+
+def serve(app):
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}/"
+
+
+def serve_upstream(body, clients):
+    """Upstream with HTTP/1.1 keep-alive, the client address of every request is added to clients"""
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            clients.add(self.client_address)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}/", server
+
+
+def measure(session, url, count):
+    latencies = []
+    for _ in range(count):
+        start = time.perf_counter()
+        response = session.get(url)
+        response.content
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--size", type=int, default=64, help="upstream body in KB")
+    args = parser.parse_args()
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+    body = b"x" * (args.size * 1024)
+    clients = set()
+    upstream_url, _ = serve_upstream(body, clients)
+
+    previous = Flask("previous")
+    previous.add_url_rule("/payload", "payload", lambda: requests.get(upstream_url + "payload").text)
+    previous_url = serve(previous)
+
+    pooled = Upstream(upstream_url)
+    current = Flask("current")
+    current.add_url_rule("/payload", "payload", lambda: pooled.forward("payload"))
+    current_url = serve(current)
+
+    client = requests.Session()
+    results = {}
+    connections = {}
+    for name, url in (("direct", upstream_url), ("previous", previous_url), ("pooled", current_url)):
+        measure(client, url + "payload", 20)
+        clients.clear()
+        results[name] = measure(client, url + "payload", args.requests)
+        connections[name] = len(clients)
+
+    direct = statistics.mean(results["direct"])
+    print(f"{args.requests} requests, {args.size} KB body")
+    print(f"{'route':<10}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'overhead ms':>14}{'upstream conns':>16}")
+    for name, latencies in results.items():
+        ordered = sorted(latencies)
+        print(f"{name:<10}{statistics.mean(latencies):>10.2f}{ordered[len(ordered) // 2]:>10.2f}"
+              f"{ordered[int(len(ordered) * 0.95)]:>10.2f}{statistics.mean(latencies) - direct:>14.2f}"
+              f"{connections[name]:>16}")
+
+
+if __name__ == "__main__":
+    main()
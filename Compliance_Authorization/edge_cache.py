@@ -0,0 +1,148 @@
+"""Gateway cache of upstream GET responses, revalidated with ETag / Last-Modified
+"""
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlencode
+
+from flask import Response, request
+
+from proxy import Upstream
+
+
+def normalized_query(args):
+    """Query string with sorted parameters, so the order in the URL does not split cache entries"""
+    return urlencode(sorted(args.items(multi=True)))
+
+
+class Entry:
+    def __init__(self, body, content_type, etag, last_modified):
+        self.body = body
+        self.content_type = content_type
+        self.etag = etag
+        self.last_modified = last_modified
+        self.validated = time.monotonic()
+
+
+class EdgeCache:
+    """LRU cache of upstream GET responses bounded by max_bytes. Entries younger than fresh_seconds are
+    served directly, older ones are revalidated with a conditional request to the upstream.
+    Entries belong to a group, which is invalidated as a whole when the upstream data changes"""
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_entry_bytes=4 * 1024 * 1024, fresh_seconds=5):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.fresh_seconds = fresh_seconds
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        # bumped by invalidate, responses fetched before an invalidation are not stored
+        self.generations = {}
+        self.counters = {'hits': 0, 'revalidated': 0, 'misses': 0, 'uncacheable': 0, 'invalidations': 0,
+                         'evictions': 0, 'not_modified': 0}
+
+    def _get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def _put(self, key, entry, generation):
+        with self.lock:
+            if self.generations.get(key[0], 0) != generation:
+                return
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous.body)
+            self.entries[key] = entry
+            self.size += len(entry.body)
+            while self.size > self.max_bytes and self.entries:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted.body)
+                self.counters['evictions'] += 1
+
+    def _count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def invalidate(self, group):
+        with self.lock:
+            self.generations[group] = self.generations.get(group, 0) + 1
+            for key in [key for key in self.entries if key[0] == group]:
+                self.size -= len(self.entries.pop(key).body)
+                self.counters['invalidations'] += 1
+
+    def _response(self, entry):
+        """Response of a cache entry, a browser which already has this version gets a 304"""
+        response = Response(entry.body, content_type=entry.content_type)
+        if entry.etag:
+            response.headers['ETag'] = entry.etag
+        if entry.last_modified:
+            response.headers['Last-Modified'] = entry.last_modified
+        # pages are behind the login, browsers may keep them but have to revalidate
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.make_conditional(request)
+        if response.status_code == 304:
+            self._count('not_modified')
+        return response
+
+    def respond(self, upstream, path, group, scope=None):
+        """Response to the current GET request, from the cache or the upstream. Scope separates the entries
+        of users who see different content, e.g. their roles"""
+        key = (group, path, normalized_query(request.args), scope)
+        entry = self._get(key)
+        if entry is not None and time.monotonic() - entry.validated < self.fresh_seconds:
+            self._count('hits')
+            return self._response(entry)
+
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+        generation = self.generations.get(group, 0)
+        r = upstream.request('GET', path, key[2], stream=True, headers=headers)
+        if r.status_code == 304 and entry is not None:
+            r.close()
+            entry.validated = time.monotonic()
+            self._count('revalidated')
+            return self._response(entry)
+
+        etag = r.headers.get('ETag')
+        last_modified = r.headers.get('Last-Modified')
+        if r.status_code != 200 or not (etag or last_modified):
+            self._count('uncacheable')
+            return Upstream.response(r)
+
+        chunks = []
+        length = 0
+        content = r.iter_content(64 * 1024)
+        for chunk in content:
+            chunks.append(chunk)
+            length += len(chunk)
+            if length > self.max_entry_bytes:
+                # too large to be cached, what was read is sent together with the rest of the stream
+                self._count('uncacheable')
+
+                def remainder(first=b"".join(chunks)):
+                    try:
+                        yield first
+                        yield from content
+                    finally:
+                        r.close()
+
+                return Response(remainder(), status=200, content_type=r.headers.get('Content-Type'))
+        entry = Entry(b"".join(chunks), r.headers.get('Content-Type'), etag, last_modified)
+        self._count('misses')
+        self._put(key, entry, generation)
+        return self._response(entry)
+
+    def stats(self):
+        with self.lock:
+            counters = dict(self.counters)
+            entries = len(self.entries)
+            size = self.size
+        requests = counters['hits'] + counters['revalidated'] + counters['misses']
+        return dict(counters, entries=entries, bytes=size, max_bytes=self.max_bytes,
+                    hit_rate=round((counters['hits'] + counters['revalidated']) / requests, 4) if requests else None)
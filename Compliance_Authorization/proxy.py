@@ -0,0 +1,106 @@
+"""Pooled reverse proxy to the upstream services of the gateway
+"""
+from http.cookiejar import DefaultCookiePolicy
+
+import requests
+from flask import Response, abort, request, stream_with_context
+from requests.adapters import HTTPAdapter
+
+import instrumentation
+
+# Headers which only concern a single connection and are not forwarded
+HOP_BY_HOP = frozenset((
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te', 'trailer',
+    'transfer-encoding', 'upgrade'
+))
+# Response headers of the upstream which are not passed to the browser, the gateway's session cookie is its own
+DROPPED_RESPONSE_HEADERS = HOP_BY_HOP | {'set-cookie', 'set-cookie2'}
+# Request headers of the browser which are passed to the upstream, cookies and credentials stay at the gateway
+FORWARDED_REQUEST_HEADERS = (
+    'Accept', 'Accept-Encoding', 'Accept-Language', 'Content-Type',
+    'If-None-Match', 'If-Modified-Since', 'If-Range', 'Range'
+)
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class RequestBody:
+    """Body of the browser request, streamed to the upstream with its Content-Length instead of chunked"""
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+
+class Upstream:
+    """Keep-alive connection pool to one upstream service with connect and read timeouts"""
+    def __init__(self, base_url, pool_size=10, connect_timeout=3.05, read_timeout=60):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        # the pool is shared by all users, cookies set by the upstream are not kept for the next request
+        self.session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def url(self, path, query_string=None):
+        url = f"{self.base_url}/{path.lstrip('/')}"
+        if query_string:
+            url += '?' + query_string
+        return url
+
+    def request(self, method, path, query_string=None, stream=False, headers=None, **kwargs):
+        """requests.Response of the upstream, unreachable upstreams and timeouts abort with 502 / 504.
+        The request id is passed on, the time until the response headers is the upstream_http stage"""
+        headers = dict(headers or {}, **instrumentation.outgoing_headers())
+        try:
+            with instrumentation.stage("upstream_http"):
+                return self.session.request(method, self.url(path, query_string), timeout=self.timeout,
+                                            stream=stream, headers=headers, **kwargs)
+        except requests.Timeout:
+            abort(504)
+        except requests.ConnectionError:
+            abort(502)
+
+    def forward(self, path=None, method=None, query_string=None, headers=None):
+        """Streams the upstream response to the browser with its status and headers.
+        Path, method, query string and body default to the ones of the current request"""
+        method = method or request.method
+        if query_string is None:
+            query_string = request.query_string.decode()
+        forwarded = {name: request.headers[name] for name in FORWARDED_REQUEST_HEADERS if name in request.headers}
+        forwarded.update(headers or {})
+        body = None
+        if method in ('POST', 'PUT', 'PATCH'):
+            body = RequestBody(request.stream, request.content_length) if request.content_length is not None \
+                else request.stream
+        upstream = self.request(method, path if path is not None else request.path, query_string, stream=True,
+                                data=body, headers=forwarded)
+        return self.response(upstream)
+
+    @staticmethod
+    def response(upstream):
+        """Flask response which streams the body of a requests.Response as it arrives"""
+        headers = [(name, value) for name, value in upstream.raw.headers.items()
+                   if name.lower() not in DROPPED_RESPONSE_HEADERS]
+
+        def generate():
+            completed = False
+            try:
+                # the body is passed on as sent, compressed bodies keep their Content-Encoding
+                yield from upstream.raw.stream(STREAM_CHUNK_SIZE, decode_content=False)
+                completed = True
+            finally:
+                if completed:
+                    # the connection goes back to the pool
+                    upstream.raw.release_conn()
+                else:
+                    # closing the upstream connection stops streaming generations when the browser went away
+                    upstream.close()
+
+        return Response(stream_with_context(generate()), status=upstream.status_code, headers=headers)
@@ -0,0 +1,59 @@
+"""Tests of the gateway's reverse proxy, run with python -m pytest from Compliance_Authorization
+"""
+import os
+import sys
+import threading
+import time
+
+import pytest
+from flask import Flask, flash, request
+from werkzeug.serving import make_server
+
+
+@pytest.fixture(scope="module")
+def upstream_url():
+    """Stand-in for PolicyManager, which flashes a message into its own session cookie after a POST"""
+    upstream = Flask("upstream")
+    upstream.secret_key = "upstream"
+
+    @upstream.route("/document", methods=['GET', 'POST'])
+    def document():
+        if request.method == 'POST':
+            flash("Document created")
+        return {'cookies': sorted(request.cookies)}
+
+    server = make_server('127.0.0.1', 0, upstream, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}/"
+    server.shutdown()
+
+
+@pytest.fixture(scope="module")
+def gateway(upstream_url):
+    os.environ.update(URL_Company_Control_Store=upstream_url, AUTH0_DOMAIN="example.invalid",
+                      APP_SECRET_KEY="gateway")
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app
+    return app
+
+
+@pytest.fixture
+def client(gateway):
+    client = gateway.app.test_client()
+    with client.session_transaction() as session:
+        session['user'] = {'access_token': "token", 'expires_at': time.time() + 600}
+    return client
+
+
+def test_post_document_keeps_login_session(client):
+    response = client.post('/document', data={'title': "Policy"})
+    assert response.status_code == 200
+    with client.session_transaction() as session:
+        assert 'user' in session
+    assert client.get('/document').status_code == 200
+
+
+def test_upstream_cookies_are_not_shared_between_requests(client):
+    client.post('/document', data={'title': "Policy"})
+    response = client.get('/document')
+    assert response.json['cookies'] == []
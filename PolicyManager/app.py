@@ -2,45 +2,60 @@ from enum import Enum
 
 import gridfs
 from bson import ObjectId
-from io import BytesIO
-from flask import Flask, render_template, request, redirect, url_for, send_file, flash, abort
+from flask import Flask, Response, render_template, request, redirect, url_for, flash, abort
 from flask.cli import load_dotenv
 import os
+import sys
 from pymongo import MongoClient
 from werkzeug.utils import secure_filename
+from werkzeug.wsgi import wrap_file
 
+from company_controls.control_cache import ControlCache
+from company_controls.documents import release_control_files, release_file, store_file
 from company_controls.guidelines import Guideline
 from company_controls.policies import Policy
 
+#instrumentation.py is shared by the services in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import instrumentation
+
 app = Flask(__name__)
 app.secret_key = 'password'
 
 # Configuration
 load_dotenv()
 uri = os.getenv("MongoDB_URI")
-client = MongoClient(uri)
+#MongoDB and GridFS commands are recorded as stages, requests slower than this are logged with their stages
+SLOW_REQUEST_SECONDS = float(os.getenv("SLOW_REQUEST_SECONDS", 2))
+instrumentation.Instrumentation(app, "policy_manager", SLOW_REQUEST_SECONDS)
+client = MongoClient(uri, event_listeners=[instrumentation.mongo_listener()])
 db = client.company_controls
 UPLOAD_FOLDER = 'uploads'
 VERSION_FOLDER = os.path.join(UPLOAD_FOLDER, 'versions')
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['VERSION_FOLDER'] = VERSION_FOLDER
 
+#GridFS files are streamed in chunks of this size, a file id never changes its content
+FILE_BUFFER_SIZE = int(os.getenv("FILE_BUFFER_SIZE", 256 * 1024))
+FILE_MAX_AGE = int(os.getenv("FILE_MAX_AGE", 3600))
+#Pages up to this size get an ETag, the gateway does not cache larger responses anyway
+ETAG_MAX_MB = int(os.getenv("ETAG_MAX_MB", 4))
+
 
 class Options(Enum):
     POLICY = "POLICY"
     GUIDELINE = "GUIDELINE"
 
 
-guidelines = {}
-policies = {}
-
-for policy in db.policy.find():
-    object_id = policy.pop('_id')
-    policies[str(object_id)] = policy
+#Company controls are cached per worker and kept coherent through change streams: "auto", "change_stream" or
+#"polling" (a version stamp every CONTROL_CACHE_POLL_INTERVAL seconds, for servers without change streams)
+CONTROL_CACHE_MODE = os.getenv("CONTROL_CACHE_MODE", "auto")
+CONTROL_CACHE_POLL_INTERVAL = float(os.getenv("CONTROL_CACHE_POLL_INTERVAL", 2))
+guidelines = ControlCache(db, "guideline", CONTROL_CACHE_MODE, CONTROL_CACHE_POLL_INTERVAL)
+policies = ControlCache(db, "policy", CONTROL_CACHE_MODE, CONTROL_CACHE_POLL_INTERVAL)
+guidelines.start()
+policies.start()
 
-for guideline in db.guideline.find():
-    object_id = guideline.pop('_id')
-    guidelines[str(object_id)] = guideline
 
 @app.before_request
 def limit_remote_addr():
@@ -48,9 +63,21 @@ def limit_remote_addr():
         abort(403)  # Forbidden
 
 
+@app.after_request
+def conditional_response(response):
+    """ETag on buffered GET responses, a matching If-None-Match is answered with 304 Not Modified.
+    Streamed responses and responses with their own ETag are left alone, bodies above ETAG_MAX_MB are not hashed"""
+    if request.method == 'GET' and response.status_code == 200 and not response.is_streamed \
+            and not response.direct_passthrough and 'ETag' not in response.headers \
+            and (response.content_length or 0) <= ETAG_MAX_MB * 1024 * 1024:
+        response.add_etag()
+        response.make_conditional(request)
+    return response
+
+
 @app.route('/')
 def index():
-    return render_template('index.html', guidelines=guidelines, policies=policies)
+    return render_template('index.html', guidelines=guidelines.summaries(), policies=policies.summaries())
 
 
 @app.route('/document', methods=['GET', 'POST'])
@@ -67,7 +94,7 @@ def new_document():
                 return redirect(url_for('new_document'))
             new_guideline = Guideline(title, description, db, file1)
             mongo_data = new_guideline.save()
-            guidelines[str(mongo_data.inserted_id)] = new_guideline.get_dict()
+            guidelines.changed(str(mongo_data.inserted_id))
             if mongo_data.acknowledged is True:
                 flash('Saving was successful!', 'success')
                 return redirect(url_for('index'))
@@ -82,15 +109,15 @@ def new_document():
                 return redirect(url_for('index'))
             new_policy = Policy(title, description, db, file1)
             mongo_data, policy_data = new_policy.save()
-            policies[str(mongo_data.inserted_id)] = policy_data
+            policies.changed(str(mongo_data.inserted_id))
             if mongo_data.acknowledged is True:
                 flash('Saving was successful!', 'success')
                 return redirect(url_for('index'))
             else:
                 flash('Saving was not successful!', 'error')
                 return redirect(url_for('index'))
-    return render_template('new_document.html', Options=Options, guidelines=guidelines,
-                           policies=policies)
+    return render_template('new_document.html', Options=Options, guidelines=guidelines.summaries(),
+                           policies=policies.summaries())
 
 
 @app.route('/document/<doc_id>')
@@ -111,8 +138,9 @@ def view_document(doc_id):
                  'last_updated': policy_data["file"]["timestamp"], 'version': policy_data["file"]["version"],
                  'old_files': policy_data["file"]["old_files"]}
 
-    return render_template('view_document.html', doc_id=doc_id, guidelines=guidelines, policies=policies, files=files,
-                           guideline_data=guideline_data, policy_data=policy_data)
+    return render_template('view_document.html', doc_id=doc_id, guidelines=guidelines.summaries(),
+                           policies=policies.summaries(), files=files, guideline_data=guideline_data,
+                           policy_data=policy_data)
 
 
 @app.route('/document/edit/<doc_id>', methods=['GET', 'POST'])
@@ -127,14 +155,19 @@ def edit_document(doc_id):
         if policy_data is not None:
             file1 = request.files['file']
             collection = db["policy"]
+            file_id = None
             if file1.filename != '':
-                fs = gridfs.GridFS(db)
                 filename = secure_filename(file1.filename)
-                file_id = fs.put(file1, filename=filename, content_type=file1.content_type)
+                file_id = store_file(db, file1, filename)
+                if file_id == policy_data['file']['file']:
+                    # unchanged re-upload, the policy keeps its file and version
+                    release_file(db, file_id)
+                    file_id = None
+            if file_id is not None:
                 result = collection.update_one(
                     {'_id': ObjectId(doc_id)},
                     {
-                        '$push': {'file.old_files': str(policies[doc_id]['file']['file'])},
+                        '$push': {'file.old_files': str(policy_data['file']['file'])},
                         '$inc': {'file.version': 1},
                         '$set': {'title': request.form['title'], 'description': request.form['description'],
                                  'file.name': filename, 'file.file': file_id}
@@ -148,30 +181,29 @@ def edit_document(doc_id):
                     },
                 )
 
-            updated_policy = collection.find_one({'_id': ObjectId(doc_id)})
-            object_id = updated_policy.pop('_id')
-            policies[str(object_id)] = updated_policy
+            policies.changed(doc_id)
             if result.acknowledged is True:
                 flash('Update was successful!', 'success')
-                return redirect(url_for('view_document', doc_id=doc_id, guidelines=guidelines, policies=policies,
-                                        guideline_data=guideline_data, policy_data=policy_data))
+                return redirect(url_for('view_document', doc_id=doc_id))
             else:
                 flash('Update was not successful!', 'error')
-                return redirect(url_for('view_document', doc_id=doc_id, guidelines=guidelines, policies=policies,
-                                        guideline_data=guideline_data, policy_data=policy_data))
+                return redirect(url_for('view_document', doc_id=doc_id))
         else:
-            guidelines[doc_id]['title'] = request.form['title']
-            guidelines[doc_id]['description'] = request.form['description']
             file1 = request.files['file']
             collection = db["guideline"]
+            file_id = None
             if file1.filename != '':
-                fs = gridfs.GridFS(db)
                 filename = secure_filename(file1.filename)
-                file_id = fs.put(file1, filename=filename, content_type=file1.content_type)
+                file_id = store_file(db, file1, filename)
+                if file_id == guideline_data['file']['file']:
+                    # unchanged re-upload, the guideline keeps its file and version
+                    release_file(db, file_id)
+                    file_id = None
+            if file_id is not None:
                 result = collection.update_one(
                     {'_id': ObjectId(doc_id)},
                     {
-                        '$push': {'file.old_files': str(guidelines[doc_id]['file']['file'])},
+                        '$push': {'file.old_files': str(guideline_data['file']['file'])},
                         '$inc': {'file.version': 1},
                         '$set': {'title': request.form['title'], 'description': request.form['description'],
                                  'file.name': filename, 'file.file': file_id}
@@ -184,26 +216,46 @@ def edit_document(doc_id):
                         '$set': {'title': request.form['title'], 'description': request.form['description']}
                     },
                 )
-            updated_guideline = collection.find_one({'_id': ObjectId(doc_id)})
-            object_id = updated_guideline.pop('_id')
-            guidelines[str(object_id)] = updated_guideline
+            guidelines.changed(doc_id)
             if result.acknowledged is True:
-                return redirect(url_for('view_document', doc_id=doc_id, guidelines=guidelines, policies=policies,
-                                        guideline_data=guideline_data, policy_data=policy_data))
+                return redirect(url_for('view_document', doc_id=doc_id))
             else:
-                return redirect(url_for('view_document', doc_id=doc_id, guidelines=guidelines, policies=policies,
-                                        guideline_data=guideline_data, policy_data=policy_data))
+                return redirect(url_for('view_document', doc_id=doc_id))
+
+    return render_template('edit_document.html', doc_id=doc_id, guidelines=guidelines.summaries(),
+                           policies=policies.summaries(), guideline_data=guideline_data, policy_data=policy_data)
+
+
+@app.route('/cache_stats')
+def cache_stats():
+    """Hits, misses and reloads of the company control caches"""
+    return {'policies': policies.stats(), 'guidelines': guidelines.stats()}
+
 
-    return render_template('edit_document.html', doc_id=doc_id, guidelines=guidelines, policies=policies,
-                           guideline_data=guideline_data, policy_data=policy_data)
+def file_etag(file_data):
+    """Content hash of a GridFS file, files without one are identified by their immutable id"""
+    return file_data.md5 or (file_data.metadata or {}).get('sha256') or str(file_data._id)
 
 
 @app.route('/file/<file_id>')
 def file(file_id):
-    """returns the PDF file for the given file"""
+    """Streams the PDF file for the given file from GridFS. Range requests of PDF viewers are answered with 206,
+    a current copy of the browser with 304"""
+    if not ObjectId.is_valid(file_id):
+        abort(404)
     fs = gridfs.GridFS(db)
-    file_data = fs.get(ObjectId(file_id))
-    return send_file(BytesIO(file_data.read()), mimetype='application/pdf')
+    try:
+        file_data = fs.get(ObjectId(file_id))
+    except gridfs.NoFile:
+        abort(404)
+    response = Response(wrap_file(request.environ, file_data, FILE_BUFFER_SIZE), mimetype='application/pdf',
+                        direct_passthrough=True)
+    response.content_length = file_data.length
+    response.last_modified = file_data.upload_date
+    response.set_etag(file_etag(file_data))
+    response.cache_control.private = True
+    response.cache_control.max_age = FILE_MAX_AGE
+    return response.make_conditional(request, accept_ranges=True, complete_length=file_data.length)
 
 
 @app.route('/document/delete/<doc_id>', methods=['POST'])
@@ -216,9 +268,11 @@ def delete_document(doc_id):
 
     if policy_data is None:
         collection = db["guideline"]
-        result = collection.delete_one({'_id': ObjectId(doc_id)})
-        del guidelines[doc_id]
-        if result.acknowledged is True:
+        deleted = collection.find_one_and_delete({'_id': ObjectId(doc_id)})
+        if deleted is not None:
+            release_control_files(db, deleted['file'])
+        guidelines.changed(doc_id)
+        if deleted is not None:
             flash('Successfully deleted!', 'success')
             return redirect(url_for('index'))
         else:
@@ -226,9 +280,11 @@ def delete_document(doc_id):
             return redirect(url_for('index'))
     else:
         collection = db["policy"]
-        result = collection.delete_one({'_id': ObjectId(doc_id)})
-        del policies[doc_id]
-        if result.acknowledged is True:
+        deleted = collection.find_one_and_delete({'_id': ObjectId(doc_id)})
+        if deleted is not None:
+            release_control_files(db, deleted['file'])
+        policies.changed(doc_id)
+        if deleted is not None:
             return redirect(url_for('index'))
         else:
             return redirect(url_for('index'))
@@ -0,0 +1,197 @@
+import logging
+import threading
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import OperationFailure, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+# fields of the company controls which are listed on every page
+SUMMARY_FIELDS = {'title': 1, 'description': 1, 'file.version': 1}
+
+
+class ControlCache:
+    """In-memory cache of the company controls of one collection, shared by the requests of a worker.
+    Only the summaries (title, description, file version) are loaded, on first use. Complete documents are
+    loaded when a control is opened. Workers stay coherent through a MongoDB change stream, or where change
+    streams are not available (standalone servers) by polling a version stamp, which every write bumps"""
+    def __init__(self, db, collection_name, mode="auto", poll_interval=2):
+        self.db = db
+        self.collection_name = collection_name
+        self.collection = db[collection_name]
+        # "auto", "change_stream" or "polling"
+        self.requested_mode = mode
+        self.mode = None
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.resume_token = None
+
+        # doc id -> summary, None until the first request
+        self.summary_cache = None
+        # doc id -> complete document
+        self.documents = {}
+        # bumped by every change, loads which started before a change are not stored
+        self.generation = 0
+        self.stamp = None
+        self.counters = {'hits': 0, 'misses': 0, 'summary_loads': 0, 'changes': 0, 'errors': 0}
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name=f"control-cache-{self.collection_name}", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def _read_stamp(self):
+        stamp = self.db.control_stamps.find_one({'_id': self.collection_name})
+        return stamp['version'] if stamp else 0
+
+    def _load_summaries(self):
+        while True:
+            generation = self.generation
+            stamp = self._read_stamp()
+            summaries = {str(document.pop('_id')): document
+                         for document in self.collection.find({}, SUMMARY_FIELDS).sort('_id', 1)}
+            with self.lock:
+                if generation != self.generation:
+                    # changed while loading
+                    continue
+                self.summary_cache = summaries
+                self.stamp = stamp
+                self.counters['summary_loads'] += 1
+                return summaries
+
+    def _count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def summaries(self):
+        """doc id -> {'title', 'description', 'file': {'version'}} of all controls, in the order of creation"""
+        summaries = self.summary_cache
+        if summaries is None:
+            summaries = self._load_summaries()
+        return summaries
+
+    def __contains__(self, doc_id):
+        return doc_id in self.summaries()
+
+    def get(self, doc_id):
+        """Complete document of a control, None if there is none with this id"""
+        if doc_id not in self.summaries():
+            return None
+        document = self.documents.get(doc_id)
+        if document is not None:
+            self._count('hits')
+            return document
+        self._count('misses')
+        generation = self.generation
+        document = self.collection.find_one({'_id': ObjectId(doc_id)})
+        if document is None:
+            return None
+        document.pop('_id')
+        with self.lock:
+            if generation == self.generation:
+                self.documents[doc_id] = document
+        return document
+
+    def _reload(self, doc_id):
+        """Drops the cached document and reloads the summary of one control"""
+        with self.lock:
+            self.generation += 1
+            generation = self.generation
+            self.documents.pop(doc_id, None)
+            self.counters['changes'] += 1
+        summary = self.collection.find_one({'_id': ObjectId(doc_id)}, SUMMARY_FIELDS)
+        with self.lock:
+            if self.summary_cache is None:
+                return
+            if generation != self.generation:
+                # another change came in meanwhile, everything is loaded again on the next request
+                self.documents = {}
+                self.summary_cache = None
+                return
+            # copied, so templates iterating the previous summaries are not affected
+            summaries = dict(self.summary_cache)
+            if summary is None:
+                summaries.pop(doc_id, None)
+            else:
+                summary.pop('_id')
+                summaries[doc_id] = summary
+            self.summary_cache = summaries
+
+    def _reset(self):
+        with self.lock:
+            self.generation += 1
+            self.documents = {}
+            self.summary_cache = None
+            self.counters['changes'] += 1
+
+    def changed(self, doc_id):
+        """Called after every write of a control, updates this worker and notifies the other ones"""
+        self._reload(doc_id)
+        stamp = self.db.control_stamps.find_one_and_update({'_id': self.collection_name}, {'$inc': {'version': 1}},
+                                                           upsert=True, return_document=ReturnDocument.AFTER)
+        with self.lock:
+            if self.stamp is not None and stamp['version'] == self.stamp + 1:
+                # only this write happened since the last check
+                self.stamp = stamp['version']
+
+    def _watch(self):
+        with self.collection.watch(resume_after=self.resume_token, max_await_time_ms=1000) as stream:
+            # changes made while no stream was open are unknown
+            self._reset()
+            self.mode = "change_stream"
+            while not self.stopped.is_set():
+                change = stream.try_next()
+                if change is None:
+                    continue
+                self.resume_token = stream.resume_token
+                if change['operationType'] in ('insert', 'update', 'replace', 'delete'):
+                    self._reload(str(change['documentKey']['_id']))
+                else:
+                    # drop, rename or invalidate of the collection
+                    self._reset()
+                    self.resume_token = None
+                    return
+
+    def _poll(self):
+        self.mode = "polling"
+        while not self.stopped.wait(self.poll_interval):
+            if self.summary_cache is None:
+                continue
+            if self._read_stamp() != self.stamp:
+                self._reset()
+
+    def _run(self):
+        while not self.stopped.is_set():
+            try:
+                if self.requested_mode == "polling" or self.mode == "polling":
+                    self._poll()
+                else:
+                    self._watch()
+            except OperationFailure as e:
+                if self.mode is None and self.requested_mode == "auto":
+                    logger.info("Change streams are not available, polling every %ss: %s", self.poll_interval, e)
+                    self.mode = "polling"
+                    continue
+                logger.warning("Change stream of %s failed, reconnecting: %s", self.collection_name, e)
+                self._count('errors')
+                self.resume_token = None
+                self._reset()
+                self.stopped.wait(self.poll_interval)
+            except PyMongoError as e:
+                logger.warning("Control cache of %s lost the connection: %s", self.collection_name, e)
+                self._count('errors')
+                self._reset()
+                self.stopped.wait(self.poll_interval)
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters,
+                        mode=self.mode,
+                        running=self.thread is not None and self.thread.is_alive(),
+                        summaries=len(self.summary_cache) if self.summary_cache is not None else None,
+                        documents=len(self.documents))
@@ -1,8 +1,87 @@
+import hashlib
+import logging
+import threading
 from datetime import datetime
 
 import gridfs
+from bson import ObjectId
+from gridfs.errors import FileExists
+from pymongo.errors import OperationFailure
 from werkzeug.utils import secure_filename
 
+logger = logging.getLogger(__name__)
+
+HASH_BLOCK_SIZE = 256 * 1024
+
+# databases whose indexes were ensured by this process
+indexed = set()
+index_lock = threading.Lock()
+
+
+def ensure_indexes(db):
+    """One GridFS file per content hash, concurrent uploads of the same content end up in the same file.
+    Runs once per process on the first upload, so starting the app needs no index build"""
+    if db.name in indexed:
+        return
+    with index_lock:
+        if db.name in indexed:
+            return
+        try:
+            db.fs.files.create_index('metadata.sha256', unique=True,
+                                     partialFilterExpression={'metadata.sha256': {'$exists': True}})
+        except OperationFailure as e:
+            # e.g. files stored twice before the index existed, uploads are still deduplicated by lookup
+            logger.warning("Unique content hash index of GridFS could not be created: %s", e)
+        indexed.add(db.name)
+
+
+def content_hash(stream):
+    """SHA-256 of an uploaded file, read in blocks from the spooled upload, which is rewound afterwards"""
+    digest = hashlib.sha256()
+    for block in iter(lambda: stream.read(HASH_BLOCK_SIZE), b''):
+        digest.update(block)
+    stream.seek(0)
+    return digest.hexdigest()
+
+
+def store_file(db, file, filename):
+    """GridFS id of the uploaded file. Content which is stored already gets one more reference
+    instead of being uploaded again"""
+    ensure_indexes(db)
+    fs = gridfs.GridFS(db)
+    sha256 = content_hash(file.stream)
+    while True:
+        existing = db.fs.files.find_one_and_update({'metadata.sha256': sha256},
+                                                   {'$inc': {'metadata.references': 1}}, {'_id': 1})
+        if existing is not None:
+            return existing['_id']
+        file_id = ObjectId()
+        try:
+            return fs.put(file.stream, _id=file_id, filename=filename, content_type=file.content_type,
+                          metadata={'sha256': sha256, 'references': 1})
+        except FileExists:
+            # GridFS reports the duplicate content hash of the files insert as FileExists.
+            # The same content was stored meanwhile, its chunks are kept and ours dropped
+            db.fs.chunks.delete_many({'files_id': file_id})
+            file.stream.seek(0)
+
+
+def release_file(db, file_id):
+    """Drops one reference to a GridFS file, the file is deleted with its last reference.
+    Files stored before the reference counting have a single reference"""
+    file_id = ObjectId(file_id)
+    db.fs.files.update_one({'_id': file_id}, {'$inc': {'metadata.references': -1}})
+    # a concurrent store_file of the same content may have taken a new reference meanwhile
+    if db.fs.files.delete_one({'_id': file_id, 'metadata.references': {'$lte': 0}}).deleted_count:
+        db.fs.chunks.delete_many({'files_id': file_id})
+
+
+def release_control_files(db, file_data):
+    """Drops the references of a company control to its current and previous files"""
+    release_file(db, file_data['file'])
+    for old_file in file_data.get('old_files', []):
+        release_file(db, old_file['file'] if isinstance(old_file, dict) else old_file)
+
 
 class Docs:
     """Class for creating saving and storing documents"""
@@ -13,8 +92,7 @@ class Docs:
         self.db = db
         self.fs = gridfs.GridFS(self.db)
         self.filename = secure_filename(self.current_version.filename)
-        self.file_id = self.fs.put(self.current_version, filename=self.filename,
-                              content_type=self.current_version.content_type)
+        self.file_id = store_file(self.db, self.current_version, self.filename)
 
     def add_file(self, file_name, file):
         self.files.append({'filename': file_name, 'file': file})
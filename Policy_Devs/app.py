@@ -1,67 +1,174 @@
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import click
 import gridfs
-from flask import Flask, request, abort
+from flask import Flask, request, abort, Response, g
 from flask.cli import load_dotenv
 from langchain.chains.retrieval_qa.base import RetrievalQA
 from langchain_core.callbacks import StreamingStdOutCallbackHandler
 from langchain_core.prompts import PromptTemplate
-from langchain_text_splitters import RecursiveCharacterTextSplitter
 from pymongo.mongo_client import MongoClient
 from langchain_community.llms import Ollama
 from langchain.callbacks.manager import CallbackManager
 from langchain_community.vectorstores import MongoDBAtlasVectorSearch
+from langchain_community.embeddings import OllamaEmbeddings
 from langchain_openai import OpenAIEmbeddings
-from langchain_community.document_loaders import PyPDFLoader
 import os
 
+from embedding_cache import CachedEmbeddings
+from hybrid_retrieval import HybridRetriever, LexicalIndex
+from indexer import BackgroundIndexer
+from ingest import AtlasVectorFiles, IngestLedger
+from pdf_pipeline import PdfPipeline
+from scheduler import ScheduledEmbeddings, Scheduler, SchedulerBusy
+from semantic_cache import SemanticCache
+from vector_index import LocalVectorStore
+
+#instrumentation.py is shared by the services in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import instrumentation
+
 app = Flask(__name__)
 
 load_dotenv()
 uri = os.getenv("MongoDB_URI")
-client = MongoClient(uri)
+#MongoDB and GridFS commands, embedding, retrieval and generation are recorded as stages,
+#requests slower than this are logged with their stages
+SLOW_REQUEST_SECONDS = float(os.getenv("SLOW_REQUEST_SECONDS", 2))
+instrumentation.Instrumentation(app, "llm_recommender", SLOW_REQUEST_SECONDS)
+client = MongoClient(uri, event_listeners=[instrumentation.mongo_listener()])
 db = client.company_controls
 OPENAI_API_KEY = os.getenv("AUTH0_CLIENT_ID")
 callback_manager = CallbackManager([StreamingStdOutCallbackHandler()])
 llm = Ollama(model="llama2", callback_manager=callback_manager)
 fs = gridfs.GridFS(db)
 
-collection_policy = db["policy"]
-collection_guideline = db["guideline"]
-
-guideline_data = collection_guideline.find()
-policy_data = collection_policy.find()
-
-files = []
-for policy in policy_data:
-    files.append(fs.get(policy["file"]["file"]))
-
-for guideline in guideline_data:
-    files.append(fs.get(guideline["file"]["file"]))
-
-text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=150)
-page_loader = None
-for file in files:
-    #need to create local file cause PyPDF Loader cant handle BytesIO
-    filename = file.filename
-    with open(f"./static/{filename}.pdf", "wb") as f:
-        f.write(file.read())
-        loader = PyPDFLoader(f"./static/{filename}.pdf")
-        pages = loader.load()
-        pages = text_splitter.split_documents(pages)
-        if page_loader is None:
-            page_loader = pages
-        else:
-            page_loader += pages
+#Pages are extracted and split in a process pool and embedded in batches
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", os.cpu_count() or 1))
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", 256))
+pdf_pipeline = PdfPipeline(chunk_size=1000, chunk_overlap=150, workers=INGEST_WORKERS,
+                           batch_size=INGEST_BATCH_SIZE)
 
 new_collection = db["Chat_Search"]
 
-vectorstore = MongoDBAtlasVectorSearch.from_documents(documents=page_loader,
-                                                      embedding=OpenAIEmbeddings(disallowed_special=()),
-                                                      #OpenAI 1536 indices, OllamaEmbeddings(),(4096)
-                                                      collection=new_collection, index_name="vector_index")
+#LLM generations, searches and embedding calls run through separate schedulers per worker process,
+#so a burst of chat traffic does not starve /query and the ingest does not starve question embeddings
+CHAT_CONCURRENCY = int(os.getenv("CHAT_CONCURRENCY", 1))
+CHAT_QUEUE_SIZE = int(os.getenv("CHAT_QUEUE_SIZE", 8))
+QUERY_CONCURRENCY = int(os.getenv("QUERY_CONCURRENCY", 4))
+QUERY_QUEUE_SIZE = int(os.getenv("QUERY_QUEUE_SIZE", 32))
+EMBEDDING_CONCURRENCY = int(os.getenv("EMBEDDING_CONCURRENCY", 2))
+EMBEDDING_QUEUE_SIZE = int(os.getenv("EMBEDDING_QUEUE_SIZE", 32))
+SCHEDULER_QUEUE_TIMEOUT = float(os.getenv("SCHEDULER_QUEUE_TIMEOUT", 30))
+chat_scheduler = Scheduler("chat", concurrency=CHAT_CONCURRENCY, queue_size=CHAT_QUEUE_SIZE,
+                           queue_timeout=SCHEDULER_QUEUE_TIMEOUT)
+query_scheduler = Scheduler("query", concurrency=QUERY_CONCURRENCY, queue_size=QUERY_QUEUE_SIZE,
+                            queue_timeout=SCHEDULER_QUEUE_TIMEOUT)
+embedding_scheduler = Scheduler("embedding", concurrency=EMBEDDING_CONCURRENCY, queue_size=EMBEDDING_QUEUE_SIZE,
+                                queue_timeout=SCHEDULER_QUEUE_TIMEOUT)
+
+#Embedding backend: "openai" (1536 dimensions) or "ollama" (4096 dimensions with llama2)
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "openai")
+OLLAMA_EMBEDDING_MODEL = os.getenv("OLLAMA_EMBEDDING_MODEL", "llama2")
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "./cache/embeddings.sqlite3")
+EMBEDDING_CACHE_MAX_MB = int(os.getenv("EMBEDDING_CACHE_MAX_MB", 512))
+
+if EMBEDDING_BACKEND == "ollama":
+    embedding_backend = OllamaEmbeddings(model=OLLAMA_EMBEDDING_MODEL)
+else:
+    embedding_backend = OpenAIEmbeddings(disallowed_special=())
+
+#Unchanged chunks and repeated questions are not embedded again
+embeddings = CachedEmbeddings(ScheduledEmbeddings(embedding_backend, embedding_scheduler), EMBEDDING_CACHE_PATH,
+                              max_bytes=EMBEDDING_CACHE_MAX_MB * 1024 * 1024,
+                              timer=lambda: instrumentation.stage("embedding"))
+
+#Vector store backend: "atlas" (MongoDB Atlas Vector Search) or "local" (NumPy index on disk)
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "atlas")
+LOCAL_INDEX_PATH = os.getenv("LOCAL_INDEX_PATH", "./cache/vector_index")
+LOCAL_INDEX_DTYPE = os.getenv("LOCAL_INDEX_DTYPE", "float32")
+LOCAL_INDEX_KIND = os.getenv("LOCAL_INDEX_KIND", "auto")
+LOCAL_INDEX_IVF_THRESHOLD = int(os.getenv("LOCAL_INDEX_IVF_THRESHOLD", 50000))
+LOCAL_INDEX_NPROBE = int(os.getenv("LOCAL_INDEX_NPROBE", 8))
+#Share of deleted vectors from which the files are rewritten without them after a sync
+LOCAL_INDEX_COMPACT_RATIO = float(os.getenv("LOCAL_INDEX_COMPACT_RATIO", 0.25))
+
+#One vector store serves /query and /chat
+if VECTOR_BACKEND == "local":
+    vectorstore = LocalVectorStore(embeddings, path=LOCAL_INDEX_PATH, dtype=LOCAL_INDEX_DTYPE, kind=LOCAL_INDEX_KIND,
+                                   ivf_threshold=LOCAL_INDEX_IVF_THRESHOLD, nprobe=LOCAL_INDEX_NPROBE,
+                                   compact_ratio=LOCAL_INDEX_COMPACT_RATIO)
+    vector_files = vectorstore
+else:
+    vectorstore = MongoDBAtlasVectorSearch(collection=new_collection,
+                                           embedding=embeddings,
+                                           index_name="vector_index")
+    vector_files = AtlasVectorFiles(new_collection, index_name="vector_index")
+
+#Only new or changed GridFS files are embedded, vectors of removed files are deleted.
+#One worker syncs at a time, its lease is extended after every file and batch and expires this long after the last one
+INGEST_LEASE_SECONDS = int(os.getenv("INGEST_LEASE_SECONDS", 600))
+ingest_ledger = IngestLedger(db, fs, vectorstore, vector_files, pdf_pipeline, lease_seconds=INGEST_LEASE_SECONDS)
+ingest_ledger.sync()
+
+
+#Answers of similar earlier questions are reused until one of their source files changes
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", 0.95))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", 1000))
+answer_cache = SemanticCache(embeddings, ingest_ledger.file_versions, threshold=ANSWER_CACHE_THRESHOLD,
+                             max_entries=ANSWER_CACHE_MAX_ENTRIES)
+
+
+def answer_cache_counters(*names):
+    """Counters of the answer cache per question kind, for /metrics"""
+    return {(kind, name): counter[name] for kind, counter in answer_cache.stats().items() if isinstance(counter, dict)
+            for name in names}
+
+
+#Hits, misses, invalidations and evictions of the embedding and the answer cache next to the request metrics
+instrumentation.register(instrumentation.Counter(
+    "embedding_cache_events_total", "Lookups and evictions of the embedding cache", ("event",),
+    lambda: {(name,): getattr(embeddings, name) for name in ('hits', 'misses', 'evictions')}))
+instrumentation.register(instrumentation.Counter(
+    "answer_cache_events_total", "Lookups, invalidations and evictions of the answer cache", ("kind", "event"),
+    lambda: answer_cache_counters('hits', 'misses', 'invalidations', 'evictions')))
+instrumentation.register(instrumentation.Counter(
+    "answer_cache_entries", "Answers in the answer cache", ("kind",),
+    lambda: {(kind,): value for (kind, _), value in answer_cache_counters('entries').items()}, "gauge"))
+
+#BM25 index over the same chunks as the vector store, rebuilt on the next search after the store changed
+lexical_index = LexicalIndex(vector_files.chunks)
+
+
+def after_sync(stats):
+    answer_cache.prune()
+    lexical_index.invalidate()
+
+
+if VECTOR_BACKEND == "local":
+    #Changes which the worker holding the ingest lease wrote are loaded on the next search of the other workers
+    vectorstore.on_reload = lambda: after_sync(None)
+
+
+#Edits in PolicyManager are indexed in the background: "auto" (change streams, polling without a replica set),
+#"change_stream", "polling" or "off"
+INDEXER_MODE = os.getenv("INDEXER_MODE", "auto")
+INDEXER_POLL_INTERVAL = float(os.getenv("INDEXER_POLL_INTERVAL", 30))
+INDEXER_DEBOUNCE = float(os.getenv("INDEXER_DEBOUNCE", 2))
+indexer = BackgroundIndexer(db, ingest_ledger, mode=INDEXER_MODE, poll_interval=INDEXER_POLL_INTERVAL,
+                            debounce=INDEXER_DEBOUNCE, on_sync=after_sync)
+if INDEXER_MODE != "off":
+    indexer.start()
+
+
+@app.cli.command("ingest")
+def ingest():
+    """Embed new or changed company controls and remove vectors of deleted ones"""
+    click.echo(ingest_ledger.sync())
 
-vectorstore_chat = MongoDBAtlasVectorSearch.from_documents(documents=page_loader,
-                                                           embedding=OpenAIEmbeddings(disallowed_special=()),
-                                                           collection=new_collection, index_name="vector_index")
 
 prompt = """
     Use the following context to answer the question.
@@ -77,40 +184,247 @@ QA_CHAIN_PROMPT = PromptTemplate(
     template=prompt,
 )
 
+#Chat context: "hybrid" fuses BM25 and vector hits and packs the best non-overlapping spans into
+#CONTEXT_TOKEN_BUDGET tokens, "vector" feeds the four nearest chunks as before
+CHAT_RETRIEVER = os.getenv("CHAT_RETRIEVER", "hybrid")
+HYBRID_FETCH_K = int(os.getenv("HYBRID_FETCH_K", 20))
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 512))
+if CHAT_RETRIEVER == "hybrid":
+    chat_retriever = HybridRetriever(vectorstore=vectorstore, lexical=lexical_index, fetch_k=HYBRID_FETCH_K,
+                                     token_budget=CONTEXT_TOKEN_BUDGET)
+else:
+    chat_retriever = vectorstore.as_retriever()
+query_retriever = vectorstore.as_retriever(search_type="similarity", search_kwargs={"k": 1})
+
+#Batch retrieval: questions missing from the embedding cache are embedded concurrently, Atlas searches run
+#concurrently, the local index searches all at once
+MAX_BATCH_QUESTIONS = int(os.getenv("MAX_BATCH_QUESTIONS", 500))
+MAX_BATCH_K = int(os.getenv("MAX_BATCH_K", 20))
+BATCH_SEARCH_WORKERS = int(os.getenv("BATCH_SEARCH_WORKERS", 8))
+search_executor = ThreadPoolExecutor(max_workers=BATCH_SEARCH_WORKERS)
+
 qa_chain = RetrievalQA.from_chain_type(
     llm,
-    retriever=vectorstore_chat.as_retriever(),
+    retriever=chat_retriever,
     chain_type_kwargs={"prompt": QA_CHAIN_PROMPT},
 )
 
 
+def document_sources(documents):
+    return [{'source': document.metadata.get("source"), 'page': document.metadata.get("page")}
+            for document in documents]
+
+
 @app.before_request
 def limit_remote_addr():
     if request.remote_addr != '127.0.0.1':
         abort(403)  # Forbidden
 
 
+@app.after_request
+def server_timing(response):
+    """Queue wait and run time of the scheduled calls of the request"""
+    entries = []
+    for name, timings in g.get('timings', []):
+        if 'queue_wait' in timings:
+            entries.append(f"{name}-queue;dur={timings['queue_wait'] * 1000:.1f}")
+        if 'run' in timings:
+            entries.append(f"{name};dur={timings['run'] * 1000:.1f}")
+    if entries:
+        response.headers['Server-Timing'] = ", ".join(entries)
+    return response
+
+
+@app.errorhandler(SchedulerBusy)
+def scheduler_busy(e):
+    return {"error": str(e)}, 429, {'Retry-After': str(e.retry_after)}
+
+
+def scheduled(scheduler, key, function):
+    """Runs function through the scheduler, identical keys in flight share one call"""
+    timings = {}
+    g.setdefault('timings', []).append((scheduler.name, timings))
+    return scheduler.run(key, function, timings)
+
+
+def lookup_answer(kind, question):
+    return scheduled(query_scheduler, ("lookup", kind, question), lambda: answer_cache.lookup(kind, question))
+
+
 @app.route('/query')
 def process_query():
     question = str(request.args.get('question'))
-    retriever = vectorstore.as_retriever(search_type="similarity", search_kwargs={"k": 1})
-    results = retriever.invoke(question)
-    try:
-        result = results[0].page_content
-        source = results[0].metadata["source"]
-        page = results[0].metadata["page"]
-        result += "\nDocument: " + source + " on page " + str(page)
-    except IndexError:
-        return "error while retrieving information from vector search", 404
 
+    def search():
+        cached, vector = answer_cache.lookup("query", question)
+        if cached is not None:
+            return cached
+        start = time.perf_counter()
+        with instrumentation.stage("retrieval"):
+            results = query_retriever.invoke(question)
+        try:
+            result = results[0].page_content
+            source = results[0].metadata["source"]
+            page = results[0].metadata["page"]
+            result += "\nDocument: " + source + " on page " + str(page)
+        except IndexError:
+            return None
+        answer_cache.put("query", question, vector, result, [results[0].metadata.get("file_id")],
+                         time.perf_counter() - start)
+        return result
+
+    result = scheduled(query_scheduler, ("query", question), search)
+    if result is None:
+        return "error while retrieving information from vector search", 404
     return {"query": question, "result": result}
 
 
+def search_by_vectors(vectors, k):
+    """(Document, score) lists for every query vector"""
+    if isinstance(vectorstore, LocalVectorStore):
+        return vectorstore.similarity_search_by_vectors(vectors, k)
+    return list(search_executor.map(lambda vector: vector_files.similarity_search_with_score_by_vector(vector, k),
+                                    vectors))
+
+
+@app.route('/query/batch', methods=['POST'])
+def process_query_batch():
+    """Top k chunks for every question of {"questions": [...], "k": 1}"""
+    body = request.get_json(silent=True) or {}
+    questions = body.get('questions')
+    k = body.get('k', 1)
+    if not isinstance(questions, list) or not all(isinstance(question, str) for question in questions):
+        return "questions must be a list of strings", 400
+    if len(questions) > MAX_BATCH_QUESTIONS:
+        return f"at most {MAX_BATCH_QUESTIONS} questions per batch", 400
+    if isinstance(k, bool) or not isinstance(k, int) or not 1 <= k <= MAX_BATCH_K:
+        return f"k must be between 1 and {MAX_BATCH_K}", 400
+
+    def search():
+        unique = list(dict.fromkeys(questions))
+        vectors = embeddings.embed_queries(unique) if unique else []
+        with instrumentation.stage("retrieval"):
+            return dict(zip(unique, search_by_vectors(vectors, k)))
+
+    found = scheduled(query_scheduler, ("batch", tuple(questions), k), search)
+    return {"k": k, "results": [{
+        "query": question,
+        "results": [{
+            "result": document.page_content,
+            "source": document.metadata.get("source"),
+            "page": document.metadata.get("page"),
+            "score": float(score)
+        } for document, score in found[question]]
+    } for question in questions]}
+
+
+@app.route('/ingest', methods=['POST'])
+def process_ingest():
+    """Embed new or changed company controls on demand"""
+    stats = ingest_ledger.sync()
+    stats['invalidated_answers'] = answer_cache.prune()
+    lexical_index.invalidate()
+    return stats
+
+
+@app.route('/index_stats')
+def index_stats():
+    """State of the background indexer, lag_seconds is the age of the oldest change not yet searchable"""
+    return indexer.stats()
+
+
+@app.route('/scheduler_stats')
+def scheduler_stats():
+    """Queue state, shared in-flight calls and queue wait / run time percentiles in seconds"""
+    return {'chat': chat_scheduler.stats(), 'query': query_scheduler.stats(), 'embedding': embedding_scheduler.stats()}
+
+
+@app.route('/cache_stats')
+def cache_stats():
+    """Hit and miss counters of the embedding and the answer cache"""
+    return {'embeddings': embeddings.stats(), 'answers': answer_cache.stats()}
+
+
 @app.route('/chat')
 def process_chat():
     question = str(request.args.get('question'))
-    result = qa_chain({"query": question})
-    return result
+    cached, vector = lookup_answer("chat", question)
+    if cached is not None:
+        return {"query": question, "result": cached['result']}
+
+    def generate():
+        start = time.perf_counter()
+        # the steps of qa_chain, run one by one so retrieval and generation are timed separately
+        with instrumentation.stage("retrieval"):
+            documents = qa_chain.retriever.invoke(question)
+        with instrumentation.stage("llm_generation"):
+            result = qa_chain.combine_documents_chain.invoke({"input_documents": documents, "question": question})
+        answer = {'result': result["output_text"], 'sources': document_sources(documents)}
+        answer_cache.put("chat", question, vector, answer,
+                         [document.metadata.get("file_id") for document in documents], time.perf_counter() - start)
+        return answer
+
+    answer = scheduled(chat_scheduler, ("chat", question), generate)
+    return {"query": question, "result": answer['result']}
+
+
+def server_sent_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.route('/chat/stream')
+def process_chat_stream():
+    """Streams the answer as Server-Sent Events: the retrieved sources first, then the tokens
+    while Ollama generates them. Generation stops when the client disconnects"""
+    question = str(request.args.get('question'))
+    cached, vector = lookup_answer("chat", question)
+    if cached is not None:
+        def replay():
+            yield server_sent_event("sources", {'query': question, 'sources': cached['sources']})
+            yield server_sent_event("token", {'token': cached['result']})
+            yield server_sent_event("done", {'cached': True})
+
+        return Response(replay(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+    # the slot is held until the stream is closed, a full queue is answered with 429 before streaming starts
+    timings = {}
+    g.setdefault('timings', []).append((chat_scheduler.name, timings))
+    chat_scheduler.acquire(timings)
+    try:
+        start = time.perf_counter()
+        with instrumentation.stage("retrieval"):
+            documents = chat_retriever.invoke(question)
+    except Exception:
+        chat_scheduler.release(timings)
+        raise
+    # same prompt the "stuff" chain of qa_chain builds
+    context = "\n\n".join(document.page_content for document in documents)
+    chat_prompt = QA_CHAIN_PROMPT.format(context=context, question=question)
+    sources = document_sources(documents)
+
+    def generate():
+        yield server_sent_event("sources", {'query': question, 'sources': sources})
+        tokens = llm.stream(chat_prompt)
+        answer = []
+        generation_start = time.perf_counter()
+        try:
+            for token in tokens:
+                answer.append(token)
+                yield server_sent_event("token", {'token': token})
+            yield server_sent_event("done", {})
+        finally:
+            # runs on GeneratorExit as well, when the client went away
+            tokens.close()
+            # the response headers are sent already, the generation only goes to the histogram
+            instrumentation.record_stage("llm_generation", time.perf_counter() - generation_start)
+        # only complete answers are cached
+        answer_cache.put("chat", question, vector, {'result': "".join(answer), 'sources': sources},
+                         [document.metadata.get("file_id") for document in documents], time.perf_counter() - start)
+
+    response = Response(generate(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(lambda: chat_scheduler.release(timings))
+    return response
 
 
 if __name__ == '__main__':
@@ -0,0 +1,162 @@
+"""Prompt size, latency and source agreement of the hybrid chat context against the vector-only context
+
+Run from the Policy_Devs folder:
+    python benchmarks/hybrid_retrieval.py
+    python benchmarks/hybrid_retrieval.py --embedding openai --llm llama2
+The policy PDFs of the PolicyManager folder are split like at ingest. Without --embedding a hashing
+embedding is used, which runs offline but ranks worse than a real model. With --llm both contexts
+are answered by Ollama and the generation time and word overlap of the answers are reported as well.
+"""
+import argparse
+import glob
+import hashlib
+import os
+import re
+import statistics
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain_core.embeddings import Embeddings  # noqa: E402
+
+from hybrid_retrieval import HybridRetriever, LexicalIndex, estimate_tokens, tokenize  # noqa: E402
+from pdf_pipeline import split_pdf  # noqa: E402
+from vector_index import LocalVectorStore  # noqa: E402
+
+# the prompt of the chat chain in app.py
+PROMPT = """
+    Use the following context to answer the question.
+    Only use the knowledge provided by the documents.
+    Do not answer any questions out of the provided knowledge.
+    If you don't know the answer, just say that you don't know, don't try to make up an answer.
+    {context}
+    Question: {question}
+    Helpful Answer:"""
+
+QUESTIONS = [
+    "What is personal data?",
+    "When is consent required for processing personal data?",
+    "How long may personal data be stored?",
+    "What are the rights of the data subject regarding erasure?",
+    "What must be done after a personal data breach?",
+    "When is a data protection impact assessment necessary?",
+    "How should developers handle third-party libraries and tools?",
+    "What are the phases of the information security policy development life cycle?",
+    "Who is responsible for approving the security policy?",
+    "Which threats does the EU cybersecurity framework address?",
+    "How should cookies and trackers be handled?",
+    "What is privacy by design?",
+]
+
+
+class HashingEmbeddings(Embeddings):
+    """Signed feature hashing of the word tokens, a deterministic offline stand-in for a real model"""
+    def __init__(self, dimension=512):
+        self.dimension = dimension
+
+    def _embed(self, text):
+        vector = np.zeros(self.dimension, dtype=np.float32)
+        for token in tokenize(text):
+            digest = int(hashlib.md5(token.encode()).hexdigest(), 16)
+            vector[digest % self.dimension] += 1 if digest & 1 << 64 else -1
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._embed(text)
+
+
+def load_embeddings(name):
+    if name == "openai":
+        from langchain_openai import OpenAIEmbeddings
+        return OpenAIEmbeddings(disallowed_special=())
+    if name == "ollama":
+        from langchain_community.embeddings import OllamaEmbeddings
+        return OllamaEmbeddings(model="llama2")
+    return HashingEmbeddings()
+
+
+def words(text):
+    return set(re.findall(r"\w+", text.lower()))
+
+
+def pages(documents):
+    return {(document.metadata['source'], document.metadata['page']) for document in documents}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pdfs", default=os.path.join("..", "PolicyManager", "*.pdf"))
+    parser.add_argument("--embedding", choices=("hashing", "openai", "ollama"), default="hashing")
+    parser.add_argument("--token-budget", type=int, default=512)
+    parser.add_argument("--fetch-k", type=int, default=20)
+    parser.add_argument("--llm", help="Ollama model which answers both contexts, e.g. llama2")
+    args = parser.parse_args()
+
+    documents = []
+    for number, path in enumerate(sorted(glob.glob(args.pdfs))):
+        with open(path, "rb") as f:
+            documents += split_pdf(str(number), os.path.basename(path), f.read(), 1000, 150)[1]
+    store = LocalVectorStore(load_embeddings(args.embedding), kind="exact")
+    store.add_documents(documents)
+    baseline = store.as_retriever()
+    hybrid = HybridRetriever(vectorstore=store, lexical=LexicalIndex(store.chunks), fetch_k=args.fetch_k,
+                             token_budget=args.token_budget)
+    hybrid.invoke("warm up")
+    llm = None
+    if args.llm:
+        from langchain_community.llms import Ollama
+        llm = Ollama(model=args.llm)
+
+    print(f"{len(documents)} chunks, {len(QUESTIONS)} questions, {args.embedding} embedding, "
+          f"budget {args.token_budget} tokens")
+    results = {'vector': [], 'hybrid': []}
+    for question in QUESTIONS:
+        for name, retriever in (('vector', baseline), ('hybrid', hybrid)):
+            start = time.perf_counter()
+            context = retriever.invoke(question)
+            retrieval = time.perf_counter() - start
+            prompt = PROMPT.format(context="\n\n".join(document.page_content for document in context),
+                                   question=question)
+            result = {'context': context, 'tokens': estimate_tokens(prompt), 'retrieval': retrieval}
+            if llm is not None:
+                start = time.perf_counter()
+                result['answer'] = llm.invoke(prompt)
+                result['generation'] = time.perf_counter() - start
+            results[name].append(result)
+
+    top_agreement = []
+    page_overlap = []
+    answer_overlap = []
+    for vector, hybrid_result in zip(results['vector'], results['hybrid']):
+        vector_pages = pages(vector['context'])
+        hybrid_pages = pages(hybrid_result['context'])
+        top_agreement.append(bool(vector['context']) and pages(vector['context'][:1]) <= hybrid_pages)
+        page_overlap.append(len(vector_pages & hybrid_pages) / len(vector_pages | hybrid_pages)
+                            if vector_pages | hybrid_pages else 1.0)
+        if llm is not None:
+            vector_words, hybrid_words = words(vector['answer']), words(hybrid_result['answer'])
+            answer_overlap.append(len(vector_words & hybrid_words) / len(vector_words | hybrid_words)
+                                  if vector_words | hybrid_words else 1.0)
+
+    print(f"{'context':<10}{'prompt tokens':>15}{'retrieval ms':>14}" + (f"{'generation s':>14}" if llm else ""))
+    for name, rows in results.items():
+        line = f"{name:<10}{statistics.mean(row['tokens'] for row in rows):>15.0f}" \
+               f"{statistics.mean(row['retrieval'] for row in rows) * 1000:>14.2f}"
+        if llm is not None:
+            line += f"{statistics.mean(row['generation'] for row in rows):>14.2f}"
+        print(line)
+    print(f"top vector source in hybrid context: {sum(top_agreement)}/{len(top_agreement)}")
+    print(f"source page overlap (Jaccard): {statistics.mean(page_overlap):.2f}")
+    if answer_overlap:
+        print(f"answer word overlap (Jaccard): {statistics.mean(answer_overlap):.2f}")
+
+
+if __name__ == "__main__":
+    main()
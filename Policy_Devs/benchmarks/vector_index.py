@@ -0,0 +1,81 @@
+"""Recall and latency of the local vector index configurations against exact float32 search
+
+Run from the Policy_Devs folder:
+    python benchmarks/vector_index.py --vectors 100000 --dimension 384
+The vectors are synthetic clusters, similar to chunk embeddings of a document corpus.
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vector_index import VectorIndex, normalize  # noqa: E402
+
+
+def clustered(rng, count, dimension, clusters):
+    centers = normalize(rng.normal(size=(clusters, dimension)))
+    labels = rng.integers(0, clusters, size=count)
+    return normalize(centers[labels] + rng.normal(scale=0.6 / np.sqrt(dimension) * 4, size=(count, dimension)))
+
+
+def run(index, queries, k, batch_size):
+    start = time.perf_counter()
+    results = []
+    for offset in range(0, len(queries), batch_size):
+        results += index.search(queries[offset:offset + batch_size], k)
+    seconds = time.perf_counter() - start
+    return [positions for positions, _ in results], seconds * 1000 / len(queries)
+
+
+def recall(results, truth, k):
+    return np.mean([len(set(found[:k]) & set(expected[:k])) / k for found, expected in zip(results, truth)])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vectors", type=int, default=100000)
+    parser.add_argument("--dimension", type=int, default=384)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--nprobe", type=int, default=8)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(7)
+    data = clustered(rng, args.vectors, args.dimension, clusters=max(10, args.vectors // 500))
+    queries = data[rng.choice(len(data), args.queries, replace=False)] \
+        + rng.normal(scale=0.02, size=(args.queries, args.dimension))
+
+    baseline = VectorIndex(args.dimension, 'float32', 'exact')
+    baseline.add(data)
+    truth, exact_ms = run(baseline, queries, args.k, args.batch_size)
+    single_truth, single_ms = run(baseline, queries, args.k, 1)
+    print(f"{args.vectors} vectors x {args.dimension} dimensions, {args.queries} queries, recall@{args.k}")
+    print(f"{'configuration':<22}{'recall':>8}{'ms/query':>10}{'MB':>8}")
+    print(f"{'exact float32 (1/call)':<22}{1.0:>8.3f}{single_ms:>10.3f}{baseline.vectors.nbytes / 2 ** 20:>8.1f}")
+    print(f"{'exact float32':<22}{1.0:>8.3f}{exact_ms:>10.3f}{baseline.vectors.nbytes / 2 ** 20:>8.1f}")
+
+    for dtype in ('float16', 'int8'):
+        index = VectorIndex(args.dimension, dtype, 'exact')
+        index.add(data)
+        results, ms = run(index, queries, args.k, args.batch_size)
+        print(f"{'exact ' + dtype:<22}{recall(results, truth, args.k):>8.3f}{ms:>10.3f}"
+              f"{index.vectors.nbytes / 2 ** 20:>8.1f}")
+
+    for dtype in ('float32', 'int8'):
+        index = VectorIndex(args.dimension, dtype, 'ivf', nprobe=args.nprobe)
+        start = time.perf_counter()
+        index.add(data)
+        train_seconds = time.perf_counter() - start
+        results, ms = run(index, queries, args.k, args.batch_size)
+        name = f"ivf {dtype} nprobe={args.nprobe}"
+        print(f"{name:<22}{recall(results, truth, args.k):>8.3f}{ms:>10.3f}{index.vectors.nbytes / 2 ** 20:>8.1f}"
+              f"   (trained in {train_seconds:.1f}s, {len(index.centroids)} lists)")
+
+
+if __name__ == '__main__':
+    main()
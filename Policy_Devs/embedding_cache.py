@@ -0,0 +1,183 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from contextlib import nullcontext
+
+from langchain_core.embeddings import Embeddings
+
+# SQLite limits the number of parameters of a single statement
+LOOKUP_CHUNK = 500
+# access times of cache hits are written in batches, after this many hits or seconds
+TOUCH_BATCH = 256
+TOUCH_INTERVAL = 30
+
+
+class CachedEmbeddings(Embeddings):
+    """Persistent embedding cache in front of any langchain embedding backend.
+    Vectors are stored in SQLite keyed by (model, kind, SHA-256 of the text, dimension), kind being "query"
+    or "document" as backends may embed both differently. The least recently used vectors are evicted when
+    the cache grows beyond max_bytes.
+    timer returns a context manager which times the backend calls"""
+    def __init__(self, backend, path, max_bytes=512 * 1024 * 1024, timer=nullcontext):
+        self.backend = backend
+        self.timer = timer
+        self.model = str(getattr(backend, 'model', None) or type(backend).__name__)
+        # None if the backend does not configure it, vectors of a model then all have the model's dimension
+        self.dimension = getattr(backend, 'dimensions', None)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # (kind, text hash) -> last access time of hits which are not written yet
+        self.touched = {}
+        self.touched_at = time.monotonic()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(embeddings)")]
+        if columns and 'kind' not in columns:
+            # cache of an earlier version which did not tell queries and documents apart
+            self.connection.execute("DROP TABLE embeddings")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                text_hash TEXT NOT NULL,
+                dimension INTEGER NOT NULL,
+                vector BLOB NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (model, kind, text_hash, dimension)
+            )""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self.connection.commit()
+        # running size of the cache, counted once here and again when it reaches max_bytes.
+        # Other processes sharing the file are only seen by these recounts
+        self.total_bytes = self._count_bytes()
+
+    @staticmethod
+    def text_hash(text):
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def _count_bytes(self):
+        return self.connection.execute("SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings").fetchone()[0]
+
+    def _lookup(self, kind, hashes):
+        found = {}
+        dimension = "AND dimension = ?" if self.dimension else ""
+        for start in range(0, len(hashes), LOOKUP_CHUNK):
+            chunk = hashes[start:start + LOOKUP_CHUNK]
+            placeholders = ",".join("?" * len(chunk))
+            parameters = [self.model, kind, *chunk] + ([self.dimension] if self.dimension else [])
+            rows = self.connection.execute(
+                f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND kind = ? "
+                f"AND text_hash IN ({placeholders}) {dimension}", parameters)
+            for text_hash, vector in rows:
+                found[text_hash] = array('f', vector).tolist()
+        now = time.time()
+        for text_hash in found:
+            self.touched[kind, text_hash] = now
+        if len(self.touched) >= TOUCH_BATCH or time.monotonic() - self.touched_at >= TOUCH_INTERVAL:
+            self._flush_touched()
+        return found
+
+    def _flush_touched(self):
+        """Writes the access times of the hits since the last flush with one statement"""
+        if self.touched:
+            self.connection.executemany(
+                "UPDATE embeddings SET last_used = ? WHERE model = ? AND kind = ? AND text_hash = ?",
+                [(last_used, self.model, kind, text_hash) for (kind, text_hash), last_used in self.touched.items()])
+            self.connection.commit()
+            self.touched = {}
+        self.touched_at = time.monotonic()
+
+    def _store(self, kind, vectors):
+        now = time.time()
+        rows = [(self.model, kind, text_hash, len(vector), array('f', vector).tobytes(), now)
+                for text_hash, vector in vectors.items()]
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO embeddings (model, kind, text_hash, dimension, vector, last_used) "
+            "VALUES (?, ?, ?, ?, ?, ?)", rows)
+        self.connection.commit()
+        self.total_bytes += sum(len(row[4]) for row in rows)
+        if self.total_bytes > self.max_bytes:
+            self._evict()
+
+    def _evict(self):
+        # recent hits must not be evicted for their stale access times
+        self._flush_touched()
+        total_bytes, count = self.connection.execute(
+            "SELECT COALESCE(SUM(LENGTH(vector)), 0), COUNT(*) FROM embeddings").fetchone()
+        self.total_bytes = total_bytes
+        if total_bytes <= self.max_bytes or not count:
+            return
+        # drop the least recently used tenth below the cap, so eviction does not run on every insert
+        average = total_bytes / count
+        surplus = int((total_bytes - self.max_bytes * 0.9) / average) + 1
+        self.connection.execute(
+            "DELETE FROM embeddings WHERE rowid IN (SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?)",
+            (surplus,))
+        self.connection.commit()
+        self.total_bytes = self._count_bytes()
+        self.evictions += surplus
+
+    def _embed(self, kind, texts, backend_call):
+        hashes = [self.text_hash(text) for text in texts]
+        with self.lock:
+            found = self._lookup(kind, list(dict.fromkeys(hashes)))
+            missing = {}
+            for text_hash, text in zip(hashes, texts):
+                if text_hash in found:
+                    self.hits += 1
+                else:
+                    missing.setdefault(text_hash, text)
+            self.misses += len(missing)
+
+        if missing:
+            with self.timer():
+                vectors = backend_call(list(missing.values()))
+            embedded = dict(zip(missing.keys(), vectors))
+            found.update(embedded)
+            with self.lock:
+                self._store(kind, embedded)
+        return [found[text_hash] for text_hash in hashes]
+
+    def embed_documents(self, texts):
+        """Cached vectors for all texts, all cache misses are embedded with a single backend call"""
+        return self._embed("document", texts, self.backend.embed_documents)
+
+    def embed_query(self, text):
+        return self._embed("query", [text], lambda texts: [self.backend.embed_query(texts[0])])[0]
+
+    def embed_queries(self, texts):
+        """Query vectors of several questions, the misses are embedded as queries with one call of the backend's
+        embed_queries where it has one"""
+        embed_queries = getattr(self.backend, 'embed_queries', None)
+        if embed_queries is None:
+            def embed_queries(texts):
+                return [self.backend.embed_query(text) for text in texts]
+        return self._embed("query", texts, embed_queries)
+
+    def stats(self):
+        with self.lock:
+            self._flush_touched()
+            total_bytes, count = self.connection.execute(
+                "SELECT COALESCE(SUM(LENGTH(vector)), 0), COUNT(*) FROM embeddings").fetchone()
+            hits, misses, evictions = self.hits, self.misses, self.evictions
+        requests = hits + misses
+        return {
+            'model': self.model,
+            'entries': count,
+            'bytes': total_bytes,
+            'max_bytes': self.max_bytes,
+            'hits': hits,
+            'misses': misses,
+            'evictions': evictions,
+            'hit_rate': round(hits / requests, 4) if requests else None
+        }
@@ -0,0 +1,170 @@
+import math
+import re
+import threading
+from collections import Counter
+from typing import Any, List
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.vectorstores import VectorStore
+
+TOKEN_PATTERN = re.compile(r"\w+")
+STOPWORDS = frozenset("""
+a an and are as at be by for from has have in is it its of on or such that the their this to
+which with shall may where whether been not any other these those under into what how do does
+""".split())
+SENTENCE_END = re.compile(r"[.!?;:\n]\s")
+
+
+def tokenize(text):
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOPWORDS]
+
+
+def estimate_tokens(text):
+    """Rough llama2 token count, about four characters per token for English text"""
+    return math.ceil(len(text) / 4)
+
+
+def chunk_key(document):
+    metadata = document.metadata
+    return metadata.get('file_id') or metadata.get('source'), metadata.get('page'), document.page_content
+
+
+class LexicalIndex:
+    """BM25 index over the chunks of the vector store, rebuilt lazily after the store changed"""
+    def __init__(self, chunks, k1=1.5, b=0.75):
+        # callable returning the current chunks as Documents
+        self.chunks = chunks
+        self.k1 = k1
+        self.b = b
+        self.lock = threading.Lock()
+        # incremented by every invalidate(), the index is current while it was built at the latest generation
+        self.generation_lock = threading.Lock()
+        self.generation = 0
+        self.built_generation = None
+        self.documents = []
+        self.postings = {}
+        self.lengths = []
+        self.idf = {}
+        self.average_length = 0
+
+    def invalidate(self):
+        with self.generation_lock:
+            self.generation += 1
+
+    def _build(self):
+        # an invalidate() while the chunks are read leaves the index stale, it is built again on the next search
+        generation = self.generation
+        documents = []
+        postings = {}
+        lengths = []
+        for document in self.chunks():
+            tokens = tokenize(document.page_content)
+            doc = len(documents)
+            documents.append(document)
+            lengths.append(len(tokens))
+            for term, frequency in Counter(tokens).items():
+                postings.setdefault(term, []).append((doc, frequency))
+        self.idf = {term: math.log(1 + (len(documents) - len(docs) + 0.5) / (len(docs) + 0.5))
+                    for term, docs in postings.items()}
+        self.average_length = sum(lengths) / len(lengths) if lengths else 0
+        self.documents, self.postings, self.lengths = documents, postings, lengths
+        self.built_generation = generation
+
+    def search(self, query, k):
+        """(Document, score) pairs ordered by their BM25 score"""
+        with self.lock:
+            if self.built_generation != self.generation:
+                self._build()
+            documents, postings, lengths, idf = self.documents, self.postings, self.lengths, self.idf
+            average_length = self.average_length
+        scores = {}
+        for term in set(tokenize(query)):
+            if term not in idf:
+                continue
+            for doc, frequency in postings[term]:
+                norm = self.k1 * (1 - self.b + self.b * lengths[doc] / average_length)
+                scores[doc] = scores.get(doc, 0) + idf[term] * frequency * (self.k1 + 1) / (frequency + norm)
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [(documents[doc], score) for doc, score in ranked]
+
+    def __len__(self):
+        return len(self.documents)
+
+
+def reciprocal_rank_fusion(rankings, rrf_k=60):
+    """Documents of several rankings ordered by the sum of 1 / (rrf_k + rank)"""
+    scores = {}
+    documents = {}
+    for ranking in rankings:
+        for rank, document in enumerate(ranking, start=1):
+            key = chunk_key(document)
+            documents.setdefault(key, document)
+            scores[key] = scores.get(key, 0) + 1 / (rrf_k + rank)
+    return [(documents[key], scores[key]) for key in sorted(scores, key=scores.get, reverse=True)]
+
+
+def trim_to_sentence(text, limit):
+    """Text cut to at most limit characters, at the last sentence end if there is one"""
+    if len(text) <= limit:
+        return text
+    text = text[:limit]
+    ends = [match.start() + 1 for match in SENTENCE_END.finditer(text)]
+    return text[:ends[-1]] if ends and ends[-1] > limit // 2 else text
+
+
+def pack_context(ranked, token_budget, min_tokens=20):
+    """Best scoring spans up to the token budget. Chunks of the same page overlap by the splitter overlap,
+    the part of a chunk which is already in the context is left out"""
+    selected = []
+    covered = {}
+    used = 0
+    for document, score in ranked:
+        text = document.page_content
+        page = chunk_key(document)[:2]
+        start = document.metadata.get('start_index')
+        if start is not None:
+            # cut the overlap with spans of the same page which are already selected
+            for span_start, span_end in covered.get(page, ()):
+                end = start + len(text)
+                if span_start <= start < span_end:
+                    text = text[span_end - start:]
+                    start = span_end
+                elif start < span_start < end:
+                    text = text[:span_start - start]
+        elif any(text in span for span in covered.get(page, ())):
+            continue
+        text = text.strip()
+        remaining = token_budget - used
+        if estimate_tokens(text) < min_tokens and text != document.page_content.strip():
+            continue
+        if estimate_tokens(text) > remaining:
+            if remaining < min_tokens:
+                break
+            text = trim_to_sentence(text, remaining * 4)
+        if not text:
+            continue
+        if start is not None:
+            covered.setdefault(page, []).append((start, start + len(text)))
+        else:
+            covered.setdefault(page, []).append(document.page_content)
+        used += estimate_tokens(text)
+        selected.append(Document(page_content=text, metadata=dict(document.metadata, score=score)))
+    return selected
+
+
+class HybridRetriever(BaseRetriever):
+    """BM25 and vector search fused with reciprocal rank fusion, the context is packed into a token budget"""
+    vectorstore: VectorStore
+    lexical: Any
+    fetch_k: int = 20
+    rrf_k: int = 60
+    token_budget: int = 512
+
+    def _get_relevant_documents(self, query: str, *,
+                                run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        vector_hits = [document for document, _ in self.vectorstore.similarity_search_with_score(query, k=self.fetch_k)]
+        lexical_hits = [document for document, _ in self.lexical.search(query, self.fetch_k)]
+        ranked = reciprocal_rank_fusion([vector_hits, lexical_hits], self.rrf_k)
+        return pack_context(ranked, self.token_budget)
@@ -0,0 +1,180 @@
+import logging
+import threading
+import time
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+from ingest import CONTROL_COLLECTIONS
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundIndexer:
+    """Watches the company control collections and runs the ingest ledger after every change, so edited
+    controls become searchable without a restart. Uses MongoDB change streams and falls back to polling
+    the file version and timestamp where change streams are not available (standalone servers)"""
+    def __init__(self, db, ledger, mode="auto", poll_interval=30, debounce=2, on_sync=None):
+        self.db = db
+        self.ledger = ledger
+        # "auto", "change_stream" or "polling"
+        self.requested_mode = mode
+        self.mode = None
+        self.poll_interval = poll_interval
+        self.debounce = debounce
+        self.on_sync = on_sync
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.resume_token = None
+        self.stamps = None
+
+        # wall clock time of the oldest change which is not indexed yet, kept until a sync succeeded
+        self.pending_since = None
+        self.last_change = None
+        # oldest change which arrived while a sync was running, that sync may not include it
+        self.syncing = False
+        self.next_pending = None
+        self.retry_at = 0
+        self.syncs = 0
+        self.errors = 0
+        self.last_error = None
+        self.last_sync = None
+        self.last_stats = None
+        self.last_lag = None
+        self.max_lag = 0.0
+
+    def start(self):
+        self.stamps = self._stamps()
+        # catch up on changes made since the startup sync, unchanged files only cost a GridFS lookup
+        self._changed(time.time())
+        self.thread = threading.Thread(target=self._run, name="background-indexer", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def _stamps(self):
+        """Current file, version and timestamp of every company control"""
+        return {(name, str(document['_id'])): (document.get('file', {}).get('file'),
+                                               document.get('file', {}).get('version'),
+                                               document.get('file', {}).get('timestamp'))
+                for name in CONTROL_COLLECTIONS
+                for document in self.db[name].find({}, {'file.file': 1, 'file.version': 1, 'file.timestamp': 1})}
+
+    def _changed(self, changed_at):
+        with self.lock:
+            self.last_change = changed_at
+            if self.syncing and (self.next_pending is None or changed_at < self.next_pending):
+                self.next_pending = changed_at
+            if self.pending_since is None or changed_at < self.pending_since:
+                self.pending_since = changed_at
+
+    def _failed(self, error):
+        with self.lock:
+            self.errors += 1
+            self.last_error = repr(error)
+
+    def _sync_pending(self):
+        """Runs the ledger once no change arrived for the debounce interval"""
+        now = time.time()
+        with self.lock:
+            if self.pending_since is None or now - self.last_change < self.debounce or now < self.retry_at:
+                return
+            covered = self.pending_since
+            self.syncing = True
+            self.next_pending = None
+        try:
+            stats = self.ledger.sync()
+        except Exception as e:
+            logger.exception("Background indexing failed, retrying in %ss", self.poll_interval)
+            self._failed(e)
+            with self.lock:
+                self.syncing = False
+                self.retry_at = time.time() + self.poll_interval
+            return
+        if stats.get('skipped'):
+            # another worker holds the lease, its sync may have started before the change
+            with self.lock:
+                self.syncing = False
+            return
+
+        lag = time.time() - covered
+        with self.lock:
+            self.syncing = False
+            self.pending_since = self.next_pending
+            self.syncs += 1
+            self.last_sync = time.time()
+            self.last_stats = stats
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+        if self.on_sync is not None:
+            self.on_sync(stats)
+
+    def _watch(self):
+        pipeline = [{'$match': {'ns.coll': {'$in': list(CONTROL_COLLECTIONS)}}}]
+        with self.db.watch(pipeline, resume_after=self.resume_token, max_await_time_ms=1000) as stream:
+            if self.mode is not None:
+                # catch up on changes made while no stream was open
+                self._changed(time.time())
+            self.mode = "change_stream"
+            while not self.stopped.is_set():
+                change = stream.try_next()
+                if change is not None:
+                    self.resume_token = stream.resume_token
+                    cluster_time = change.get('clusterTime')
+                    self._changed(cluster_time.as_datetime().timestamp() if cluster_time else time.time())
+                    continue
+                self._sync_pending()
+
+    def _poll(self):
+        self.mode = "polling"
+        while not self.stopped.wait(min(self.poll_interval, self.debounce) if self.pending_since
+                                    else self.poll_interval):
+            stamps = self._stamps()
+            if stamps != self.stamps:
+                self.stamps = stamps
+                self._changed(time.time())
+            self._sync_pending()
+
+    def _run(self):
+        while not self.stopped.is_set():
+            try:
+                if self.requested_mode == "polling" or self.mode == "polling":
+                    self._poll()
+                else:
+                    self._watch()
+            except OperationFailure as e:
+                if self.mode is None and self.requested_mode == "auto":
+                    logger.info("Change streams are not available, polling every %ss: %s", self.poll_interval, e)
+                    self.mode = "polling"
+                    continue
+                logger.warning("Change stream failed, reconnecting: %s", e)
+                self._failed(e)
+                self.resume_token = None
+                self.stopped.wait(self.poll_interval)
+            except PyMongoError as e:
+                logger.warning("Background indexer lost the connection: %s", e)
+                self._failed(e)
+                self.stopped.wait(self.poll_interval)
+            except Exception as e:
+                # the thread must not die, changes would silently stop being indexed
+                logger.exception("Background indexer failed, restarting")
+                self._failed(e)
+                self.stopped.wait(self.poll_interval)
+
+    def stats(self):
+        now = time.time()
+        with self.lock:
+            return {
+                'mode': self.mode,
+                'running': self.thread is not None and self.thread.is_alive(),
+                'syncs': self.syncs,
+                'errors': self.errors,
+                'last_error': self.last_error,
+                # age of the oldest change which is not searchable yet, 0 when the index is current
+                'lag_seconds': round(now - self.pending_since, 3) if self.pending_since is not None else 0.0,
+                'last_lag_seconds': round(self.last_lag, 3) if self.last_lag is not None else None,
+                'max_lag_seconds': round(self.max_lag, 3),
+                'last_sync': self.last_sync,
+                'last_stats': self.last_stats
+            }
@@ -0,0 +1,247 @@
+import hashlib
+import logging
+import os
+import socket
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId
+from gridfs.errors import GridFSError
+from langchain_core.documents import Document
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+# Collections whose documents reference the GridFS files which are searchable
+CONTROL_COLLECTIONS = ("policy", "guideline")
+
+
+class LeaseLost(Exception):
+    """The sync lease expired and another worker took it over, this sync has to stop writing"""
+
+
+class AtlasVectorFiles:
+    """File level operations of the ledger on the MongoDB Atlas vector collection, and searches by vector"""
+    def __init__(self, collection, index_name="vector_index"):
+        self.collection = collection
+        self.index_name = index_name
+
+    def similarity_search_with_score_by_vector(self, vector, k=4):
+        """(Document, score) pairs of the top k chunks of the Atlas Vector Search index"""
+        pipeline = [
+            {'$vectorSearch': {'queryVector': vector, 'path': 'embedding', 'numCandidates': k * 10, 'limit': k,
+                               'index': self.index_name}},
+            {'$set': {'score': {'$meta': 'vectorSearchScore'}}},
+            {'$project': {'embedding': 0, '_id': 0}}
+        ]
+        return [(Document(page_content=record.pop('text', ""), metadata=record), record.pop('score'))
+                for record in self.collection.aggregate(pipeline)]
+
+    def delete_file(self, file_id, keep_hash=None):
+        """Deletes the vectors of the file, except the ones of the version with keep_hash"""
+        query = {'file_id': file_id}
+        if keep_hash is not None:
+            query['file_hash'] = {'$ne': keep_hash}
+        self.collection.delete_many(query)
+
+    def delete_version(self, file_id, file_hash):
+        self.collection.delete_many({'file_id': file_id, 'file_hash': file_hash})
+
+    def delete_unassigned(self):
+        self.collection.delete_many({'file_id': {'$exists': False}})
+
+    def chunks(self):
+        """All stored chunks as Documents, without their embeddings"""
+        return [Document(page_content=record.pop('text', ""), metadata=record)
+                for record in self.collection.find({}, {'embedding': 0, '_id': 0})]
+
+    def compact(self):
+        """Atlas drops deleted vectors itself"""
+        return 0
+
+    def copy_file(self, source_file_id, file_id, filename, file_hash):
+        vectors = list(self.collection.find({'file_id': source_file_id}, {'_id': 0}))
+        if not vectors:
+            return False
+        for vector in vectors:
+            vector['file_id'] = file_id
+            vector['file_hash'] = file_hash
+            vector['filename'] = filename
+            vector['source'] = filename
+        self.collection.insert_many(vectors)
+        return True
+
+
+class IngestLedger:
+    """Keeps track of which GridFS files are embedded in the vector store, so only new or changed
+    files are embedded and the vectors of removed files are deleted"""
+    def __init__(self, db, fs, vectorstore, vector_files, pipeline, ledger_name="Ingest_Ledger",
+                 lease_seconds=600):
+        self.db = db
+        self.fs = fs
+        self.vectorstore = vectorstore
+        # AtlasVectorFiles or LocalVectorStore
+        self.vector_files = vector_files
+        self.pipeline = pipeline
+        self.ledger = db[ledger_name]
+        self.locks = db[f"{ledger_name}_Lock"]
+        self.lease_seconds = lease_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+
+    def current_files(self):
+        """GridFS file id -> collection for the current version of every company control"""
+        files = {}
+        for name in CONTROL_COLLECTIONS:
+            for document in self.db[name].find({}, {'file.file': 1}):
+                files[str(document['file']['file'])] = name
+        return files
+
+    def file_versions(self, file_ids):
+        """Content hash of the given files as they are embedded in the vector store"""
+        return {entry['_id']: entry['hash'] for entry in self.ledger.find({'_id': {'$in': file_ids}}, {'hash': 1})}
+
+    def _acquire(self):
+        """Lease which keeps several workers from embedding the same files at the same time"""
+        now = datetime.now(timezone.utc)
+        try:
+            self.locks.update_one(
+                {'_id': "sync", '$or': [{'until': {'$lt': now}}, {'owner': self.owner}]},
+                {'$set': {'owner': self.owner, 'until': now + timedelta(seconds=self.lease_seconds)}},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            return False
+        return True
+
+    def _renew(self):
+        """Extends the lease while the sync makes progress, raises LeaseLost if another worker holds it"""
+        result = self.locks.update_one(
+            {'_id': "sync", 'owner': self.owner},
+            {'$set': {'until': datetime.now(timezone.utc) + timedelta(seconds=self.lease_seconds)}})
+        if not result.matched_count:
+            raise LeaseLost(f"{self.owner} lost the ingest lease")
+
+    def _release(self):
+        self.locks.delete_one({'_id': "sync", 'owner': self.owner})
+
+    def sync(self):
+        """Embeds new or changed files and deletes the vectors of removed files"""
+        if not self._acquire():
+            return {'skipped': True}
+        try:
+            return self._sync()
+        except LeaseLost:
+            # the worker holding the lease now embeds the remaining files, and clears what this one stored
+            # of an unfinished file before embedding it again
+            return {'skipped': True, 'lease_lost': True}
+        finally:
+            self._release()
+
+    def _sync(self):
+        stats = {'added': 0, 'copied': 0, 'removed': 0, 'unchanged': 0, 'failed': 0, 'chunks': 0}
+        ledger = {entry['_id']: entry for entry in self.ledger.find()}
+        if not ledger:
+            # vectors stored before the ledger existed cannot be matched to a file
+            self.vector_files.delete_unassigned()
+
+        current = self.current_files()
+        changed = {}
+        # content hash -> file id parsed in this sync, and the files with the same content waiting for it
+        parsed = {}
+        waiting = {}
+
+        def changed_files():
+            """Reads new or changed files from GridFS and hands them to the pipeline"""
+            for file_id, collection in current.items():
+                self._renew()
+                entry = ledger.get(file_id)
+                if entry is not None and entry.get('unreadable'):
+                    # referenced by a company control but missing or corrupt in GridFS, its content never changes
+                    # as uploads get new file ids
+                    stats['unchanged'] += 1
+                    continue
+                try:
+                    grid_out = self.fs.get(ObjectId(file_id))
+                    if entry is not None and entry['length'] == grid_out.length \
+                            and entry['upload_date'] == grid_out.upload_date:
+                        stats['unchanged'] += 1
+                        continue
+                    data = grid_out.read()
+                except GridFSError as e:
+                    # deleted since current_files() or corrupt, the other files are still indexed
+                    logger.warning("GridFS file %s could not be read: %s", file_id, e)
+                    self.vector_files.delete_file(file_id)
+                    self._record(file_id, {'hash': None, 'collection': collection, 'filename': None, 'length': None,
+                                           'upload_date': None, 'chunks': 0, 'failed': repr(e),
+                                           'unreadable': True})
+                    stats['failed'] += 1
+                    continue
+
+                content_hash = hashlib.sha256(data).hexdigest()
+                if entry is not None and entry['hash'] == content_hash:
+                    stats['unchanged'] += 1
+                    continue
+
+                # leftovers of an interrupted sync of this version, the previous version stays searchable
+                # until the new vectors are stored
+                self.vector_files.delete_version(file_id, content_hash)
+                changed[file_id] = {'hash': content_hash, 'collection': collection, 'filename': grid_out.filename,
+                                    'length': grid_out.length, 'upload_date': grid_out.upload_date, 'chunks': 0}
+                duplicate = self.ledger.find_one({'hash': content_hash, '_id': {'$ne': file_id},
+                                                  'failed': {'$exists': False}})
+                if duplicate is not None and self.vector_files.copy_file(duplicate['_id'], file_id, grid_out.filename,
+                                                                         content_hash):
+                    self.vector_files.delete_file(file_id, keep_hash=content_hash)
+                    changed[file_id]['chunks'] = duplicate['chunks']
+                    stats['copied'] += 1
+                    self._record(file_id, changed.pop(file_id))
+                    continue
+                if content_hash in parsed:
+                    # same content as a file of this sync, its vectors are copied once that one is stored
+                    waiting.setdefault(parsed[content_hash], []).append(file_id)
+                    continue
+                parsed[content_hash] = file_id
+                yield file_id, grid_out.filename, data
+
+        for documents, completed, failed in self.pipeline.batches(changed_files()):
+            # nothing is written without the lease, it is extended for every batch
+            self._renew()
+            for file_id, error in failed:
+                # recorded with the hash of the file, so the same content is not parsed again on every sync
+                logger.warning("%s could not be split: %r", changed[file_id]['filename'], error)
+                for failed_id in [file_id] + waiting.pop(file_id, []):
+                    self.vector_files.delete_file(failed_id)
+                    self._record(failed_id, dict(changed.pop(failed_id), failed=repr(error)))
+                    stats['failed'] += 1
+            for document in documents:
+                document.metadata['file_hash'] = changed[document.metadata['file_id']]['hash']
+            if documents:
+                self.vectorstore.add_documents(documents)
+            for document in documents:
+                changed[document.metadata['file_id']]['chunks'] += 1
+            for file_id in completed:
+                # the previous version of the file is deleted once all chunks of the new one are stored
+                self.vector_files.delete_file(file_id, keep_hash=changed[file_id]['hash'])
+                stats['added'] += 1
+                entry = changed.pop(file_id)
+                self._record(file_id, entry)
+                for duplicate_id in waiting.pop(file_id, []):
+                    duplicate = changed.pop(duplicate_id)
+                    self.vector_files.copy_file(file_id, duplicate_id, duplicate['filename'], duplicate['hash'])
+                    self.vector_files.delete_file(duplicate_id, keep_hash=duplicate['hash'])
+                    duplicate['chunks'] = entry['chunks']
+                    stats['copied'] += 1
+                    self._record(duplicate_id, duplicate)
+        stats['chunks'] = sum(entry['chunks'] for entry in self.ledger.find({'_id': {'$in': list(current)}}))
+
+        for file_id in ledger:
+            if file_id not in current:
+                self.vector_files.delete_file(file_id)
+                self.ledger.delete_one({'_id': file_id})
+                stats['removed'] += 1
+        stats['compacted'] = self.vector_files.compact()
+        return stats
+
+    def _record(self, file_id, entry):
+        """Marks the file as embedded"""
+        self.ledger.replace_one({'_id': file_id}, dict(entry, _id=file_id, embedded_at=datetime.now(timezone.utc)),
+                                upsert=True)
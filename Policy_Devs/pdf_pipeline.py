@@ -0,0 +1,95 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from io import BytesIO
+
+from langchain_core.documents import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from pypdf import PdfReader
+
+
+def split_pdf(file_id, filename, data, chunk_size, chunk_overlap):
+    """Extracts the pages of an in-memory PDF and splits them into chunks, runs in a worker process"""
+    reader = PdfReader(BytesIO(data))
+    pages = [Document(page_content=page.extract_text() or "",
+                      metadata={'source': filename, 'page': number, 'file_id': file_id, 'filename': filename})
+             for number, page in enumerate(reader.pages)]
+    # start_index lets the retriever leave out the overlap of neighbouring chunks
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap,
+                                                   add_start_index=True)
+    return file_id, text_splitter.split_documents(pages)
+
+
+class PdfPipeline:
+    """Streaming ingest pipeline: GridFS bytes -> page extraction and splitting in a process pool
+    -> batches of documents for the embedder. No files are written to disk"""
+    def __init__(self, chunk_size=1000, chunk_overlap=150, workers=1, batch_size=256):
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.workers = workers
+        self.batch_size = batch_size
+
+    def split(self, files):
+        """Yields (file_id, documents, error) for every (file_id, filename, data) as soon as it is split.
+        documents is None and error the exception for files which could not be read, e.g. corrupt PDFs"""
+        if self.workers <= 1:
+            for file_id, filename, data in files:
+                try:
+                    yield split_pdf(file_id, filename, data, self.chunk_size, self.chunk_overlap) + (None,)
+                except Exception as e:
+                    yield file_id, None, e
+            return
+
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            # future -> file id
+            pending = {}
+            files = iter(files)
+            exhausted = False
+            while True:
+                # only a few files are read ahead, so the whole corpus is never held in memory
+                while not exhausted and len(pending) < self.workers * 2:
+                    try:
+                        file_id, filename, data = next(files)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    pending[pool.submit(split_pdf, file_id, filename, data, self.chunk_size,
+                                        self.chunk_overlap)] = file_id
+                if not pending:
+                    return
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    file_id = pending.pop(future)
+                    try:
+                        yield future.result() + (None,)
+                    except Exception as e:
+                        yield file_id, None, e
+
+    def batches(self, files):
+        """Yields (documents, completed, failed) where documents holds at most batch_size chunks,
+        completed lists the file ids whose last chunk is part of the batch and failed the (file_id, error)
+        of files which could not be split since the previous batch"""
+        batch = []
+        completed = []
+        failed = []
+        queue = deque()
+        for file_id, documents, error in self.split(files):
+            if error is not None:
+                failed.append((file_id, error))
+                continue
+            queue.append((file_id, documents))
+            while queue:
+                file_id, documents = queue[0]
+                space = self.batch_size - len(batch)
+                batch.extend(documents[:space])
+                if len(documents) > space:
+                    queue[0] = (file_id, documents[space:])
+                else:
+                    queue.popleft()
+                    completed.append(file_id)
+                if len(batch) >= self.batch_size:
+                    yield batch, completed, failed
+                    batch = []
+                    completed = []
+                    failed = []
+        if batch or completed or failed:
+            yield batch, completed, failed
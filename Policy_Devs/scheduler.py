@@ -0,0 +1,179 @@
+import math
+import threading
+import time
+from collections import deque
+
+from langchain_core.embeddings import Embeddings
+
+
+class SchedulerBusy(Exception):
+    """The queue of the scheduler is full or the call waited too long for a slot"""
+    def __init__(self, name, retry_after):
+        super().__init__(f"{name} is busy, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class _Call:
+    """Result of an in-flight call, shared by every request asking the same"""
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class Scheduler:
+    """Runs expensive LLM or embedding calls with at most `concurrency` at once. Further calls wait
+    in FIFO order in a queue of `queue_size`, when it is full SchedulerBusy is raised right away.
+    Calls with the same key which are already queued or running share their result"""
+    def __init__(self, name, concurrency=1, queue_size=8, queue_timeout=30, samples=1000):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.condition = threading.Condition()
+        self.waiting = deque()
+        self.running = 0
+        self.in_flight = {}
+
+        self.calls = 0
+        self.shared = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.queue_waits = deque(maxlen=samples)
+        self.run_times = deque(maxlen=samples)
+
+    def retry_after(self):
+        """Seconds until the queue has likely drained"""
+        average = sum(self.run_times) / len(self.run_times) if self.run_times else 1
+        return max(1, math.ceil(average * (len(self.waiting) + self.running) / self.concurrency))
+
+    def acquire(self, timings=None):
+        """Waits for a free slot, every acquire needs a release"""
+        start = time.perf_counter()
+        with self.condition:
+            if len(self.waiting) >= self.queue_size and self.running >= self.concurrency:
+                self.rejected += 1
+                raise SchedulerBusy(self.name, self.retry_after())
+            ticket = object()
+            self.waiting.append(ticket)
+            deadline = time.monotonic() + self.queue_timeout
+            while self.running >= self.concurrency or self.waiting[0] is not ticket:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.condition.wait(remaining):
+                    self.waiting.remove(ticket)
+                    self.condition.notify_all()
+                    self.timeouts += 1
+                    raise SchedulerBusy(self.name, self.retry_after())
+            self.waiting.popleft()
+            self.running += 1
+            self.condition.notify_all()
+        queue_wait = time.perf_counter() - start
+        self.queue_waits.append(queue_wait)
+        if timings is not None:
+            timings['queue_wait'] = queue_wait
+            timings['started'] = time.perf_counter()
+
+    def release(self, timings=None):
+        if timings is not None and 'started' in timings:
+            timings['run'] = time.perf_counter() - timings.pop('started')
+            self.run_times.append(timings['run'])
+        with self.condition:
+            self.running -= 1
+            self.condition.notify_all()
+
+    def run(self, key, function, timings=None):
+        """Result of function(), shared with all callers of the same key while it is in flight"""
+        timings = {} if timings is None else timings
+        with self.condition:
+            self.calls += 1
+            call = self.in_flight.get(key)
+            owner = call is None
+            if owner:
+                call = self.in_flight[key] = _Call()
+            else:
+                call.waiters += 1
+                self.shared += 1
+        if not owner:
+            start = time.perf_counter()
+            call.done.wait()
+            timings['shared'] = True
+            timings['queue_wait'] = time.perf_counter() - start
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            self.acquire(timings)
+            try:
+                call.result = function()
+            finally:
+                self.release(timings)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.condition:
+                del self.in_flight[key]
+            call.done.set()
+        return call.result
+
+    @staticmethod
+    def _percentile(samples, percentile):
+        if not samples:
+            return None
+        ordered = sorted(samples)
+        return round(ordered[min(len(ordered) - 1, int(len(ordered) * percentile))], 4)
+
+    def stats(self):
+        with self.condition:
+            queue_waits = list(self.queue_waits)
+            run_times = list(self.run_times)
+            return {
+                'concurrency': self.concurrency,
+                'queue_size': self.queue_size,
+                'running': self.running,
+                'waiting': len(self.waiting),
+                'calls': self.calls,
+                'shared': self.shared,
+                'rejected': self.rejected,
+                'timeouts': self.timeouts,
+                'queue_wait_p50': self._percentile(queue_waits, 0.5),
+                'queue_wait_p95': self._percentile(queue_waits, 0.95),
+                'run_p50': self._percentile(run_times, 0.5),
+                'run_p95': self._percentile(run_times, 0.95)
+            }
+
+
+class ScheduledEmbeddings(Embeddings):
+    """Embedding backend whose calls run through a scheduler, identical questions in flight are embedded once.
+    Batches of documents come from the ingest, they wait for a slot instead of failing when the queue is full"""
+    def __init__(self, backend, scheduler):
+        self.backend = backend
+        self.scheduler = scheduler
+        self.model = getattr(backend, 'model', None) or type(backend).__name__
+        self.dimensions = getattr(backend, 'dimensions', None)
+
+    def embed_documents(self, texts):
+        while True:
+            try:
+                return self.scheduler.run(("documents", tuple(texts)), lambda: self.backend.embed_documents(texts))
+            except SchedulerBusy as e:
+                time.sleep(e.retry_after)
+
+    def embed_query(self, text):
+        return self.scheduler.run(("query", text), lambda: self.backend.embed_query(text))
+
+    def embed_queries(self, texts):
+        """Query vectors of several questions, embedded with one backend call in one slot"""
+        if len(texts) <= 1:
+            return [self.embed_query(text) for text in texts]
+        return self.scheduler.run(("queries", tuple(texts)), lambda: self._embed_queries(texts))
+
+    def _embed_queries(self, texts):
+        # Ollama models put an instruction in front of questions which differs from the one of documents,
+        # other backends (OpenAI) embed questions like documents
+        query_instruction = getattr(self.backend, 'query_instruction', None)
+        if query_instruction is not None and hasattr(self.backend, '_embed'):
+            return self.backend._embed([f"{query_instruction}{text}" for text in texts])
+        return self.backend.embed_documents(texts)
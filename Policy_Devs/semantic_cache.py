@@ -0,0 +1,135 @@
+import threading
+import time
+
+import numpy as np
+
+
+class _Partition:
+    """Normalized question vectors of one kind of answer in a fixed size matrix"""
+    def __init__(self, dimension, max_entries):
+        self.matrix = np.zeros((max_entries, dimension), dtype=np.float32)
+        self.used = np.zeros(max_entries, dtype=bool)
+        self.last_used = np.zeros(max_entries, dtype=np.float64)
+        self.entries = [None] * max_entries
+
+    def free_slot(self):
+        """First unused slot or the least recently used one"""
+        free = np.flatnonzero(~self.used)
+        if len(free):
+            return int(free[0]), False
+        return int(np.argmin(self.last_used)), True
+
+    def remove(self, slot):
+        self.used[slot] = False
+        self.entries[slot] = None
+
+
+class SemanticCache:
+    """Answers of previous questions, returned for new questions whose embedding is within the cosine
+    similarity threshold. Every entry records the versions of its source files and is dropped as soon as
+    one of them changed"""
+    def __init__(self, embeddings, versions, threshold=0.95, max_entries=1000):
+        self.embeddings = embeddings
+        # file ids -> {file id: version} of the files currently in the vector store
+        self.versions = versions
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.partitions = {}
+        self.counters = {}
+
+    def _counter(self, kind):
+        return self.counters.setdefault(kind, {'hits': 0, 'misses': 0, 'invalidations': 0, 'evictions': 0,
+                                               'saved_seconds': 0.0})
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, kind, question):
+        """Returns (response or None, question vector), the vector is handed to put on a miss"""
+        vector = self._normalize(self.embeddings.embed_query(question))
+        entry = None
+        with self.lock:
+            counter = self._counter(kind)
+            partition = self.partitions.get(kind)
+            if partition is not None and partition.matrix.shape[1] == len(vector) and partition.used.any():
+                scores = partition.matrix @ vector
+                scores[~partition.used] = -np.inf
+                slot = int(np.argmax(scores))
+                if scores[slot] >= self.threshold:
+                    entry = partition.entries[slot]
+            if entry is None:
+                counter['misses'] += 1
+                return None, vector
+
+        # the source files are checked outside the lock, it is a database round-trip
+        valid = self.versions(list(entry['sources'])) == entry['sources']
+        with self.lock:
+            if not valid:
+                if partition.entries[slot] is entry:
+                    partition.remove(slot)
+                counter['invalidations'] += 1
+                counter['misses'] += 1
+                return None, vector
+            partition.last_used[slot] = time.monotonic()
+            counter['hits'] += 1
+            counter['saved_seconds'] += entry['elapsed']
+        return entry['response'], vector
+
+    def put(self, kind, question, vector, response, file_ids, elapsed):
+        """Stores the response, answers whose sources cannot be tracked are not cached"""
+        file_ids = set(file_ids)
+        if not file_ids or None in file_ids:
+            return
+        sources = self.versions(list(file_ids))
+        if len(sources) != len(file_ids):
+            return
+        with self.lock:
+            partition = self.partitions.get(kind)
+            if partition is None or partition.matrix.shape[1] != len(vector):
+                partition = self.partitions[kind] = _Partition(len(vector), self.max_entries)
+            slot, evicted = partition.free_slot()
+            if evicted:
+                self._counter(kind)['evictions'] += 1
+            partition.matrix[slot] = vector
+            partition.used[slot] = True
+            partition.last_used[slot] = time.monotonic()
+            partition.entries[slot] = {'question': question, 'response': response, 'sources': sources,
+                                       'elapsed': elapsed}
+
+    def prune(self):
+        """Drops all entries whose source files changed, one version lookup for the whole cache"""
+        with self.lock:
+            entries = [(kind, slot, entry) for kind, partition in self.partitions.items()
+                       for slot, entry in enumerate(partition.entries) if entry is not None]
+        file_ids = {file_id for kind, slot, entry in entries for file_id in entry['sources']}
+        current = self.versions(list(file_ids)) if file_ids else {}
+        removed = 0
+        with self.lock:
+            for kind, slot, entry in entries:
+                if any(current.get(file_id) != version for file_id, version in entry['sources'].items()):
+                    partition = self.partitions[kind]
+                    if partition.entries[slot] is entry:
+                        partition.remove(slot)
+                        self._counter(kind)['invalidations'] += 1
+                        removed += 1
+        return removed
+
+    def clear(self):
+        with self.lock:
+            self.partitions.clear()
+
+    def stats(self):
+        with self.lock:
+            stats = {'threshold': self.threshold, 'max_entries': self.max_entries}
+            for kind, counter in self.counters.items():
+                partition = self.partitions.get(kind)
+                requests = counter['hits'] + counter['misses']
+                stats[kind] = dict(counter,
+                                   entries=int(partition.used.sum()) if partition is not None else 0,
+                                   saved_seconds=round(counter['saved_seconds'], 3),
+                                   hit_rate=round(counter['hits'] / requests, 4) if requests else None)
+        return stats
@@ -0,0 +1,601 @@
+import copy
+import json
+import os
+import threading
+import uuid
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+
+DTYPES = {'float32': np.float32, 'float16': np.float16, 'int8': np.int8}
+KINDS = ('auto', 'exact', 'ivf')
+
+
+def normalize(vectors):
+    """Unit length rows, so the inner product is the cosine similarity"""
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def read_rows(path, dtype, start, stop, columns=1):
+    """Rows start to stop of a raw array file"""
+    count = (stop - start) * columns
+    if count == 0:
+        values = np.empty(0, dtype=dtype)
+    else:
+        values = np.fromfile(path, dtype=dtype, count=count, offset=start * columns * np.dtype(dtype).itemsize)
+    if len(values) != count:
+        raise ValueError(f"{path} is shorter than index.json says")
+    return values.reshape(-1, columns) if columns > 1 else values
+
+
+def append_rows(path, values, start):
+    """Writes values[start:] behind the first start rows of a raw array file, the tail of an interrupted
+    write is cut off"""
+    row_bytes = values.itemsize * int(np.prod(values.shape[1:]))
+    with open(path, "ab") as f:
+        f.truncate(start * row_bytes)
+        f.write(np.ascontiguousarray(values[start:]).tobytes())
+
+
+def extend(array, rows, buffer=None):
+    """array followed by rows, as a view of a buffer which grows geometrically. Returns the view and the buffer.
+    The stored rows are copied only when the buffer is full, views handed out before (snapshots) do not
+    reach the rows written behind them"""
+    size = len(array)
+    if buffer is None or array.base is not buffer or len(buffer) < size + len(rows):
+        grown = np.empty((max(2 * size, size + len(rows), 16),) + array.shape[1:], dtype=array.dtype)
+        grown[:size] = array
+        buffer = grown
+    buffer[size:size + len(rows)] = rows
+    return buffer[:size + len(rows)], buffer
+
+
+def cluster_lists(assignments, nlist):
+    """Ascending positions of every cluster"""
+    order = np.argsort(assignments, kind='stable')
+    return np.split(order, np.searchsorted(assignments[order], np.arange(1, nlist)))
+
+
+def top_k(scores, k):
+    """Column indexes of the k highest scores of every row, best first"""
+    k = min(k, scores.shape[1])
+    if k <= 0:
+        return np.empty((scores.shape[0], 0), dtype=np.int64)
+    candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, candidates, axis=1), axis=1, kind='stable')
+    return np.take_along_axis(candidates, order, axis=1)
+
+
+class VectorIndex:
+    """Cosine similarity index over normalized vectors stored as float32, float16 or int8.
+    Small indexes are searched exactly, large ones through an inverted file (IVF) of k-means
+    clusters of which only the nprobe closest are scanned.
+    Adds only write behind the rows of the current arrays, removals and trainings replace them, so a
+    snapshot() stays consistent while the index changes"""
+    def __init__(self, dimension, dtype='float32', kind='auto', ivf_threshold=50000, nprobe=8,
+                 chunk_size=65536):
+        if dtype not in DTYPES:
+            raise ValueError(f"dtype has to be one of {', '.join(DTYPES)}")
+        if kind not in KINDS:
+            raise ValueError(f"kind has to be one of {', '.join(KINDS)}")
+        self.dimension = dimension
+        self.dtype = dtype
+        self.kind = kind
+        self.ivf_threshold = ivf_threshold
+        self.nprobe = nprobe
+        self.chunk_size = chunk_size
+        self.vectors = np.empty((0, dimension), dtype=DTYPES[dtype])
+        # per vector scale of the int8 quantization
+        self.scales = np.empty(0, dtype=np.float32)
+        self.alive = np.empty(0, dtype=bool)
+        # removed positions in the order of their removal, as persisted in removed.bin
+        self.removals = np.empty(0, dtype=np.int64)
+        self.centroids = None
+        self.assignments = None
+        self.lists = None
+        self.trained_size = 0
+        # number of trainings, the clusters of each one are saved to files of their own
+        self.training = 0
+        # number of compactions, the rows of each one are saved to files of their own
+        self.epoch = 0
+        # buffers the arrays are views of, by attribute name or ('list', cluster)
+        self.buffers = {}
+
+    def __len__(self):
+        return int(self.alive.sum())
+
+    def _encode(self, vectors):
+        if self.dtype == 'int8':
+            scales = np.abs(vectors).max(axis=1)
+            scales[scales == 0] = 1
+            encoded = np.round(vectors / scales[:, None] * 127).astype(np.int8)
+            return encoded, (scales / 127).astype(np.float32)
+        return vectors.astype(DTYPES[self.dtype]), np.ones(len(vectors), dtype=np.float32)
+
+    def decode(self, positions):
+        """Stored vectors as float32"""
+        vectors = np.asarray(self.vectors[positions], dtype=np.float32)
+        if self.dtype == 'int8':
+            vectors *= self.scales[positions][:, None]
+        return vectors
+
+    def _scores(self, rows, queries):
+        """Similarity of the stored rows (slice or positions) with the queries as (rows, queries) matrix"""
+        scores = np.asarray(self.vectors[rows], dtype=np.float32) @ queries.T
+        if self.dtype == 'int8':
+            scores *= self.scales[rows][:, None]
+        return scores
+
+    def uses_ivf(self):
+        return self.kind == 'ivf' or (self.kind == 'auto' and len(self) >= self.ivf_threshold)
+
+    def add(self, vectors):
+        """Adds the vectors and returns their positions"""
+        encoded, scales = self._encode(normalize(vectors))
+        start = len(self.vectors)
+        self.vectors, self.buffers['vectors'] = extend(self.vectors, encoded, self.buffers.get('vectors'))
+        self.scales, self.buffers['scales'] = extend(self.scales, scales, self.buffers.get('scales'))
+        self.alive, self.buffers['alive'] = extend(self.alive, np.ones(len(encoded), dtype=bool),
+                                                   self.buffers.get('alive'))
+        positions = np.arange(start, start + len(encoded))
+        if self.centroids is not None and len(self) < 2 * self.trained_size:
+            self._assign(positions)
+        elif self.uses_ivf():
+            # the clusters are trained again whenever the index doubled in size
+            self.train()
+        return positions
+
+    def remove(self, positions):
+        positions = np.asarray(positions, dtype=np.int64)
+        alive = np.array(self.alive)
+        alive[positions] = False
+        self.alive = alive
+        self.removals, self.buffers['removals'] = extend(self.removals, positions, self.buffers.get('removals'))
+
+    def compact(self):
+        """Drops the removed rows. Returns the former positions of the kept rows, in their new order"""
+        kept = np.flatnonzero(self.alive)
+        self.vectors = np.array(self.vectors[kept])
+        self.scales = self.scales[kept]
+        self.alive = np.ones(len(kept), dtype=bool)
+        self.removals = np.empty(0, dtype=np.int64)
+        if self.centroids is not None:
+            self.assignments = self.assignments[kept]
+            self.lists = cluster_lists(self.assignments, len(self.centroids))
+            self.training += 1
+        self.epoch += 1
+        return kept
+
+    def snapshot(self):
+        """Copy of the current state, which later changes of the index do not affect"""
+        return copy.copy(self)
+
+    def train(self, iterations=10, seed=0):
+        """Spherical k-means over a sample of the vectors, every vector is assigned to its closest centroid"""
+        positions = np.flatnonzero(self.alive)
+        if len(positions) == 0:
+            return
+        nlist = max(1, int(2 * np.sqrt(len(positions))))
+        rng = np.random.default_rng(seed)
+        sample = rng.choice(positions, size=min(len(positions), nlist * 32), replace=False)
+        data = self.decode(np.sort(sample))
+        centroids = data[rng.choice(len(data), size=min(nlist, len(data)), replace=False)]
+        for _ in range(iterations):
+            labels = np.argmax(data @ centroids.T, axis=1)
+            order = np.argsort(labels, kind='stable')
+            clusters, starts = np.unique(labels[order], return_index=True)
+            sums = centroids.copy()
+            sums[clusters] = np.add.reduceat(data[order], starts, axis=0)
+            centroids = normalize(sums)
+        self.centroids = centroids
+        self.trained_size = len(positions)
+        self.training += 1
+        self.assignments = np.empty(0, dtype=np.int32)
+        self.lists = [np.empty(0, dtype=np.int64) for _ in range(len(centroids))]
+        self._assign(np.arange(len(self.vectors)))
+
+    def _assign(self, positions):
+        """Assigns the positions following the assigned ones to their closest centroid"""
+        lists = list(self.lists)
+        for start in range(0, len(positions), self.chunk_size):
+            chunk = positions[start:start + self.chunk_size]
+            labels = np.argmax(self._scores(chunk, self.centroids), axis=1).astype(np.int32)
+            self.assignments, self.buffers['assignments'] = extend(self.assignments, labels,
+                                                                   self.buffers.get('assignments'))
+            for label in np.unique(labels):
+                lists[label], self.buffers['list', label] = extend(lists[label], chunk[labels == label],
+                                                                   self.buffers.get(('list', label)))
+        self.lists = lists
+
+    def search(self, queries, k):
+        """Batched top-k search. Returns a (positions, scores) pair of lists per query"""
+        queries = normalize(queries)
+        if len(self) == 0:
+            return [([], []) for _ in queries]
+        if self.centroids is not None and self.uses_ivf():
+            return self._search_ivf(queries, k)
+        return self._search_exact(queries, k)
+
+    def _search_exact(self, queries, k):
+        best_positions = np.empty((len(queries), 0), dtype=np.int64)
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        for start in range(0, len(self.vectors), self.chunk_size):
+            end = min(start + self.chunk_size, len(self.vectors))
+            scores = self._scores(slice(start, end), queries).T
+            scores[:, ~self.alive[start:end]] = -np.inf
+            positions = np.broadcast_to(np.arange(start, end), scores.shape)
+            scores = np.concatenate([best_scores, scores], axis=1)
+            positions = np.concatenate([best_positions, positions], axis=1)
+            best = top_k(scores, k)
+            best_scores = np.take_along_axis(scores, best, axis=1)
+            best_positions = np.take_along_axis(positions, best, axis=1)
+        return [(positions[np.isfinite(scores)].tolist(), scores[np.isfinite(scores)].tolist())
+                for positions, scores in zip(best_positions, best_scores)]
+
+    def _search_ivf(self, queries, k):
+        probes = top_k(queries @ self.centroids.T, self.nprobe)
+        results = []
+        for query, clusters in zip(queries, probes):
+            candidates = np.concatenate([self.lists[cluster] for cluster in clusters])
+            candidates = candidates[self.alive[candidates]]
+            if len(candidates) == 0:
+                results.append(([], []))
+                continue
+            scores = self._scores(candidates, query[None, :])[:, 0]
+            best = top_k(scores[None, :], k)[0]
+            results.append((candidates[best].tolist(), scores[best].tolist()))
+        return results
+
+    def meta(self):
+        return {'dimension': self.dimension, 'dtype': self.dtype, 'kind': self.kind,
+                'ivf_threshold': self.ivf_threshold, 'nprobe': self.nprobe, 'size': len(self.vectors),
+                'removed': len(self.removals), 'training': self.training, 'trained_size': self.trained_size,
+                'epoch': self.epoch}
+
+    @staticmethod
+    def files(epoch):
+        """Names of the row files of a compaction"""
+        return [f"vectors-{epoch}.bin", f"scales-{epoch}.bin", f"removed-{epoch}.bin"]
+
+    def save(self, directory, saved=None):
+        """Appends the vectors and removals which are not in the files of the directory yet, saved is the
+        meta() of the files. Clusters are written to new files after every training, all rows to new files
+        after a compaction. Returns the meta() to be stored in index.json"""
+        os.makedirs(directory, exist_ok=True)
+        if saved is not None and saved['epoch'] != self.epoch:
+            saved = None
+        start = saved['size'] if saved else 0
+        vectors_file, scales_file, removed_file = self.files(self.epoch)
+        append_rows(os.path.join(directory, vectors_file), self.vectors, start)
+        append_rows(os.path.join(directory, scales_file), self.scales, start)
+        append_rows(os.path.join(directory, removed_file), self.removals, saved['removed'] if saved else 0)
+        if self.training:
+            if saved is None or saved['training'] != self.training:
+                np.save(os.path.join(directory, f"centroids-{self.training}.npy"), self.centroids)
+                start = 0
+            append_rows(os.path.join(directory, f"assignments-{self.training}.bin"), self.assignments, start)
+        return self.meta()
+
+    @staticmethod
+    def remove_files(directory, names):
+        """Deletes the files of an earlier training or compaction once index.json no longer refers to them"""
+        for name in names:
+            try:
+                os.remove(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+
+    @classmethod
+    def from_meta(cls, meta):
+        return cls(meta['dimension'], meta['dtype'], meta['kind'], meta['ivf_threshold'], meta['nprobe'])
+
+    def load(self, directory, meta, loaded=None):
+        """Reads what the files of the directory (described by meta) have in addition to loaded, the meta
+        of the state of this index, or everything. Vectors are memory-mapped"""
+        size = meta['size']
+        start = loaded['size'] if loaded else 0
+        removed = loaded['removed'] if loaded else 0
+        dtype = DTYPES[self.dtype]
+        vectors_file, scales_file, removed_file = self.files(meta['epoch'])
+        removals = read_rows(os.path.join(directory, removed_file), np.int64, removed, meta['removed'])
+        scales = read_rows(os.path.join(directory, scales_file), np.float32, start, size)
+        buffers = dict(self.buffers)
+        if meta['training'] and (loaded is None or loaded['training'] != meta['training']):
+            centroids = np.load(os.path.join(directory, f"centroids-{meta['training']}.npy"))
+            assignments = read_rows(os.path.join(directory, f"assignments-{meta['training']}.bin"), np.int32, 0, size)
+            lists = cluster_lists(assignments, len(centroids))
+        elif meta['training']:
+            centroids = self.centroids
+            added = read_rows(os.path.join(directory, f"assignments-{meta['training']}.bin"), np.int32, start, size)
+            assignments, buffers['assignments'] = extend(self.assignments[:start], added, buffers.get('assignments'))
+            lists = list(self.lists)
+            for label in np.unique(added):
+                lists[label], buffers['list', label] = extend(lists[label], start + np.flatnonzero(added == label),
+                                                              buffers.get(('list', label)))
+        else:
+            centroids, assignments, lists = None, None, None
+
+        if size:
+            self.vectors = np.memmap(os.path.join(directory, vectors_file), dtype=dtype, mode='r',
+                                     shape=(size, self.dimension))
+        else:
+            self.vectors = np.empty((0, self.dimension), dtype=dtype)
+        self.scales, buffers['scales'] = extend(self.scales[:start], scales, buffers.get('scales'))
+        alive, buffers['alive'] = extend(self.alive[:start], np.ones(size - start, dtype=bool), buffers.get('alive'))
+        if len(removals):
+            alive = np.array(alive)
+            alive[removals] = False
+        self.alive = alive
+        self.removals, buffers['removals'] = extend(self.removals[:removed], removals, buffers.get('removals'))
+        self.centroids, self.assignments, self.lists = centroids, assignments, lists
+        self.buffers = buffers
+        self.training = meta['training']
+        self.epoch = meta['epoch']
+        self.trained_size = meta['trained_size']
+        return removals
+
+
+class LocalVectorStore(VectorStore):
+    """langchain vector store on top of VectorIndex, persisted in a local directory.
+    Changes are appended to the files. Every worker process has its own copy of the index, the changes
+    another process wrote are loaded on the next search or change, after which on_reload is called"""
+    def __init__(self, embedding, path=None, dtype='float32', kind='auto', ivf_threshold=50000, nprobe=8,
+                 compact_ratio=0.25, on_reload=None):
+        self._embedding = embedding
+        self.path = path
+        self.dtype = dtype
+        self.kind = kind
+        self.ivf_threshold = ivf_threshold
+        self.nprobe = nprobe
+        # share of removed rows from which compact() rewrites the files without them
+        self.compact_ratio = compact_ratio
+        self.on_reload = on_reload
+        self.lock = threading.Lock()
+        self.index = None
+        # text, metadata and id of every position of the index, None once deleted.
+        # Removals replace the list, so searches can keep using the one they started with
+        self.documents = []
+        self.positions = {}
+        # contents of index.json for the state of this process, and the file it was read from
+        self.saved = None
+        self.meta_key = None
+        self._refresh()
+
+    @property
+    def embeddings(self):
+        return self._embedding
+
+    def __len__(self):
+        return len(self.index) if self.index is not None else 0
+
+    def _refresh(self):
+        """Loads the changes written by other processes since the files were last read or written by this one.
+        Returns whether there were any"""
+        if not self.path:
+            return False
+        meta_path = os.path.join(self.path, "index.json")
+        try:
+            stat = os.stat(meta_path)
+        except FileNotFoundError:
+            return False
+        meta_key = (stat.st_ino, stat.st_mtime_ns)
+        if meta_key == self.meta_key:
+            return False
+        with open(meta_path) as f:
+            meta = json.load(f)
+        saved = self.saved
+        if saved is not None and meta['generation'] == saved['generation']:
+            self.meta_key = meta_key
+            return False
+        if saved is None or self.index is None or meta['epoch'] != saved['epoch']:
+            # nothing loaded yet, or the files were compacted
+            saved = None
+            self.documents, self.positions = [], {}
+            index = VectorIndex.from_meta(meta)
+        else:
+            index = self.index
+        try:
+            with open(os.path.join(self.path, f"documents-{meta['epoch']}.jsonl"), "rb") as f:
+                f.seek(saved['documents_bytes'] if saved else 0)
+                lines = f.read(meta['documents_bytes'] - (saved['documents_bytes'] if saved else 0)).splitlines()
+            removals = index.load(self.path, meta, saved)
+        except (OSError, ValueError):
+            # the writer started another training or compaction meanwhile, loaded on the next call
+            return False
+        documents = self.documents + [json.loads(line) for line in lines]
+        for position in removals:
+            self.positions.pop(documents[position]['id'], None)
+            documents[position] = None
+        for position in range(len(self.documents), len(documents)):
+            if documents[position] is not None:
+                self.positions[documents[position]['id']] = position
+        self.index, self.documents = index, documents
+        self.saved, self.meta_key = meta, meta_key
+        return True
+
+    def _save(self):
+        if not self.path:
+            return
+        saved = self.saved
+        meta = self.index.save(self.path, saved)
+        written = saved if saved and saved['epoch'] == meta['epoch'] else None
+        with open(os.path.join(self.path, f"documents-{meta['epoch']}.jsonl"), "ab") as f:
+            f.truncate(written['documents_bytes'] if written else 0)
+            f.write("".join(json.dumps(document, default=str) + "\n"
+                            for document in self.documents[written['size'] if written else 0:]).encode("utf-8"))
+            meta['documents_bytes'] = f.tell()
+        meta['generation'] = (saved['generation'] if saved else 0) + 1
+        meta_path = os.path.join(self.path, "index.json")
+        tmp_path = os.path.join(self.path, "index.tmp.json")
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, meta_path)
+        stat = os.stat(meta_path)
+        self.saved, self.meta_key = meta, (stat.st_ino, stat.st_mtime_ns)
+        if saved and saved['training'] and saved['training'] != meta['training']:
+            VectorIndex.remove_files(self.path, [f"centroids-{saved['training']}.npy",
+                                                 f"assignments-{saved['training']}.bin"])
+        if saved and saved['epoch'] != meta['epoch']:
+            VectorIndex.remove_files(self.path, VectorIndex.files(saved['epoch'])
+                                     + [f"documents-{saved['epoch']}.jsonl"])
+
+    def _add_vectors(self, vectors, texts, metadatas):
+        ids = [uuid.uuid4().hex for _ in texts]
+        with self.lock:
+            self._refresh()
+            if self.index is None:
+                self.index = VectorIndex(len(vectors[0]), self.dtype, self.kind, self.ivf_threshold, self.nprobe)
+            positions = self.index.add(vectors)
+            for position, text, metadata, document_id in zip(positions, texts, metadatas, ids):
+                self.documents.append({'id': document_id, 'text': text, 'metadata': metadata})
+                self.positions[document_id] = int(position)
+            self._save()
+        return ids
+
+    def add_texts(self, texts, metadatas=None, **kwargs):
+        texts = list(texts)
+        if not texts:
+            return []
+        metadatas = list(metadatas) if metadatas is not None else [{} for _ in texts]
+        return self._add_vectors(self._embedding.embed_documents(texts), texts, metadatas)
+
+    def _remove(self, positions):
+        self.index.remove(positions)
+        documents = list(self.documents)
+        for position in positions:
+            self.positions.pop(documents[position]['id'], None)
+            documents[position] = None
+        self.documents = documents
+        self._save()
+
+    def delete(self, ids=None, **kwargs):
+        with self.lock:
+            self._refresh()
+            if self.index is None:
+                return True
+            positions = [self.positions[document_id] for document_id in ids or [] if document_id in self.positions]
+            if positions:
+                self._remove(positions)
+        return True
+
+    def compact(self):
+        """Rewrites the index without its removed rows once they make up compact_ratio of it.
+        Returns the number of rows dropped"""
+        with self.lock:
+            self._refresh()
+            if self.index is None or self.compact_ratio is None:
+                return 0
+            dropped = len(self.index.vectors) - len(self.index)
+            if not dropped or dropped < self.compact_ratio * len(self.index.vectors):
+                return 0
+            kept = self.index.compact()
+            self.documents = [self.documents[position] for position in kept]
+            self.positions = {document['id']: position for position, document in enumerate(self.documents)}
+            self._save()
+        return dropped
+
+    def _file_positions(self, file_id, file_hash=None, keep_hash=None):
+        return [position for position, document in enumerate(self.documents)
+                if document is not None and document['metadata'].get('file_id') == file_id
+                and (file_hash is None or document['metadata'].get('file_hash') == file_hash)
+                and (keep_hash is None or document['metadata'].get('file_hash') != keep_hash)]
+
+    def delete_file(self, file_id, keep_hash=None):
+        """Removes the chunks of a GridFS file, except the ones of the version with keep_hash"""
+        with self.lock:
+            self._refresh()
+            positions = self._file_positions(file_id, keep_hash=keep_hash)
+            if positions:
+                self._remove(positions)
+
+    def delete_version(self, file_id, file_hash):
+        """Removes the chunks of one version of a GridFS file"""
+        with self.lock:
+            self._refresh()
+            positions = self._file_positions(file_id, file_hash=file_hash)
+            if positions:
+                self._remove(positions)
+
+    def delete_unassigned(self):
+        """Removes chunks which are not linked to a GridFS file"""
+        with self.lock:
+            self._refresh()
+            positions = [position for position, document in enumerate(self.documents)
+                         if document is not None and 'file_id' not in document['metadata']]
+            if positions:
+                self._remove(positions)
+
+    def copy_file(self, source_file_id, file_id, filename, file_hash):
+        """Stores the chunks of one file again for another file with the same content, without embedding"""
+        with self.lock:
+            self._refresh()
+            positions = self._file_positions(source_file_id)
+            if not positions:
+                return False
+            vectors = self.index.decode(np.array(positions))
+            texts = [self.documents[position]['text'] for position in positions]
+            metadatas = [dict(self.documents[position]['metadata'], file_id=file_id, filename=filename,
+                              source=filename, file_hash=file_hash) for position in positions]
+        self._add_vectors(vectors, texts, metadatas)
+        return True
+
+    def _snapshot(self):
+        """Index and documents of one state, taken after loading the changes of other processes"""
+        with self.lock:
+            reloaded = self._refresh()
+            index = self.index.snapshot() if self.index is not None else None
+            documents = self.documents
+        if reloaded and self.on_reload is not None:
+            self.on_reload()
+        return index, documents
+
+    def chunks(self):
+        """All stored chunks as Documents"""
+        _, documents = self._snapshot()
+        return [Document(page_content=document['text'], metadata=document['metadata'])
+                for document in documents if document is not None]
+
+    def similarity_search_by_vectors(self, vectors, k=4):
+        """Batched top-k: a list of (Document, score) lists, one per query vector"""
+        index, documents = self._snapshot()
+        if index is None or not len(vectors):
+            return [[] for _ in vectors]
+        results = []
+        for positions, scores in index.search(vectors, k):
+            results.append([(Document(page_content=documents[position]['text'],
+                                      metadata=documents[position]['metadata']), score)
+                            for position, score in zip(positions, scores)])
+        return results
+
+    def batch_similarity_search(self, queries, k=4):
+        """Embeds all queries as questions and searches them together"""
+        queries = list(queries)
+        embed_queries = getattr(self._embedding, 'embed_queries', None)
+        if embed_queries is not None:
+            vectors = embed_queries(queries)
+        else:
+            vectors = [self._embedding.embed_query(query) for query in queries]
+        return self.similarity_search_by_vectors(vectors, k)
+
+    def similarity_search_with_score(self, query, k=4, **kwargs):
+        return self.similarity_search_by_vectors([self._embedding.embed_query(query)], k)[0]
+
+    def similarity_search_by_vector(self, embedding, k=4, **kwargs):
+        return [document for document, _ in self.similarity_search_by_vectors([embedding], k)[0]]
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return [document for document, _ in self.similarity_search_with_score(query, k, **kwargs)]
+
+    def _select_relevance_score_fn(self):
+        # cosine similarity in [-1, 1] to a relevance in [0, 1]
+        return lambda score: (score + 1) / 2
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, **kwargs):
+        store = cls(embedding, **kwargs)
+        store.add_texts(texts, metadatas)
+        return store
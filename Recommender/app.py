@@ -1,13 +1,29 @@
+import functools
+import json
+import click
 import requests
-from flask import Flask, render_template, jsonify, request, Response, abort
+from flask import Flask, render_template, jsonify, request, Response, abort, stream_with_context
 from neo4j import GraphDatabase
 import neo4j.time
 from dotenv import load_dotenv
 import os
+import sys
+import threading
+import time
 
 from rdflib_neo4j import Neo4jStoreConfig, HANDLE_VOCAB_URI_STRATEGY, Neo4jStore
 from rdflib import Graph
 
+import bulk_loader
+import import_manifest
+from graph_snapshot import SnapshotManager
+from response_cache import ResponseCache
+from text_index import TextIndex
+
+#instrumentation.py is shared by the services in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import instrumentation
+
 app = Flask(__name__)
 
 #Load Configuration from .env file
@@ -17,6 +33,12 @@ AURA_DB_USERNAME = os.getenv("AURA_DB_USERNAME")
 AURA_DB_PWD = os.getenv("AURA_DB_PWD")
 driver = GraphDatabase.driver(AURA_DB_URI, auth=(AURA_DB_USERNAME, AURA_DB_PWD))
 
+#Requests slower than this are logged with their stage breakdown, metrics are served on /metrics
+SLOW_REQUEST_SECONDS = float(os.getenv("SLOW_REQUEST_SECONDS", 2))
+#Responses up to this size get an ETag, the gateway does not cache larger responses anyway
+ETAG_MAX_MB = int(os.getenv("ETAG_MAX_MB", 4))
+instrumentation.Instrumentation(app, "recommender", SLOW_REQUEST_SECONDS)
+
 auth_data = {'uri': AURA_DB_URI,
              'database': "neo4j",
              'user': AURA_DB_USERNAME,
@@ -26,16 +48,127 @@ config = Neo4jStoreConfig(auth_data=auth_data,
                           handle_vocab_uri_strategy=HANDLE_VOCAB_URI_STRATEGY.IGNORE,
                           batching=True)
 
-neo4j_aura = Graph(store=Neo4jStore(config=config))
-
 #dataset to download from the web // rdf file format
 #dataset = "https://old.datahub.io/dataset/92481a73-d12e-4565-98a0-41d737d3e09a/resource/34b9eac2-96db-4afa-ba3f-a33f21f1b2b2/download/gdpr.rdf"
 
 #Locally downloaded from https://github.com/coolharsh55/GDPRtEXT/blob/master/gdpr.rdf
 dataset = "./static/gdpr.rdf"
+dataset_name = "gdpr"
+
+#Loader used for the import: "bulk" (batched UNWIND queries) or "rdflib" (rdflib_neo4j Neo4jStore)
+GDPR_LOADER = os.getenv("GDPR_LOADER", "bulk")
+GDPR_BATCH_SIZE = int(os.getenv("GDPR_BATCH_SIZE", 5000))
+GDPR_LOADER_WORKERS = int(os.getenv("GDPR_LOADER_WORKERS", 1))
+GDPR_CACHE_DIR = os.getenv("GDPR_CACHE_DIR", "./cache")
+
+
+def loader_settings(loader):
+    """Everything which influences the imported graph is part of the import manifest hash"""
+    return {'loader': loader,
+            'format': "xml",
+            'handle_vocab_uri_strategy': HANDLE_VOCAB_URI_STRATEGY.IGNORE.name,
+            'batching': True}
+
+
+def import_dataset(force=False, loader=GDPR_LOADER):
+    """Import the GDPR dataset into Neo4j unless the manifest shows that it is already loaded.
+    Returns the loader statistics or None if the import was skipped"""
+    settings = loader_settings(loader)
+    fingerprint = import_manifest.dataset_fingerprint(dataset, settings)
+    manifest = import_manifest.read_manifest(driver, dataset_name)
+    if not force and manifest is not None and manifest['hash'] == fingerprint:
+        return None
+
+    if loader == "bulk":
+        stats = bulk_loader.bulk_load(driver, dataset, fingerprint, GDPR_CACHE_DIR, database=auth_data['database'],
+                                      batch_size=GDPR_BATCH_SIZE, workers=GDPR_LOADER_WORKERS,
+                                      rdf_format=settings['format'])
+    else:
+        #Neo4jStore is write only, so the triples are counted outside of the timed import
+        triples = len(Graph().parse(dataset, format=settings['format']))
+        start = time.perf_counter()
+        neo4j_aura = Graph(store=Neo4jStore(config=config))
+        neo4j_aura.parse(dataset, format=settings['format'])
+        neo4j_aura.close(True)
+        seconds = time.perf_counter() - start
+        stats = {'loader': "rdflib",
+                 'triples': triples,
+                 'seconds': round(seconds, 3),
+                 'triples_per_second': round(triples / seconds) if seconds else None}
+
+    import_manifest.write_manifest(driver, dataset_name, fingerprint)
+    app.logger.info("Imported %s: %s", dataset, stats)
+    return stats
+
+
+def serving():
+    """False for flask CLI commands other than run, like reload-gdpr, which import the dataset themselves"""
+    context = click.get_current_context(silent=True)
+    return context is None or context.info_name == "run"
+
+
+if serving():
+    import_dataset()
+
+
+@app.cli.command("reload-gdpr")
+@click.option("--loader", type=click.Choice(["bulk", "rdflib"]), default=GDPR_LOADER,
+              help="Loader used for the import, to compare the throughput of both")
+def reload_gdpr(loader):
+    """Force a new import of the GDPR dataset into Neo4j"""
+    stats = import_dataset(force=True, loader=loader)
+    click.echo(f"Imported {stats['triples']} triples from {dataset} with the {loader} loader "
+               f"in {stats['seconds']}s ({stats['triples_per_second']} triples/s)")
+
+
+def dataset_generation():
+    """Generation of the loaded dataset, increased by every import"""
+    manifest = import_manifest.read_manifest(driver, dataset_name)
+    return manifest['generation'] if manifest else None
+
+
+#The graph is static after the import, so reads are answered from an in-memory snapshot
+SNAPSHOT_CHECK_INTERVAL = float(os.getenv("SNAPSHOT_CHECK_INTERVAL", 30))
+#A failed snapshot build (Neo4j down, graph too large) is retried after this many seconds at the earliest
+SNAPSHOT_RETRY_INTERVAL = float(os.getenv("SNAPSHOT_RETRY_INTERVAL", 60))
+
+
+def build_text_index(snapshot):
+    """The full-text index is built together with every snapshot, before it is swapped in"""
+    snapshot.text_index = TextIndex(snapshot)
 
-neo4j_aura = neo4j_aura.parse(dataset, format="xml")
-neo4j_aura.close(True)
+
+snapshots = SnapshotManager(driver, dataset_generation, check_interval=SNAPSHOT_CHECK_INTERVAL,
+                            prepare=build_text_index, retry_interval=SNAPSHOT_RETRY_INTERVAL)
+try:
+    snapshots.build()
+except Exception as e:
+    app.logger.warning("Graph snapshot could not be built, falling back to Neo4j: %s", e)
+
+
+#Read responses only depend on the query and the loaded dataset generation
+RESPONSE_CACHE_BYTES = int(os.getenv("RESPONSE_CACHE_BYTES", 64 * 1024 * 1024))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", 3600))
+response_cache = ResponseCache(RESPONSE_CACHE_BYTES, RESPONSE_CACHE_TTL)
+
+
+def cached_response(view):
+    """Serves GET JSON responses from the response cache, keyed on the path and the sorted query parameters"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method != 'GET' or request.args.get('format') == 'ndjson':
+            return view(*args, **kwargs)
+        key = (request.path, tuple(sorted(request.args.items(multi=True))))
+        generation = snapshots.current_generation()
+        body = response_cache.get(key, generation)
+        if body is not None:
+            return Response(body, mimetype='application/json')
+        response = app.make_response(view(*args, **kwargs))
+        # errors are answered with 4xx / 5xx, so only data is cached
+        if response.status_code == 200 and response.mimetype == 'application/json':
+            response_cache.put(key, generation, response.get_data())
+        return response
+    return wrapper
 
 
 @app.before_request
@@ -44,6 +177,18 @@ def limit_remote_addr():
         abort(403)
 
 
+@app.after_request
+def conditional_response(response):
+    """ETag on buffered GET responses, a matching If-None-Match is answered with 304 Not Modified.
+    Streamed responses and responses with their own ETag are left alone, bodies above ETAG_MAX_MB are not hashed"""
+    if request.method == 'GET' and response.status_code == 200 and not response.is_streamed \
+            and not response.direct_passthrough and 'ETag' not in response.headers \
+            and (response.content_length or 0) <= ETAG_MAX_MB * 1024 * 1024:
+        response.add_etag()
+        response.make_conditional(request)
+    return response
+
+
 def serialize_neo4j_value(value):
     """"**Serialize neo4j value"""
     if isinstance(value, (neo4j.time.Date, neo4j.time.DateTime)):
@@ -62,11 +207,6 @@ def serialize_node(node):
 
 def serialize_relationship(rel):
     """Serialize the relationships"""
-
-    test = {k: serialize_neo4j_value(v) for k, v in rel.items()}
-    for key in test:
-        print(key)
-
     return {
         'id': rel.id,
         'startNode': rel.start_node.id,
@@ -76,105 +216,399 @@ def serialize_relationship(rel):
     }
 
 
+#Labels which can be selected as filter for the graph
+VALID_FILTERS = [
+    "Article", "Chapter", "Citation", "LR", "LRS", "LegalResourceSubdivision", "Point", "Policy", "Recital",
+    "Resource", "Section", "SubPoint"
+]
+
+#Upper bound for the page size of /graph
+MAX_GRAPH_LIMIT = int(os.getenv("MAX_GRAPH_LIMIT", 5000))
+
+
 @app.route('/')
 def index():
     """basic buildup of the GDPR home"""
-    valid_filters = [
-        "Article", "Chapter", "Citation", "LR", "LRS", "LegalResourceSubdivision", "Point", "Policy", "Recital",
-        "Resource", "Section", "SubPoint"
-    ]
-    return render_template('index.html', valid_filters=valid_filters)
+    return render_template('index.html', valid_filters=VALID_FILTERS)
+
+
+def graph_records(filter_value, node_id, cursor, limit):
+    """Yields serialized (node, relationship, node) triples ordered by relationship id.
+    Answers from the snapshot if possible, otherwise the Neo4j result is consumed while yielding"""
+    snapshot = snapshots.get()
+    if snapshot is not None:
+        if filter_value:
+            records = snapshot.graph_by_label(filter_value)
+        else:
+            records = snapshot.graph_by_id(node_id)
+        records.sort(key=lambda record: snapshot.rel_ids[record[1]])
+        if cursor is not None:
+            records = [record for record in records if snapshot.rel_ids[record[1]] > cursor]
+        if limit is not None:
+            records = records[:limit]
+        for n, r, m in records:
+            yield snapshot.serialize_node(n), snapshot.serialize_relationship(r), snapshot.serialize_node(m)
+        return
 
-
-@app.route('/graph')
-def get_graph():
-    """Buidling the graph"""
-    filter_value = request.args.get('filter')
-    node_id = request.args.get('id')
     if filter_value:
+        #filter_value is one of VALID_FILTERS, labels cannot be passed as parameter
         query = f"""
         MATCH (n:{filter_value})-[r]->(m)
+        WHERE $cursor IS NULL OR id(r) > $cursor
         RETURN n, r, m
+        ORDER BY id(r)
         """
-    elif node_id:
-        query = f"""
+    else:
+        query = """
         MATCH (n)-[r]->(m)
-        WHERE id(n) = {node_id}
+        WHERE id(n) = $node_id AND ($cursor IS NULL OR id(r) > $cursor)
         RETURN n, r, m
+        ORDER BY id(r)
         """
-    else:
-        return jsonify({'error': 'No filter or ID provided'})
+    if limit is not None:
+        query += "LIMIT $limit"
+
+    with driver.session() as session:
+        # the records are streamed, the stage covers the query until its first records
+        with instrumentation.stage("neo4j"):
+            result = session.run(query, node_id=node_id, cursor=cursor, limit=limit)
+        for record in result:
+            yield serialize_node(record['n']), serialize_relationship(record['r']), serialize_node(record['m'])
+
 
-    nodes = []
+@app.route('/graph')
+@cached_response
+def get_graph():
+    """Buidling the graph
+
+    Nodes are only returned once. Optional parameters:
+    limit / cursor - page through the relationships, the next cursor is returned as next_cursor
+    format=ndjson - stream one {"node"} or {"relationship"} object per line, closed by {"next_cursor"}"""
+    filter_value = request.args.get('filter')
+    node_id = request.args.get('id')
+    if filter_value:
+        if filter_value not in VALID_FILTERS:
+            return jsonify({'error': 'Invalid filter provided'}), 400
+        node_id = None
+    elif node_id:
+        try:
+            node_id = int(node_id)
+        except ValueError:
+            return jsonify({'error': 'Invalid ID provided'}), 400
+    else:
+        return jsonify({'error': 'No filter or ID provided'}), 400
+
+    limit = request.args.get('limit', type=int)
+    cursor = request.args.get('cursor', type=int)
+    if limit is not None:
+        limit = max(1, min(limit, MAX_GRAPH_LIMIT))
+
+    records = graph_records(filter_value, node_id, cursor, limit)
+
+    if request.args.get('format') == 'ndjson':
+        def generate():
+            seen = set()
+            count = 0
+            last_id = None
+            for n, r, m in records:
+                for node in (n, m):
+                    if node['id'] not in seen:
+                        seen.add(node['id'])
+                        yield json.dumps({'node': node}, default=str) + "\n"
+                yield json.dumps({'relationship': r}, default=str) + "\n"
+                count += 1
+                last_id = r['id']
+            next_cursor = last_id if limit is not None and count == limit else None
+            yield json.dumps({'next_cursor': next_cursor}) + "\n"
+
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    nodes = {}
     relationships = []
     try:
-        with driver.session() as session:
-            result = session.run(query)
-            for record in result:
-                n = record['n']
-                r = record['r']
-                m = record['m']
-
-                nodes.append(serialize_node(n))
-                nodes.append(serialize_node(m))
-                relationships.append(serialize_relationship(r))
+        for n, r, m in records:
+            nodes.setdefault(n['id'], n)
+            nodes.setdefault(m['id'], m)
+            relationships.append(r)
     except Exception as e:
-        return e, 404
+        return jsonify({'error': str(e)}), 404
 
-    return jsonify({
-        'nodes': list(nodes),
+    response = {
+        'nodes': list(nodes.values()),
         'relationships': relationships
-    })
+    }
+    if limit is not None:
+        response['next_cursor'] = relationships[-1]['id'] if len(relationships) == limit else None
+    return jsonify(response)
+
+
+#Upper bound for the number of node ids of one batch request
+MAX_BATCH_IDS = int(os.getenv("MAX_BATCH_IDS", 500))
+
+DIRECTIONS = ('both', 'incoming', 'outgoing')
+
+NODE_RELATIONSHIPS_QUERY = """
+UNWIND $ids AS node_id
+MATCH (n)
+WHERE id(n) = node_id
+OPTIONAL MATCH (n)<-[ri]-(mi)
+WHERE $incoming AND ($types IS NULL OR type(ri) IN $types)
+WITH n, node_id, [x IN collect({r: ri, m: mi}) WHERE x.r IS NOT NULL] AS incoming
+OPTIONAL MATCH (n)-[ro]->(mo)
+WHERE $outgoing AND ($types IS NULL OR type(ro) IN $types)
+RETURN node_id, incoming, [x IN collect({r: ro, m: mo}) WHERE x.r IS NOT NULL] AS outgoing
+"""
+
+
+def node_relationships(ids, direction='both', types=None):
+    """Incoming and outgoing neighbours of all given node ids, answered with a single query"""
+    result = {node_id: {'incoming': [], 'outgoing': []} for node_id in ids}
+    snapshot = snapshots.get()
+    if snapshot is not None:
+        for node_id in ids:
+            incoming_rels, outgoing_rels = snapshot.node_relationships(node_id, direction, types)
+            result[node_id] = {'incoming': incoming_rels, 'outgoing': outgoing_rels}
+        return result
+
+    with instrumentation.stage("neo4j"), driver.session() as session:
+        records = session.run(NODE_RELATIONSHIPS_QUERY, ids=list(ids), types=types,
+                              incoming=direction in ('both', 'incoming'),
+                              outgoing=direction in ('both', 'outgoing'))
+        for record in records:
+            result[record['node_id']] = {
+                'incoming': [{
+                    'id': rel['r'].id,
+                    'type': rel['r'].type,
+                    'startNode': rel['m'].id,
+                    'properties': {k: serialize_neo4j_value(v) for k, v in rel['m'].items()}
+                } for rel in record['incoming']],
+                'outgoing': [{
+                    'id': rel['r'].id,
+                    'type': rel['r'].type,
+                    'endNode': rel['m'].id,
+                    'properties': {k: serialize_neo4j_value(v) for k, v in rel['m'].items()}
+                } for rel in record['outgoing']]
+            }
+    return result
+
+
+def split_list(value):
+    """Comma separated query parameter as list"""
+    return [item for item in value.split(',') if item] if value else []
 
 
 @app.route('/node_relationships')
+@cached_response
 def get_node_relationships():
-    """"""
-    node_id = int(request.args.get('node_id'))
-    incoming_rels = []
-    outgoing_rels = []
+    """Incoming and outgoing relationships of a single node"""
     try:
-        with driver.session() as session:
-            query_incoming = """
-            MATCH (n)<-[r]-(m)
-            WHERE id(n) = $node_id
-            RETURN r, m
-            """
-            result_incoming = session.run(query_incoming, node_id=node_id)
-            for record in result_incoming:
-                rel = record['r']
-                start_node = record['m']
-                information_incoming = {
-                    'id': rel.id,
-                    'type': rel.type,
-                    'startNode': start_node.id,
-                    'properties': {k: serialize_neo4j_value(v) for k, v in start_node.items()}
-                }
-                incoming_rels.append(information_incoming)
-
-            query_outgoing = """
-            MATCH (n)-[r]->(m)
-            WHERE id(n) = $node_id
-            RETURN r, m
-            """
-            result_outgoing = session.run(query_outgoing, node_id=node_id)
-            for record in result_outgoing:
-                rel = record['r']
-                end_node = record['m']
-                information_outgoing = {
-                    'id': rel.id,
-                    'type': rel.type,
-                    'endNode': end_node.id,
-                    'properties': {k: serialize_neo4j_value(v) for k, v in end_node.items()}
-                }
-                outgoing_rels.append(information_outgoing)
+        node_id = int(request.args.get('node_id'))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid node ID provided'}), 400
+    try:
+        relationships = node_relationships([node_id])[node_id]
     except Exception as e:
-        return e, 404
+        return jsonify({'error': str(e)}), 404
+
+    return jsonify(relationships)
+
+
+@app.route('/node_relationships/batch', methods=['GET', 'POST'])
+@cached_response
+def get_node_relationships_batch():
+    """Incoming and outgoing relationships of several nodes
+
+    Parameters as query string (ids=1,2,3&direction=outgoing&types=hasArticle,hasRecital)
+    or as JSON body ({"ids": [1, 2, 3], "direction": "outgoing", "types": ["hasArticle"]})"""
+    if request.method == 'POST':
+        parameters = request.get_json(silent=True) or {}
+        ids = parameters.get('ids', [])
+        direction = parameters.get('direction', 'both')
+        types = parameters.get('types') or None
+        # a JSON string would otherwise be read character by character
+        if not isinstance(ids, list) or not all(isinstance(node_id, (int, str)) and not isinstance(node_id, bool)
+                                                for node_id in ids):
+            return jsonify({'error': 'ids has to be a list of node IDs'}), 400
+        if types is not None and not (isinstance(types, list) and all(isinstance(t, str) for t in types)):
+            return jsonify({'error': 'types has to be a list of strings'}), 400
+    else:
+        ids = split_list(request.args.get('ids'))
+        direction = request.args.get('direction', 'both')
+        types = split_list(request.args.get('types')) or None
+
+    try:
+        ids = list(dict.fromkeys(int(node_id) for node_id in ids))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid node ID provided'}), 400
+    if not ids:
+        return jsonify({'error': 'No IDs provided'}), 400
+    if len(ids) > MAX_BATCH_IDS:
+        return jsonify({'error': f'At most {MAX_BATCH_IDS} IDs can be requested at once'}), 400
+    if direction not in DIRECTIONS:
+        return jsonify({'error': 'Invalid direction provided'}), 400
+
+    try:
+        relationships = node_relationships(ids, direction, types)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 404
+
+    return jsonify({str(node_id): rels for node_id, rels in relationships.items()})
+
+
+#Limits of the traversal endpoints, so a single request cannot walk the whole graph
+MAX_HOPS = int(os.getenv("MAX_HOPS", 6))
+MAX_NEIGHBOURHOOD_NODES = int(os.getenv("MAX_NEIGHBOURHOOD_NODES", 2000))
+MAX_PATH_VISITED = int(os.getenv("MAX_PATH_VISITED", 50000))
+
+
+def traversal_filters():
+    """direction, labels and types parameters shared by the traversal endpoints"""
+    direction = request.args.get('direction', 'both')
+    labels = set(split_list(request.args.get('labels'))) or None
+    types = set(split_list(request.args.get('types'))) or None
+    return direction, labels, types
+
+
+def serialize_subgraph(snapshot, nodes, edges):
+    return {
+        'nodes': [snapshot.serialize_node(index) for index in nodes],
+        'relationships': [snapshot.serialize_relationship(edge) for edge in edges]
+    }
+
+
+@app.route('/neighbourhood')
+@cached_response
+def get_neighbourhood():
+    """k-hop neighbourhood of a node
+
+    Parameters: node_id, hops (default 1), max_nodes, direction (both, incoming, outgoing),
+    labels and types as comma separated lists"""
+    node_id = request.args.get('node_id', type=int)
+    hops = request.args.get('hops', 1, type=int)
+    max_nodes = request.args.get('max_nodes', MAX_NEIGHBOURHOOD_NODES, type=int)
+    direction, labels, types = traversal_filters()
+    if node_id is None:
+        return jsonify({'error': 'No node ID provided'}), 400
+    if direction not in DIRECTIONS:
+        return jsonify({'error': 'Invalid direction provided'}), 400
+    hops = max(1, min(hops, MAX_HOPS))
+    max_nodes = max(1, min(max_nodes, MAX_NEIGHBOURHOOD_NODES))
+
+    snapshot = snapshots.get()
+    if snapshot is None:
+        return jsonify({'error': 'Graph snapshot is not available yet'}), 503
+
+    result = snapshot.neighbourhood(node_id, hops, max_nodes, direction, labels, types)
+    if result is None:
+        return jsonify({'error': 'Node not found'}), 404
+    nodes, edges, truncated = result
+    response = serialize_subgraph(snapshot, nodes, edges)
+    response['truncated'] = truncated
+    return jsonify(response)
+
+
+@app.route('/shortest_path')
+@cached_response
+def get_shortest_path():
+    """Shortest path between two nodes
+
+    Parameters: source, target, max_hops (default MAX_HOPS), direction (both, incoming, outgoing),
+    labels and types as comma separated lists"""
+    source = request.args.get('source', type=int)
+    target = request.args.get('target', type=int)
+    max_hops = request.args.get('max_hops', MAX_HOPS, type=int)
+    direction, labels, types = traversal_filters()
+    if source is None or target is None:
+        return jsonify({'error': 'Source and target ID have to be provided'}), 400
+    if direction not in DIRECTIONS:
+        return jsonify({'error': 'Invalid direction provided'}), 400
+    max_hops = max(1, min(max_hops, MAX_HOPS))
+
+    snapshot = snapshots.get()
+    if snapshot is None:
+        return jsonify({'error': 'Graph snapshot is not available yet'}), 503
+
+    result = snapshot.shortest_path(source, target, max_hops, MAX_PATH_VISITED, direction, labels, types)
+    if result is None:
+        return jsonify({'error': f'No path found within {max_hops} hops'}), 404
+    nodes, edges = result
+    response = serialize_subgraph(snapshot, nodes, edges)
+    response['length'] = len(edges)
+    return jsonify(response)
+
+
+def current_text_index(snapshot):
+    """Returns the text index of the snapshot or None if there is no current snapshot"""
+    if snapshot is None:
+        return None
+    return snapshot.text_index
+
+
+@app.route('/search')
+@cached_response
+def search():
+    """Ranked full-text search over Articles, Recitals, Points and SubPoints
+
+    Parameters: q, limit (default 10), labels as comma separated list"""
+    query = request.args.get('q', '').strip()
+    limit = max(1, min(request.args.get('limit', 10, type=int), MAX_GRAPH_LIMIT))
+    labels = set(split_list(request.args.get('labels'))) or None
+    if not query:
+        return jsonify({'error': 'No search query provided'}), 400
+
+    snapshot = snapshots.get()
+    index = current_text_index(snapshot)
+    if snapshot is None or index is None:
+        return jsonify({'error': 'Search index is not available yet'}), 503
+
+    results = []
+    for node, score in index.search(query, limit, labels, snapshot):
+        result = snapshot.serialize_node(node)
+        result['score'] = round(score, 4)
+        result.update(index.citations(result['id']))
+        results.append(result)
+    return jsonify({'query': query, 'results': results})
+
+
+@app.route('/citations')
+@cached_response
+def citations():
+    """Articles cited by a Recital, or Recitals citing an Article"""
+    node_id = request.args.get('node_id', type=int)
+    if node_id is None:
+        return jsonify({'error': 'No node ID provided'}), 400
+
+    index = current_text_index(snapshots.get())
+    if index is None:
+        return jsonify({'error': 'Search index is not available yet'}), 503
+
+    return jsonify(index.citations(node_id))
+
+
+@app.route('/cache_stats')
+def cache_stats():
+    """Hit, miss and eviction counters of the response cache"""
+    stats = response_cache.stats()
+    stats['generation'] = snapshots.generation
+    return jsonify(stats)
+
+
+#Label views which are loaded into the response cache at startup
+PREWARM_FILTERS = split_list(os.getenv("PREWARM_FILTERS", ",".join(VALID_FILTERS)))
+
+
+def prewarm_cache():
+    """Fills the response cache with the label views of the graph, runs in the background after startup"""
+    try:
+        for filter_value in PREWARM_FILTERS:
+            with app.test_request_context('/graph', query_string={'filter': filter_value}):
+                get_graph()
+    except Exception as e:
+        app.logger.warning("Response cache could not be pre-warmed: %s", e)
+
 
-    return jsonify({
-        'incoming': incoming_rels,
-        'outgoing': outgoing_rels
-    })
+if serving():
+    threading.Thread(target=prewarm_cache, name="prewarm-cache", daemon=True).start()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,116 @@
+"""Compares the bounded BFS of the graph snapshot with the equivalent Cypher queries on gdpr.rdf
+
+Run from the Recommender folder after the dataset was imported:
+    python benchmarks/traversal.py
+With --offline the snapshot is built from the parsed RDF file and only the BFS side is measured.
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from graph_snapshot import GraphSnapshot  # noqa: E402
+
+NEIGHBOURHOOD_QUERY = """
+MATCH (n)-[*1..{hops}]-(m)
+WHERE id(n) = $node_id
+RETURN count(DISTINCT m) AS nodes
+"""
+
+SHORTEST_PATH_QUERY = """
+MATCH (a), (b)
+WHERE id(a) = $source AND id(b) = $target
+MATCH p = shortestPath((a)-[*..{hops}]-(b))
+RETURN length(p) AS length
+"""
+
+
+def offline_snapshot(dataset):
+    import bulk_loader
+    parsed = bulk_loader.parse_dataset(dataset)
+    nodes = []
+    for label_set, rows in parsed['nodes'].items():
+        for index, props in rows:
+            nodes.append((index, list(label_set) + ["Resource"], dict(props, uri=parsed['uris'][index])))
+    relationships = []
+    for rel_type, pairs in parsed['edges'].items():
+        for s, o in pairs:
+            relationships.append((len(relationships), s, o, rel_type, {}))
+    return GraphSnapshot(0, nodes, relationships)
+
+
+def timed(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def report(name, timings):
+    timings = sorted(timings)
+    p95 = timings[int(len(timings) * 0.95) - 1] if len(timings) > 1 else timings[0]
+    print(f"{name:<32} median {statistics.median(timings):8.3f} ms   p95 {p95:8.3f} ms   n={len(timings)}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataset", default="./static/gdpr.rdf")
+    parser.add_argument("--hops", type=int, default=2)
+    parser.add_argument("--samples", type=int, default=50)
+    parser.add_argument("--offline", action="store_true")
+    args = parser.parse_args()
+
+    driver = None
+    if args.offline:
+        snapshot = offline_snapshot(args.dataset)
+    else:
+        from dotenv import load_dotenv
+        from neo4j import GraphDatabase
+        load_dotenv()
+        driver = GraphDatabase.driver(os.getenv("AURA_DB_URI"),
+                                      auth=(os.getenv("AURA_DB_USERNAME"), os.getenv("AURA_DB_PWD")))
+        start = time.perf_counter()
+        snapshot = GraphSnapshot.from_neo4j(driver, None)
+        print(f"snapshot built from Neo4j in {time.perf_counter() - start:.2f}s")
+    print(f"{len(snapshot)} nodes, {len(snapshot.rel_ids)} relationships")
+
+    random.seed(42)
+    articles = list(snapshot.label_nodes.get("Article", ()))
+    recitals = list(snapshot.label_nodes.get("Recital", ()))
+    starts = [snapshot.node_ids[random.choice(articles)] for _ in range(args.samples)]
+    pairs = [(snapshot.node_ids[random.choice(articles)], snapshot.node_ids[random.choice(recitals)])
+             for _ in range(args.samples)]
+
+    bfs_neighbourhood = []
+    bfs_path = []
+    for node_id in starts:
+        bfs_neighbourhood += timed(lambda: snapshot.neighbourhood(node_id, args.hops, 10 ** 6), 1)
+    for source, target in pairs:
+        bfs_path += timed(lambda: snapshot.shortest_path(source, target, 6, 10 ** 6), 1)
+    report(f"BFS {args.hops}-hop neighbourhood", bfs_neighbourhood)
+    report("BFS shortest path", bfs_path)
+
+    if driver is None:
+        return
+    cypher_neighbourhood = []
+    cypher_path = []
+    with driver.session() as session:
+        for node_id in starts:
+            query = NEIGHBOURHOOD_QUERY.format(hops=args.hops)
+            cypher_neighbourhood += timed(lambda: session.run(query, node_id=node_id).consume(), 1)
+        for source, target in pairs:
+            query = SHORTEST_PATH_QUERY.format(hops=6)
+            cypher_path += timed(lambda: session.run(query, source=source, target=target).consume(), 1)
+    report(f"Cypher {args.hops}-hop neighbourhood", cypher_neighbourhood)
+    report("Cypher shortest path", cypher_path)
+    driver.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+import os
+import pickle
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+from datetime import time as time_of_day
+
+from rdflib import Graph, BNode, Literal, RDF
+
+# Same uniqueness constraint rdflib_neo4j creates, so both loaders produce an identical graph
+CONSTRAINT_QUERY = "CREATE CONSTRAINT n10s_unique_uri IF NOT EXISTS FOR (r:Resource) REQUIRE r.uri IS UNIQUE"
+
+NEO4J_TYPES = (str, int, float, bool, date, datetime, time_of_day)
+
+
+def local_name(uri):
+    """Strips the namespace of an uri like HANDLE_VOCAB_URI_STRATEGY.IGNORE does"""
+    uri = str(uri)
+    for separator in ('#', '/', ':'):
+        index = uri.rfind(separator)
+        if index != -1 and index < len(uri) - 1:
+            return uri[index + 1:]
+    return uri
+
+
+def escape_name(name):
+    """Labels and relationship types cannot be parameters, so they are quoted for the query"""
+    return '`' + name.replace('`', '``') + '`'
+
+
+def resource_uri(term):
+    """Blank nodes get the same bnode:// uri rdflib_neo4j assigns to them"""
+    if isinstance(term, BNode):
+        return f"bnode://{term}"
+    return str(term)
+
+
+def literal_value(literal):
+    """Converts a literal into a value the neo4j driver can store as property"""
+    value = literal.toPython()
+    if isinstance(value, NEO4J_TYPES):
+        return value
+    return str(literal)
+
+
+def parse_dataset(dataset, rdf_format="xml"):
+    """Parses the RDF file once and groups nodes by label set and edges by relationship type"""
+    graph = Graph()
+    graph.parse(dataset, format=rdf_format)
+
+    uris = []
+    uri_index = {}
+    labels = {}
+    properties = {}
+
+    def node(term):
+        uri = resource_uri(term)
+        index = uri_index.get(uri)
+        if index is None:
+            index = uri_index[uri] = len(uris)
+            uris.append(uri)
+        return index
+
+    edges = {}
+    for subject, predicate, obj in graph:
+        s = node(subject)
+        if predicate == RDF.type and not isinstance(obj, Literal):
+            labels.setdefault(s, set()).add(local_name(obj))
+        elif isinstance(obj, Literal):
+            properties.setdefault(s, {})[local_name(predicate)] = literal_value(obj)
+        else:
+            edges.setdefault(local_name(predicate), []).append((s, node(obj)))
+
+    nodes = {}
+    for index in range(len(uris)):
+        label_set = tuple(sorted(labels.get(index, ())))
+        nodes.setdefault(label_set, []).append((index, properties.get(index, {})))
+
+    return {'triples': len(graph), 'uris': uris, 'nodes': nodes, 'edges': edges}
+
+
+def load_parsed(dataset, fingerprint, cache_dir, rdf_format="xml"):
+    """Returns the grouped triples from the pickle cache and only parses the RDF file on a cache miss"""
+    cache_file = os.path.join(cache_dir, f"{os.path.basename(dataset)}.{fingerprint[:16]}.pickle")
+    if os.path.exists(cache_file):
+        with open(cache_file, "rb") as f:
+            return pickle.load(f)
+
+    parsed = parse_dataset(dataset, rdf_format)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "wb") as f:
+        pickle.dump(parsed, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, cache_file)
+    return parsed
+
+
+def batches(rows, batch_size):
+    for start in range(0, len(rows), batch_size):
+        yield rows[start:start + batch_size]
+
+
+def node_jobs(parsed, batch_size):
+    uris = parsed['uris']
+    for label_set, rows in parsed['nodes'].items():
+        query = """
+        UNWIND $rows AS row
+        MERGE (n:Resource {uri: row.uri})
+        SET n += row.props
+        """
+        if label_set:
+            query += "SET n:" + ":".join(escape_name(label) for label in label_set)
+        for batch in batches(rows, batch_size):
+            yield query, [{'uri': uris[index], 'props': props} for index, props in batch]
+
+
+def edge_jobs(parsed, batch_size):
+    uris = parsed['uris']
+    for rel_type, pairs in parsed['edges'].items():
+        query = f"""
+        UNWIND $rows AS row
+        MATCH (s:Resource {{uri: row.s}})
+        MATCH (o:Resource {{uri: row.o}})
+        MERGE (s)-[:{escape_name(rel_type)}]->(o)
+        """
+        for batch in batches(pairs, batch_size):
+            yield query, [{'s': uris[s], 'o': uris[o]} for s, o in batch]
+
+
+def run_jobs(driver, database, jobs, workers):
+    """Writes every batch in its own transaction, spread over parallel sessions if workers > 1"""
+    def write(job):
+        query, rows = job
+        with driver.session(database=database) as session:
+            session.execute_write(lambda tx: tx.run(query, rows=rows).consume())
+
+    if workers <= 1:
+        for job in jobs:
+            write(job)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # list() re-raises the first failed batch
+        list(executor.map(write, jobs))
+
+
+def bulk_load(driver, dataset, fingerprint, cache_dir, database="neo4j", batch_size=5000, workers=1,
+              rdf_format="xml"):
+    """Imports the dataset with UNWIND batches and reports the throughput in triples per second"""
+    start = time.perf_counter()
+    parsed = load_parsed(dataset, fingerprint, cache_dir, rdf_format)
+    parsed_at = time.perf_counter()
+
+    with driver.session(database=database) as session:
+        session.run(CONSTRAINT_QUERY).consume()
+    # All nodes have to exist before the relationship batches can match them
+    run_jobs(driver, database, node_jobs(parsed, batch_size), workers)
+    run_jobs(driver, database, edge_jobs(parsed, batch_size), workers)
+
+    seconds = time.perf_counter() - start
+    return {'loader': "bulk",
+            'triples': parsed['triples'],
+            'parse_seconds': round(parsed_at - start, 3),
+            'seconds': round(seconds, 3),
+            'triples_per_second': round(parsed['triples'] / seconds) if seconds else None}
@@ -0,0 +1,374 @@
+import logging
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
+import neo4j.time
+
+from import_manifest import MANIFEST_LABEL
+
+logger = logging.getLogger(__name__)
+
+NODES_QUERY = f"""
+MATCH (n)
+WHERE NOT n:{MANIFEST_LABEL}
+RETURN id(n) AS id, labels(n) AS labels, properties(n) AS properties
+"""
+
+RELATIONSHIPS_QUERY = f"""
+MATCH (a)-[r]->(b)
+WHERE NOT a:{MANIFEST_LABEL} AND NOT b:{MANIFEST_LABEL}
+RETURN id(r) AS id, id(a) AS start, id(b) AS end, type(r) AS type, properties(r) AS properties
+"""
+
+
+def serialize_value(value):
+    """Same conversion the endpoints apply to neo4j values"""
+    if isinstance(value, (neo4j.time.Date, neo4j.time.DateTime)):
+        return str(value)
+    return value
+
+
+def build_offsets(keys, count):
+    """CSR offsets: edges of node i are stored at positions offsets[i]:offsets[i + 1]"""
+    offsets = array('q', [0] * (count + 1))
+    for key in keys:
+        offsets[key + 1] += 1
+    for i in range(count):
+        offsets[i + 1] += offsets[i]
+    return offsets
+
+
+class Interner:
+    """Stores every distinct value once and hands out its position"""
+    def __init__(self):
+        self.values = []
+        self.positions = {}
+
+    def add(self, value, key=None):
+        key = value if key is None else key
+        position = self.positions.get(key)
+        if position is None:
+            position = self.positions[key] = len(self.values)
+            self.values.append(value)
+        return position
+
+
+class GraphSnapshot:
+    """Read only copy of the graph with CSR incoming and outgoing adjacency arrays"""
+    def __init__(self, generation, nodes, relationships):
+        self.generation = generation
+        self.created_at = time.time()
+        # full-text index, set by the prepare hook of the SnapshotManager
+        self.text_index = None
+
+        nodes = sorted(nodes, key=lambda node: node[0])
+        self.node_ids = array('q', (node[0] for node in nodes))
+        label_sets = Interner()
+        properties = Interner()
+        self.node_labels = array('l')
+        self.node_properties = array('l')
+        self.label_nodes = {}
+        for index, (node_id, labels, props) in enumerate(nodes):
+            labels = tuple(labels)
+            self.node_labels.append(label_sets.add(labels))
+            self.node_properties.append(self._intern_properties(properties, props))
+            for label in labels:
+                self.label_nodes.setdefault(label, array('l')).append(index)
+
+        relationships = [rel for rel in relationships
+                         if self.index_of(rel[1]) is not None and self.index_of(rel[2]) is not None]
+        relationships.sort(key=lambda rel: rel[0])
+        types = Interner()
+        self.rel_ids = array('q')
+        self.rel_start = array('l')
+        self.rel_end = array('l')
+        self.rel_types = array('l')
+        self.rel_properties = array('l')
+        for rel_id, start, end, rel_type, props in relationships:
+            self.rel_ids.append(rel_id)
+            self.rel_start.append(self.index_of(start))
+            self.rel_end.append(self.index_of(end))
+            self.rel_types.append(types.add(rel_type))
+            self.rel_properties.append(self._intern_properties(properties, props))
+
+        self.label_sets = label_sets.values
+        self.types = types.values
+        self.properties = properties.values
+
+        count = len(self.node_ids)
+        self.out_offsets = build_offsets(self.rel_start, count)
+        self.in_offsets = build_offsets(self.rel_end, count)
+        self.out_edges = self._fill_adjacency(self.rel_start, self.out_offsets)
+        self.in_edges = self._fill_adjacency(self.rel_end, self.in_offsets)
+
+    @staticmethod
+    def _intern_properties(properties, props):
+        props = {k: serialize_value(v) for k, v in props.items()}
+        try:
+            key = tuple(sorted(props.items()))
+            hash(key)
+        except TypeError:
+            # list properties are not hashable and are stored without sharing
+            key = ('unshared', len(properties.values))
+        return properties.add(props, key)
+
+    @staticmethod
+    def _fill_adjacency(keys, offsets):
+        edges = array('l', [0] * len(keys))
+        cursor = array('q', offsets[:-1])
+        for edge, key in enumerate(keys):
+            edges[cursor[key]] = edge
+            cursor[key] += 1
+        return edges
+
+    @classmethod
+    def from_neo4j(cls, driver, generation):
+        with driver.session() as session:
+            nodes = [(record['id'], record['labels'], record['properties'])
+                     for record in session.run(NODES_QUERY)]
+            relationships = [(record['id'], record['start'], record['end'], record['type'], record['properties'])
+                             for record in session.run(RELATIONSHIPS_QUERY)]
+        return cls(generation, nodes, relationships)
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def index_of(self, node_id):
+        """Position of the node in the arrays or None if the id is unknown"""
+        index = bisect_left(self.node_ids, node_id)
+        if index < len(self.node_ids) and self.node_ids[index] == node_id:
+            return index
+        return None
+
+    def outgoing(self, index):
+        return self.out_edges[self.out_offsets[index]:self.out_offsets[index + 1]]
+
+    def incoming(self, index):
+        return self.in_edges[self.in_offsets[index]:self.in_offsets[index + 1]]
+
+    def serialize_node(self, index):
+        return {
+            'id': self.node_ids[index],
+            'labels': list(self.label_sets[self.node_labels[index]]),
+            'properties': self.properties[self.node_properties[index]]
+        }
+
+    def serialize_relationship(self, edge):
+        return {
+            'id': self.rel_ids[edge],
+            'startNode': self.node_ids[self.rel_start[edge]],
+            'endNode': self.node_ids[self.rel_end[edge]],
+            'type': self.types[self.rel_types[edge]],
+            'properties': self.properties[self.rel_properties[edge]]
+        }
+
+    def graph_by_id(self, node_id):
+        """Edges leaving the node as (n, r, m) indexes, like MATCH (n)-[r]->(m) WHERE id(n) = $id"""
+        index = self.index_of(node_id)
+        if index is None:
+            return []
+        return [(index, edge, self.rel_end[edge]) for edge in self.outgoing(index)]
+
+    def graph_by_label(self, label):
+        """Edges leaving all nodes with the label, like MATCH (n:Label)-[r]->(m)"""
+        records = []
+        for index in self.label_nodes.get(label, ()):
+            records.extend((index, edge, self.rel_end[edge]) for edge in self.outgoing(index))
+        return records
+
+    def node_relationships(self, node_id, direction='both', types=None):
+        """Incoming and outgoing relationships in the format of the /node_relationships endpoint"""
+        index = self.index_of(node_id)
+        if index is None:
+            return [], []
+        incoming = []
+        outgoing = []
+        if direction in ('both', 'incoming'):
+            incoming = [{
+                'id': self.rel_ids[edge],
+                'type': self.types[self.rel_types[edge]],
+                'startNode': self.node_ids[self.rel_start[edge]],
+                'properties': self.properties[self.node_properties[self.rel_start[edge]]]
+            } for edge in self.incoming(index) if types is None or self.types[self.rel_types[edge]] in types]
+        if direction in ('both', 'outgoing'):
+            outgoing = [{
+                'id': self.rel_ids[edge],
+                'type': self.types[self.rel_types[edge]],
+                'endNode': self.node_ids[self.rel_end[edge]],
+                'properties': self.properties[self.node_properties[self.rel_end[edge]]]
+            } for edge in self.outgoing(index) if types is None or self.types[self.rel_types[edge]] in types]
+        return incoming, outgoing
+
+    def node_matches(self, index, labels):
+        if labels is None:
+            return True
+        return any(label in labels for label in self.label_sets[self.node_labels[index]])
+
+    def neighbours(self, index, direction='both', types=None):
+        """Yields (edge, neighbour) pairs of the node, optionally only for the given relationship types"""
+        if direction in ('both', 'outgoing'):
+            for edge in self.outgoing(index):
+                if types is None or self.types[self.rel_types[edge]] in types:
+                    yield edge, self.rel_end[edge]
+        if direction in ('both', 'incoming'):
+            for edge in self.incoming(index):
+                if types is None or self.types[self.rel_types[edge]] in types:
+                    yield edge, self.rel_start[edge]
+
+    def neighbourhood(self, node_id, hops, max_nodes, direction='both', labels=None, types=None):
+        """Bounded BFS: nodes and relationships within the hop limit around the node.
+        Nodes which do not carry one of the labels are neither returned nor expanded.
+        Returns (nodes, edges, truncated) or None if the node is unknown"""
+        start = self.index_of(node_id)
+        if start is None:
+            return None
+        visited = {start}
+        nodes = [start]
+        edges = set()
+        frontier = [start]
+        truncated = False
+        for _ in range(hops):
+            next_frontier = []
+            for index in frontier:
+                for edge, neighbour in self.neighbours(index, direction, types):
+                    if not self.node_matches(neighbour, labels):
+                        continue
+                    if neighbour not in visited:
+                        if len(nodes) >= max_nodes:
+                            truncated = True
+                            continue
+                        visited.add(neighbour)
+                        nodes.append(neighbour)
+                        next_frontier.append(neighbour)
+                    edges.add(edge)
+            frontier = next_frontier
+            if not frontier:
+                break
+        return nodes, sorted(edges), truncated
+
+    def shortest_path(self, source_id, target_id, max_hops, max_visited, direction='both', labels=None,
+                      types=None):
+        """Bounded BFS for one shortest path between two nodes.
+        Returns (nodes, edges) along the path or None if there is none within the limits"""
+        source = self.index_of(source_id)
+        target = self.index_of(target_id)
+        if source is None or target is None:
+            return None
+        if source == target:
+            return [source], []
+        parents = {source: None}
+        frontier = [source]
+        for _ in range(max_hops):
+            next_frontier = []
+            for index in frontier:
+                for edge, neighbour in self.neighbours(index, direction, types):
+                    if neighbour in parents:
+                        continue
+                    if neighbour != target and not self.node_matches(neighbour, labels):
+                        continue
+                    parents[neighbour] = (index, edge)
+                    if neighbour == target:
+                        return self._path(parents, target)
+                    if len(parents) >= max_visited:
+                        return None
+                    next_frontier.append(neighbour)
+            frontier = next_frontier
+            if not frontier:
+                break
+        return None
+
+    @staticmethod
+    def _path(parents, target):
+        nodes = [target]
+        edges = []
+        while parents[nodes[-1]] is not None:
+            index, edge = parents[nodes[-1]]
+            nodes.append(index)
+            edges.append(edge)
+        nodes.reverse()
+        edges.reverse()
+        return nodes, edges
+
+
+class SnapshotManager:
+    """Keeps the snapshot in sync with the dataset generation of the import manifest.
+    get() never blocks on Neo4j for long: a stale snapshot is rebuilt in the background
+    and callers fall back to Neo4j until the new one is ready. After a failed build the next one
+    starts retry_interval seconds later at the earliest"""
+    def __init__(self, driver, load_generation, check_interval=30, prepare=None, retry_interval=60):
+        self.driver = driver
+        self.load_generation = load_generation
+        # builds derived data of a new snapshot before it is swapped in
+        self.prepare = prepare
+        self.check_interval = check_interval
+        self.retry_interval = retry_interval
+        self.snapshot = None
+        self.generation = None
+        self.checked_at = 0
+        self.lock = threading.Lock()
+        self.building = False
+        self.failed_at = None
+        self.failures = 0
+
+    def build(self):
+        """Builds the snapshot in the calling thread"""
+        try:
+            generation = self.load_generation()
+            snapshot = GraphSnapshot.from_neo4j(self.driver, generation)
+            if self.prepare is not None:
+                self.prepare(snapshot)
+        except Exception:
+            with self.lock:
+                self.failed_at = time.monotonic()
+                self.failures += 1
+                self.building = False
+            raise
+        with self.lock:
+            self.failed_at = None
+            self.snapshot = snapshot
+            self.generation = generation
+            self.checked_at = time.monotonic()
+            self.building = False
+        return snapshot
+
+    def _build_in_background(self):
+        with self.lock:
+            if self.building:
+                return
+            if self.failed_at is not None and time.monotonic() - self.failed_at < self.retry_interval:
+                return
+            self.building = True
+
+        def run():
+            try:
+                self.build()
+            except Exception:
+                logger.exception("Graph snapshot could not be built, retrying in %ss", self.retry_interval)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def current_generation(self):
+        """Dataset generation, read from the import manifest at most every check_interval seconds"""
+        now = time.monotonic()
+        if now - self.checked_at >= self.check_interval:
+            self.checked_at = now
+            try:
+                self.generation = self.load_generation()
+            except Exception:
+                pass
+        return self.generation
+
+    def get(self):
+        """Returns the snapshot or None if it is missing or stale"""
+        self.current_generation()
+        snapshot = self.snapshot
+        if snapshot is None or snapshot.generation != self.generation:
+            self._build_in_background()
+            return None
+        return snapshot
+
+    def invalidate(self):
+        """Forces a generation check on the next access"""
+        self.checked_at = 0
@@ -0,0 +1,44 @@
+import hashlib
+import json
+from datetime import datetime, timezone
+
+# Label of the single bookkeeping node which records what has been imported into Neo4j
+MANIFEST_LABEL = "ImportManifest"
+
+
+def dataset_fingerprint(dataset, loader_settings):
+    """Content hash of the dataset file combined with the loader configuration"""
+    digest = hashlib.sha256()
+    with open(dataset, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    digest.update(json.dumps(loader_settings, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def read_manifest(driver, name):
+    """Returns the stored manifest for the given dataset name or None if it was never imported"""
+    query = f"""
+    MATCH (m:{MANIFEST_LABEL} {{name: $name}})
+    RETURN m.hash AS hash, m.generation AS generation, m.loaded_at AS loaded_at
+    """
+    with driver.session() as session:
+        record = session.run(query, name=name).single()
+    if record is None:
+        return None
+    return {'hash': record['hash'], 'generation': record['generation'], 'loaded_at': record['loaded_at']}
+
+
+def write_manifest(driver, name, fingerprint):
+    """Stores the fingerprint of a finished import and bumps the dataset generation"""
+    query = f"""
+    MERGE (m:{MANIFEST_LABEL} {{name: $name}})
+    SET m.hash = $hash,
+        m.generation = coalesce(m.generation, 0) + 1,
+        m.loaded_at = $loaded_at
+    RETURN m.generation AS generation
+    """
+    loaded_at = datetime.now(timezone.utc).isoformat()
+    with driver.session() as session:
+        record = session.run(query, name=name, hash=fingerprint, loaded_at=loaded_at).single()
+    return record['generation']
@@ -0,0 +1,72 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """LRU cache for serialized responses bounded by the total size of the stored bodies.
+    Entries expire after ttl seconds and whenever the dataset generation changes"""
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key, generation):
+        """Returns the cached body or None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            entry_generation, expires_at, body = entry
+            if entry_generation != generation or expires_at < time.monotonic():
+                self._remove(key)
+                self.invalidations += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return body
+
+    def put(self, key, generation, body):
+        # a single body which takes more than a quarter of the cache would evict most other entries
+        if len(body) > self.max_bytes // 4:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (generation, time.monotonic() + self.ttl, body)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                oldest = next(iter(self.entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def _remove(self, key):
+        _, _, body = self.entries.pop(key)
+        self.size -= len(body)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'hit_rate': round(self.hits / requests, 4) if requests else None
+            }
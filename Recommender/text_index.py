@@ -0,0 +1,148 @@
+import math
+import re
+from collections import Counter
+
+# Nodes and properties which carry the text of the regulation
+TEXT_LABELS = ("Article", "Recital", "Point", "SubPoint")
+TEXT_PROPERTIES = ("title", "title_alternative", "description")
+
+STOPWORDS = frozenset("""
+a an and are as at be by for from has have in is it its of on or such that the their this to
+which with shall may where whether been not any other these those under into
+""".split())
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+# "Article 6", "Articles 13 and 14", "Article 6(1)(a)"
+ARTICLE_REFERENCE = re.compile(r"\bArticles?\s+(\d+(?:\([0-9a-z]+\))*(?:(?:\s*,\s*|\s+and\s+|\s+or\s+|\s+to\s+)"
+                               r"\d+(?:\([0-9a-z]+\))*)*)")
+ARTICLE_NUMBER = re.compile(r"(?<![(\d])\d+")
+# References to other legal acts, like "Article 16 of the Treaty on the Functioning of the European Union" or "Article 263 TFEU"
+FOREIGN_REFERENCE = re.compile(r"\s*(?:TFEU|TEU|of\s+(?:the\s+|that\s+)?(?:Charter|Treaty|TFEU|Directive|Regulation|"
+                               r"Council|Decision|Protocol|Framework|Annex))")
+
+
+def tokenize(text):
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOPWORDS]
+
+
+def cited_articles(text):
+    """Numbers of the GDPR articles referenced in the text"""
+    numbers = set()
+    for match in ARTICLE_REFERENCE.finditer(text):
+        if FOREIGN_REFERENCE.match(text, match.end()):
+            continue
+        numbers.update(int(number) for number in ARTICLE_NUMBER.findall(match.group(1)))
+    return numbers
+
+
+def invert_citations(citations):
+    """Sorted forward and backward maps of node id -> cited node ids"""
+    forward = {}
+    backward = {}
+    for source, targets in citations.items():
+        forward[source] = sorted(targets)
+        for target in targets:
+            backward.setdefault(target, []).append(source)
+    return forward, {target: sorted(sources) for target, sources in backward.items()}
+
+
+class TextIndex:
+    """BM25 ranked inverted index over the text of the snapshot nodes plus the Article <-> Recital citation map"""
+    def __init__(self, snapshot, k1=1.5, b=0.75):
+        self.generation = snapshot.generation
+        self.k1 = k1
+        self.b = b
+        self.postings = {}
+        self.doc_nodes = []
+        self.doc_lengths = []
+
+        indexed = set()
+        for label in TEXT_LABELS:
+            for index in snapshot.label_nodes.get(label, ()):
+                properties = snapshot.properties[snapshot.node_properties[index]]
+                text = " ".join(str(properties[key]) for key in TEXT_PROPERTIES if properties.get(key))
+                if not text or index in indexed:
+                    continue
+                indexed.add(index)
+                doc = len(self.doc_nodes)
+                tokens = tokenize(text)
+                self.doc_nodes.append(index)
+                self.doc_lengths.append(len(tokens))
+                for term, frequency in Counter(tokens).items():
+                    self.postings.setdefault(term, []).append((doc, frequency))
+
+        self.average_length = sum(self.doc_lengths) / len(self.doc_lengths) if self.doc_lengths else 0
+        self.idf = {term: math.log(1 + (len(self.doc_nodes) - len(docs) + 0.5) / (len(docs) + 0.5))
+                    for term, docs in self.postings.items()}
+        (self.recital_articles, self.article_recitals), (self.article_references, self.article_referenced_by) = \
+            self._citation_map(snapshot)
+
+    @staticmethod
+    def _citation_map(snapshot):
+        """Recitals citing Articles and Articles whose text or points reference other Articles"""
+        articles = {}
+        for index in snapshot.label_nodes.get("Article", ()):
+            properties = snapshot.properties[snapshot.node_properties[index]]
+            number = str(properties.get("number", ""))
+            if number.isdigit():
+                articles[int(number)] = snapshot.node_ids[index]
+
+        def references(index):
+            text = str(snapshot.properties[snapshot.node_properties[index]].get("description", ""))
+            return {articles[number] for number in cited_articles(text) if number in articles}
+
+        recital_articles = {}
+        for index in snapshot.label_nodes.get("Recital", ()):
+            cited = references(index)
+            if cited:
+                recital_articles[snapshot.node_ids[index]] = cited
+
+        article_references = {}
+        article_ids = set(articles.values())
+        for label in ("Article", "Point", "SubPoint"):
+            for index in snapshot.label_nodes.get(label, ()):
+                node_id = snapshot.node_ids[index]
+                if node_id in article_ids:
+                    containing = {node_id}
+                else:
+                    containing = {snapshot.node_ids[neighbour] for edge, neighbour in
+                                  snapshot.neighbours(index, 'outgoing', {'isPartOfArticle'})}
+                cited = references(index)
+                for article_id in containing:
+                    cited_elsewhere = cited - {article_id}
+                    if cited_elsewhere:
+                        article_references.setdefault(article_id, set()).update(cited_elsewhere)
+
+        return invert_citations(recital_articles), invert_citations(article_references)
+
+    def search(self, query, limit=10, labels=None, snapshot=None):
+        """Returns (node index, score) pairs ordered by their BM25 score"""
+        scores = {}
+        for term in set(tokenize(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for doc, frequency in self.postings[term]:
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc] / self.average_length)
+                scores[doc] = scores.get(doc, 0) + idf * frequency * (self.k1 + 1) / (frequency + norm)
+
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        results = []
+        for doc, score in ranked:
+            index = self.doc_nodes[doc]
+            if labels is not None and not snapshot.node_matches(index, labels):
+                continue
+            results.append((index, score))
+            if len(results) >= limit:
+                break
+        return results
+
+    def citations(self, node_id):
+        """Citations of a Recital or an Article as lists of node ids"""
+        return {
+            'cites_articles': self.recital_articles.get(node_id, []),
+            'cited_by_recitals': self.article_recitals.get(node_id, []),
+            'references_articles': self.article_references.get(node_id, []),
+            'referenced_by_articles': self.article_referenced_by.get(node_id, [])
+        }
@@ -0,0 +1,193 @@
+"""Request tracing and latency metrics shared by the Flask services
+
+Every request gets an id, taken from the X-Request-Id header of the caller or generated, which is passed on
+to the upstream calls and returned in the response. Request durations and the stages of a request (upstream
+HTTP, Neo4j, MongoDB / GridFS, embedding, retrieval, LLM generation) are recorded as Prometheus histograms
+on /metrics, next to the counters the services register. Requests slower than the threshold are logged with
+their stage breakdown.
+"""
+import logging
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from flask import Response, abort, g, has_request_context, request
+
+REQUEST_ID_HEADER = "X-Request-Id"
+# ids of the callers are only taken over if they cannot break log lines or headers
+REQUEST_ID_PATTERN = re.compile(r"[\w.-]{1,128}")
+# seconds, LLM generations on a CPU take minutes
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+logger = logging.getLogger("instrumentation")
+
+
+class Histogram:
+    """Prometheus histogram with labels"""
+    def __init__(self, name, documentation, label_names, buckets=BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # label values -> [bucket counts..., sum, count]
+        self.series = {}
+
+    def observe(self, seconds, *label_values):
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [0] * (len(self.buckets) + 2)
+            for position, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    series[position] += 1
+            series[-2] += seconds
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = {labels: list(values) for labels, values in self.series.items()}
+        for label_values, values in sorted(series.items()):
+            labels = ",".join(f'{name}="{value}"' for name, value in zip(self.label_names, label_values))
+            for bound, count in zip(self.buckets, values):
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {values[-1]}')
+            lines.append(f"{self.name}_sum{{{labels}}} {values[-2]:.6f}")
+            lines.append(f"{self.name}_count{{{labels}}} {values[-1]}")
+        return "\n".join(lines)
+
+
+class Counter:
+    """Prometheus counter (or gauge) with labels, whose values collect() returns by label values when /metrics
+    is scraped"""
+    def __init__(self, name, documentation, label_names, collect, metric_type="counter"):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.collect = collect
+        self.metric_type = metric_type
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        for label_values, value in sorted(self.collect().items()):
+            labels = ",".join(f'{name}="{value}"' for name, value in
+                              zip(("service",) + self.label_names, (service_name,) + label_values))
+            lines.append(f"{self.name}{{{labels}}} {value}")
+        return "\n".join(lines)
+
+
+REQUEST_DURATION = Histogram("http_request_duration_seconds", "Duration of the requests until the response headers",
+                             ("service", "endpoint", "method", "status"))
+STAGE_DURATION = Histogram("request_stage_duration_seconds", "Duration of the stages of the requests",
+                           ("service", "stage"))
+
+# set by Instrumentation, stages outside of a request are recorded for this service
+service_name = "unknown"
+# Counters rendered on /metrics after the histograms
+counters = []
+
+
+def register(counter):
+    counters.append(counter)
+    return counter
+
+
+def request_id():
+    """Id of the current request, None outside of a request"""
+    if has_request_context():
+        return g.get('request_id')
+    return None
+
+
+def outgoing_headers():
+    """Headers which pass the request id on to an upstream service"""
+    current = request_id()
+    return {REQUEST_ID_HEADER: current} if current else {}
+
+
+def record_stage(name, seconds):
+    STAGE_DURATION.observe(seconds, service_name, name)
+    if has_request_context() and 'stages' in g:
+        g.stages.append((name, seconds))
+
+
+@contextmanager
+def stage(name):
+    """Times the block as a stage of the current request"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - start)
+
+
+def mongo_listener():
+    """pymongo command listener which records the MongoDB commands as stages, GridFS collections as "gridfs" """
+    from pymongo import monitoring
+
+    class MongoStages(monitoring.CommandListener):
+        def __init__(self):
+            self.lock = threading.Lock()
+            self.stages = {}
+
+        def started(self, event):
+            collection = event.command.get(event.command_name)
+            name = "gridfs" if isinstance(collection, str) and collection.startswith("fs.") else "mongo"
+            with self.lock:
+                self.stages[(event.connection_id, event.request_id)] = name
+
+        def _finished(self, event):
+            with self.lock:
+                name = self.stages.pop((event.connection_id, event.request_id), "mongo")
+            record_stage(name, event.duration_micros / 1e6)
+
+        def succeeded(self, event):
+            self._finished(event)
+
+        def failed(self, event):
+            self._finished(event)
+
+    return MongoStages()
+
+
+class Instrumentation:
+    """Request ids, request and stage histograms, /metrics and the slow request log for a Flask app"""
+    def __init__(self, app, service, slow_request_seconds=2.0):
+        global service_name
+        service_name = service
+        self.app = app
+        self.service = service
+        self.slow_request_seconds = slow_request_seconds
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+        app.add_url_rule("/metrics", "metrics", self.metrics)
+
+    @staticmethod
+    def start_request():
+        caller_id = request.headers.get(REQUEST_ID_HEADER, "")
+        g.request_id = caller_id if REQUEST_ID_PATTERN.fullmatch(caller_id) else uuid.uuid4().hex
+        g.request_start = time.perf_counter()
+        g.stages = []
+
+    def finish_request(self, response):
+        if 'request_start' not in g:
+            return response
+        seconds = time.perf_counter() - g.request_start
+        response.headers[REQUEST_ID_HEADER] = g.request_id
+        REQUEST_DURATION.observe(seconds, self.service, request.endpoint or "unmatched", request.method,
+                                 str(response.status_code))
+        if seconds >= self.slow_request_seconds:
+            stages = ", ".join(f"{name}={stage_seconds * 1000:.1f}ms" for name, stage_seconds in g.stages)
+            logger.warning("Slow request %s %s %s %s %.1fms: %s", g.request_id, request.method, request.full_path,
+                           response.status_code, seconds * 1000, stages or "no stages")
+        return response
+
+    @staticmethod
+    def metrics():
+        if request.remote_addr != '127.0.0.1':
+            abort(403)
+        body = "".join(metric.render() + "\n" for metric in [REQUEST_DURATION, STAGE_DURATION] + counters)
+        return Response(body, mimetype="text/plain; version=0.0.4")